@@ -1,13 +1,25 @@
-
 import os
 
+
+__all__ = ["AttributeDict"]
+
+
+
 class AttributeDict(object):
     """
     A class to convert a nested Dictionary into an object with key-values
     accessibly using attribute notation (AttributeDict.attribute) instead of
     key notation (Dict["key"]). This class recursively sets Dicts to objects,
     allowing you to recurse down nested dicts (like: AttributeDict.attr.attr)
+
+    Values are prepared only when first looked up, and then remembered as
+    ordinary attributes: a nested dict becomes an AttributeDict, and shell
+    variables in text are expanded (as of that first lookup). So later
+    lookups are plain attribute access, and an object taken from another
+    (e.g., a toolkit's tools, from its pipeline manager's config) is shared
+    rather than copied.
     """
+
     def __init__(self, entries, default=False):
         """
         :param entries: A dictionary (key-value pairs) to add as attributes.
@@ -16,22 +28,15 @@ class AttributeDict(object):
         AttributeDict.java would return "java" instead of raising an error,
         if no .java attribute were found.
         """
+        # Entries not yet looked up, each with its default mode
+        self._entries = {}
         self.add_entries(entries, default)
         self.return_defaults = default
 
     def add_entries(self, entries, default=False):
         for key, value in entries.items():
-            if type(value) is dict:
-                self.__dict__[key] = AttributeDict(value, default)
-            else:
-                try:
-                    # try expandvars() to allow the yaml to use
-                    # shell variables.
-                    self.__dict__[key] = os.path.expandvars(value)  # value
-                except TypeError:
-                    # if value is an int, expandvars() will fail; if 
-                    # expandvars() fails, just use the raw value
-                    self.__dict__[key] = value
+            self._entries[key] = (value, default)
+            self.__dict__.pop(key, None)
 
     def __getitem__(self, key):
         """
@@ -39,13 +44,23 @@ class AttributeDict(object):
         """
         return getattr(self, key)
 
+    def __contains__(self, key):
+        return key in self._entries or \
+            (key in self.__dict__ and key not in _INTERNAL)
+
     def __repr__(self):
-        return str(self.__dict__)
+        for key in list(self._entries):
+            getattr(self, key)
+        return str({key: value for key, value in self.__dict__.items()
+                    if key not in _INTERNAL})
 
     def __getattr__(self, name):
-        if name in self.__dict__.keys():
-            return self.name
-        else:
+        if name in _INTERNAL or name.startswith("__"):
+            # Not yet initialized (e.g., while being copied), or a special
+            # method that's not provided
+            raise AttributeError(name)
+        entry = self._entries.get(name)
+        if entry is None:
             if self.return_defaults:
                 # If this object has default mode on, then we should
                 # simply return the name of the requested attribute as
@@ -53,3 +68,18 @@ class AttributeDict(object):
                 return name
             else:
                 raise AttributeError("No attribute " + name)
+        value, default = entry
+        if type(value) is dict:
+            value = AttributeDict(value, default)
+        elif isinstance(value, str):
+            # Expand shell variables, to allow the yaml to use them.
+            value = os.path.expandvars(value)
+        # If another thread got here first, its value is the one shared.
+        value = self.__dict__.setdefault(name, value)
+        self._entries.pop(name, None)
+        return value
+
+
+
+# Attributes of an AttributeDict itself, rather than of its data
+_INTERNAL = frozenset(["_entries", "return_defaults"])
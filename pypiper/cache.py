@@ -0,0 +1,199 @@
+""" Content-addressed cache of command results, shared across runs """
+
+import errno
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+from .manifest import file_digest
+
+
+__all__ = ["ResultCache"]
+
+
+# Suffix of results being written to the cache
+_TEMP_SUFFIX = ".tmp"
+
+
+
+class ResultCache(object):
+    """
+    Store of targets keyed by the command and input content that made them.
+
+    A target made by a command from given inputs is stored under a key that
+    combines the command text with the digest of each input's content, so
+    that any later run of the same command on identical inputs--for another
+    sample, or on a rerun--can take the stored result rather than recompute
+    it. A new result is copied into the cache, so the pipeline's own target
+    is left as it was. A cached result is hard-linked into place where
+    possible, and copied otherwise; since a linked file is shared with the
+    cache, cached results are read-only. Use of a result is noted in its
+    access time, leaving its modification time (and so that of every copy
+    linked to it) alone. If the cache has a size limit, the least recently
+    used results are evicted to keep within it.
+
+    :param str folder: Path to the folder in which to keep results; it may be
+        shared by several pipelines.
+    :param int max_size: Maximum total size of cached results, in bytes;
+        unlimited if not provided
+    """
+
+    def __init__(self, folder, max_size=None):
+        self.folder = folder
+        self.max_size = max_size
+        self._digests = {}
+        self._lock = threading.Lock()
+        # Running total size of the results, once it's been measured
+        self._size = None
+
+
+    def key(self, cmd, inputs):
+        """
+        Determine the cache key for a command run on particular inputs.
+
+        :param str cmd: Command that makes the target.
+        :param Iterable[str] inputs: Paths to the files used to make target.
+        :return str: Key for the result of the command on these inputs.
+        """
+        h = hashlib.sha1(cmd.encode("utf-8"))
+        for path in inputs:
+            h.update(b"\0")
+            h.update(self._digest(path).encode("utf-8"))
+        return h.hexdigest()
+
+
+    def fetch(self, key, target):
+        """
+        Put the cached result for a key at the target path, if there is one.
+
+        :param str key: Key for the result, as from key()
+        :param str target: Path at which to place the result.
+        :return bool: Whether the result was in the cache.
+        """
+        path = self._path(key)
+        try:
+            info = os.stat(path)
+            # Mark as recently used, keeping the modification time.
+            os.utime(path, (time.time(), info.st_mtime))
+        except OSError:
+            return False
+        if os.path.lexists(target):
+            os.remove(target)
+        _link_or_copy(path, target)
+        return True
+
+
+    def store(self, key, target):
+        """
+        Add a newly made target to the cache.
+
+        :param str key: Key for the result, as from key()
+        :param str target: Path to the result; only a file can be cached.
+        :return bool: Whether the target was cached.
+        """
+        if not os.path.isfile(target):
+            return False
+        path = self._path(key)
+        _makedirs(os.path.dirname(path))
+        fd, temp = tempfile.mkstemp(
+            suffix=_TEMP_SUFFIX, dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as dst, open(target, "rb") as src:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            os.chmod(temp, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            size = os.path.getsize(temp)
+            os.rename(temp, path)
+        except Exception:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+        if self.max_size is not None:
+            with self._lock:
+                if self._size is not None:
+                    self._size += size
+                over = self._size is None or self._size > self.max_size
+            if over:
+                self.evict(self.max_size)
+        return True
+
+
+    def evict(self, max_size):
+        """
+        Remove least recently used results until the cache is small enough.
+
+        This measures the whole cache, so store() calls it only when the
+        running total (as of the last measurement, plus what's been stored
+        since) exceeds the limit.
+
+        :param int max_size: Maximum total size of cached results, in bytes
+        :return list[str]: Paths to the results removed
+        """
+        entries = []
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if name.endswith(_TEMP_SUFFIX):
+                    # Being written, by this or another pipeline
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((info.st_atime, info.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for _, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed.append(path)
+        with self._lock:
+            self._size = total
+        return removed
+
+
+    def _digest(self, path):
+        """ Hash a file's content, reusing the hash if it's unmodified. """
+        info = os.stat(path)
+        state = (os.path.abspath(path), info.st_mtime, info.st_size)
+        with self._lock:
+            digest = self._digests.get(state)
+        if digest is None:
+            digest = file_digest(path)
+            with self._lock:
+                self._digests[state] = digest
+        return digest
+
+
+    def _path(self, key):
+        """ Determine where the result for a key is kept. """
+        return os.path.join(self.folder, key[:2], key)
+
+
+
+def _link_or_copy(src, dst):
+    """ Hard link a file, or copy it if it can't be linked. """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+
+def _makedirs(path):
+    """ Create a folder if it doesn't already exist. """
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
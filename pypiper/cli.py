@@ -0,0 +1,148 @@
+""" Command-line interface to pypiper's tools for pipeline output """
+
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+
+from .profiling import SUMMARY_FIELDS, read_profiles, summarize_profiles
+
+
+__all__ = ["main"]
+
+
+
+# For each way of ranking offenders, the statistic by which to rank.
+_RANKINGS = {"wall": "wall_total", "time": "wall_p95", "mem": "mem_p95",
+             "failures": "failure_rate"}
+
+
+
+def build_parser():
+    """
+    Create the parser for the pypiper command's arguments.
+
+    :return argparse.ArgumentParser: Parser with a subcommand for each tool
+    """
+    parser = argparse.ArgumentParser(
+        prog="pypiper", description="Tools for the output of pypiper pipelines")
+    subparsers = parser.add_subparsers(dest="command")
+
+    report = subparsers.add_parser(
+        "profile-report",
+        help="Summarize the profiles of many pipeline runs",
+        description="Aggregate the commands in the profiles of many pipeline "
+                    "output folders, and list the worst offenders for time, "
+                    "memory, and failures.")
+    report.add_argument(
+        "folders", nargs="+",
+        help="Pipeline output folders or profile files; glob patterns are "
+             "expanded")
+    report.add_argument(
+        "--by", choices=["tool", "stage", "lock_name", "command"],
+        default="tool", help="How to group commands (default: %(default)s)")
+    report.add_argument(
+        "--sort", choices=sorted(_RANKINGS), default="wall",
+        help="How to rank groups: total wall time, p95 wall time, p95 peak "
+             "memory, or failure rate (default: %(default)s)")
+    report.add_argument(
+        "--top", type=int, default=10,
+        help="Number of groups to list (default: %(default)s)")
+    report.add_argument(
+        "-p", "--processes", type=int, default=multiprocessing.cpu_count(),
+        help="Number of processes with which to read profiles "
+             "(default: %(default)s)")
+    report.add_argument(
+        "-o", "--output",
+        help="Path to a TSV file to which to write the full summary")
+    return parser
+
+
+
+def main(argv=None):
+    """
+    Run the pypiper command.
+
+    :param Iterable[str] argv: Command-line arguments; those given to this
+        process if not provided
+    :return int: Exit status
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command != "profile-report":
+        parser.print_help()
+        return 1
+    return profile_report(args)
+
+
+
+def profile_report(args):
+    """
+    Print the summary of profiles asked for on the command line.
+
+    :param argparse.Namespace args: Parsed arguments to profile-report
+    :return int: Exit status
+    """
+    paths = []
+    for pattern in args.folders:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    missing = [p for p in paths if not os.path.exists(p)]
+    if missing:
+        sys.stderr.write("No such file or folder: {}\n".format(
+            ", ".join(missing)))
+        return 1
+    columns = read_profiles(paths, workers=args.processes)
+    if not columns["command"]:
+        sys.stderr.write("No profiles found\n")
+        return 1
+    summary = summarize_profiles(columns, by=args.by)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write("\t".join(SUMMARY_FIELDS) + "\n")
+            for group in summary:
+                f.write("\t".join(_format_value(group[field], "")
+                                  for field in SUMMARY_FIELDS) + "\n")
+    stat = _RANKINGS[args.sort]
+    ranked = sorted(summary, key=lambda g: -(g[stat] or 0))[:args.top]
+    folders = len(set(columns["folder"]))
+    print("Commands: {}; folders: {}; groups: {}".format(
+        len(columns["command"]), folders, len(summary)))
+    print("Top {} by {} ({}):".format(len(ranked), args.by, stat))
+    print(_format_table(ranked))
+    return 0
+
+
+
+def _format_table(summary):
+    """ Lay out summary statistics as an aligned text table. """
+    headers = ["group", "runs", "failures", "fail%", "wall_total",
+               "wall_p50", "wall_p95", "mem_p50", "mem_p95", "mem_max"]
+    rows = []
+    for group in summary:
+        rate = group["failure_rate"]
+        rows.append([
+            str(group["group"]), str(group["runs"]), str(group["failures"]),
+            "-" if rate is None else "{:.1f}".format(100 * rate)] +
+            [_format_value(group[field]) for field in SUMMARY_FIELDS[4:]])
+    widths = [max(len(r[i]) for r in [headers] + rows)
+              for i in range(len(headers))]
+    lines = ["  ".join(h.ljust(w) if i == 0 else h.rjust(w)
+                       for i, (h, w) in enumerate(zip(row, widths)))
+             for row in [headers] + rows]
+    return "\n".join(lines)
+
+
+
+def _format_value(value, missing="-"):
+    """ Render a statistic for display. """
+    if value is None:
+        return missing
+    if isinstance(value, float):
+        return "{:.2f}".format(value)
+    return str(value)
+
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+""" Waiting for files to appear or disappear """
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import random
+import select
+import time
+
+
+__all__ = ["DirectoryWatcher", "wait_for"]
+
+
+
+# inotify(7) flags for the changes that may satisfy a wait: a file created,
+# deleted, or renamed into or out of the watched folder.
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_WATCH_MASK = _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+
+_libc = None
+
+
+
+class DirectoryWatcher(object):
+    """
+    Block until something changes in a folder.
+
+    Where inotify is available, a wait ends as soon as a file in the folder
+    is created, deleted, or renamed. Elsewhere, or if the folder can't be
+    watched, a wait simply lasts as long as its timeout. Note that on a
+    network file system (e.g., NFS), changes made by other hosts aren't
+    reported, so waits should always be bounded.
+
+    :param str folder: Path to the folder to watch.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.fd = _inotify_watch(folder)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    @property
+    def active(self):
+        """
+        Determine whether changes to the folder can be noticed.
+
+        :return bool: Whether inotify is watching the folder.
+        """
+        return self.fd is not None
+
+
+    def wait(self, timeout):
+        """
+        Wait for a change in the folder, or for the timeout to elapse.
+
+        :param float timeout: Maximum number of seconds to wait.
+        :return bool: Whether a change was seen (False if timed out).
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+        try:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+        except (OSError, select.error) as e:
+            if _errno(e) == errno.EINTR:
+                return False
+            raise
+        if not ready:
+            return False
+        # Drain the events; the caller checks for itself what's changed.
+        try:
+            while os.read(self.fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return True
+
+
+    def close(self):
+        """ Stop watching the folder. """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+
+def wait_for(condition, path, max_interval=60, on_timeout=None):
+    """
+    Block until a condition involving a file is satisfied.
+
+    The condition is rechecked as soon as anything changes in the folder
+    containing the file, if that can be watched; otherwise, or in case a
+    change goes unreported, it's rechecked after intervals that double, with
+    random jitter, up to a limit. Jitter keeps many waiters on the same file
+    from checking it in lockstep.
+
+    :param callable condition: Function of no arguments returning whether
+        the wait is over, e.g. whether the file exists.
+    :param str path: Path to the file of interest.
+    :param float max_interval: Maximum number of seconds between checks.
+    :param callable on_timeout: Function to call, with no arguments, each
+        time that an interval passes without the condition being satisfied.
+    """
+    interval = 0.5
+    with DirectoryWatcher(os.path.dirname(os.path.abspath(path))) as watcher:
+        # The watch is set before this check, so no change can be missed.
+        while not condition():
+            delay = random.uniform(0.5, 1.0) * interval
+            if not watcher.wait(delay):
+                interval = min(2 * interval, max_interval)
+                if on_timeout is not None and not condition():
+                    on_timeout()
+
+
+
+def _inotify_watch(folder):
+    """
+    Begin watching a folder with inotify.
+
+    :param str folder: Path to the folder to watch.
+    :return int | NoneType: File descriptor from which to read the folder's
+        events, or null if it can't be watched.
+    """
+    global _libc
+    if not hasattr(select, "select") or not os.path.isdir(folder):
+        return None
+    try:
+        if _libc is None:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        init, add_watch = _libc.inotify_init1, _libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    # Python 2 lacks O_CLOEXEC, whose value is IN_CLOEXEC's on Linux.
+    fd = init(os.O_NONBLOCK | getattr(os, "O_CLOEXEC", 0o2000000))
+    if fd < 0:
+        return None
+    if add_watch(fd, folder.encode(), _WATCH_MASK) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+
+def _errno(e):
+    """ Fetch the error number from an exception, in Python 2 or 3. """
+    return getattr(e, "errno", None) or (e.args[0] if e.args else None)
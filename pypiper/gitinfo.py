@@ -0,0 +1,297 @@
+""" Version provenance of code in git repositories, read without running git """
+
+from concurrent.futures import Future
+import binascii
+import datetime
+import os
+import struct
+import subprocess
+import threading
+import zlib
+
+
+__all__ = ["repo_info", "diff_stat", "diff_stat_async"]
+
+
+
+# Type of a commit object in a pack file
+_PACK_COMMIT = 1
+
+
+
+def repo_info(path):
+    """
+    Describe the commit checked out in the git repository containing a path.
+
+    The repository's files are read directly (HEAD, the branch's ref, loose
+    or packed, and the commit object), so no git process is started.
+
+    :param str path: Path to a folder within the repository's work tree.
+    :return dict | NoneType: The commit's hash ('hash') and date ('date', as
+        in git's %ai format), and the branch checked out ('branch'); null if
+        the path isn't in a repository. The date is null if the commit
+        couldn't be read.
+    """
+    git_dir = find_git_dir(path)
+    if git_dir is None:
+        return None
+    common_dir = _common_dir(git_dir)
+    head = os.path.join(git_dir, "HEAD")
+    try:
+        with open(head) as f:
+            text = f.read().strip()
+    except (IOError, OSError):
+        return None
+    if text.startswith("ref:"):
+        ref = text[4:].strip()
+        branch = ref[len("refs/heads/"):] if ref.startswith("refs/heads/") \
+            else ref
+        sha = _read_ref(common_dir, ref)
+    else:
+        sha = text
+        branch = "(HEAD detached at {})".format(sha[:7])
+    if sha is None:
+        # A branch with no commits yet
+        return None
+    return {"hash": sha, "branch": branch,
+            "date": commit_date(common_dir, sha)}
+
+
+
+def diff_stat(path):
+    """
+    Summarize uncommitted changes to the repository containing a path.
+
+    This compares the work tree to the index and the commit, so, unlike the
+    rest of the provenance, it takes git itself (and may be slow for a
+    large work tree).
+
+    :param str path: Path to a folder within the repository's work tree.
+    :return str: Summary of changes, as by git diff --shortstat; empty if
+        none, or if git can't be run
+    """
+    try:
+        with open(os.devnull, "w") as devnull:
+            out = subprocess.check_output(
+                ["git", "diff", "--shortstat", "HEAD"], cwd=path,
+                stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+    return out.decode("utf-8", "replace").strip()
+
+
+
+def diff_stat_async(path):
+    """
+    Summarize uncommitted changes to a repository in the background.
+
+    :param str path: Path to a folder within the repository's work tree.
+    :return concurrent.futures.Future: Summary of changes, as by diff_stat,
+        once it's been computed
+    """
+    future = Future()
+
+    def compute():
+        future.set_result(diff_stat(path))
+
+    thread = threading.Thread(target=compute)
+    thread.daemon = True
+    thread.start()
+    return future
+
+
+
+def find_git_dir(path):
+    """
+    Find the git folder of the repository containing a path.
+
+    :param str path: Path to a folder within a work tree.
+    :return str | NoneType: Path to the git folder, or null if there's none
+    """
+    path = os.path.abspath(path)
+    while True:
+        dot_git = os.path.join(path, ".git")
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.isfile(dot_git):
+            # Work trees and submodules point to their git folder.
+            try:
+                with open(dot_git) as f:
+                    text = f.read().strip()
+            except (IOError, OSError):
+                return None
+            if text.startswith("gitdir:"):
+                return os.path.normpath(
+                    os.path.join(path, text[len("gitdir:"):].strip()))
+            return None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+
+def commit_date(git_dir, sha):
+    """
+    Determine when a commit was authored.
+
+    :param str git_dir: Path to the repository's git (common) folder.
+    :param str sha: Hash of the commit.
+    :return str | NoneType: Commit date, as in git's %ai format (e.g.,
+        '2018-05-01 12:34:56 -0400'); null if the commit can't be read
+    """
+    try:
+        data = _read_object(git_dir, sha)
+    except (IOError, OSError, ValueError, zlib.error, struct.error):
+        data = None
+    if data is None:
+        # E.g., a commit stored as a delta, which takes git to reconstruct
+        return _git_commit_date(git_dir, sha)
+    for line in data.split(b"\n"):
+        if not line:
+            break
+        if line.startswith(b"author "):
+            seconds, zone = line.rsplit(b" ", 2)[1:]
+            return _format_date(int(seconds), zone.decode())
+    return None
+
+
+
+def _git_commit_date(git_dir, sha):
+    """ Have git determine when a commit was authored. """
+    try:
+        with open(os.devnull, "w") as devnull:
+            out = subprocess.check_output(
+                ["git", "--git-dir", git_dir, "show", "-s", "--format=%ai",
+                 sha], stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode("utf-8", "replace").strip() or None
+
+
+
+def _format_date(seconds, zone):
+    """ Render a time and time zone offset (e.g., '-0400') as git does. """
+    sign = -1 if zone.startswith("-") else 1
+    offset = sign * (int(zone[1:3]) * 3600 + int(zone[3:5]) * 60)
+    moment = datetime.datetime(1970, 1, 1) + \
+        datetime.timedelta(seconds=seconds + offset)
+    return "{} {}".format(moment.strftime("%Y-%m-%d %H:%M:%S"), zone)
+
+
+
+def _common_dir(git_dir):
+    """ Find the folder with the objects and refs shared by work trees. """
+    try:
+        with open(os.path.join(git_dir, "commondir")) as f:
+            return os.path.normpath(os.path.join(git_dir, f.read().strip()))
+    except (IOError, OSError):
+        return git_dir
+
+
+
+def _read_ref(git_dir, ref):
+    """ Resolve a ref to a hash, from its loose file or the packed refs. """
+    try:
+        with open(os.path.join(git_dir, ref)) as f:
+            text = f.read().strip()
+        if text.startswith("ref:"):
+            return _read_ref(git_dir, text[4:].strip())
+        return text
+    except (IOError, OSError):
+        pass
+    try:
+        with open(os.path.join(git_dir, "packed-refs")) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2 and fields[1] == ref:
+                    return fields[0]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+
+def _read_object(git_dir, sha):
+    """ Read a commit object's content, from a loose object or a pack. """
+    loose = os.path.join(git_dir, "objects", sha[:2], sha[2:])
+    if os.path.isfile(loose):
+        with open(loose, "rb") as f:
+            data = zlib.decompress(f.read())
+        return data[data.index(b"\0") + 1:]
+    pack_dir = os.path.join(git_dir, "objects", "pack")
+    try:
+        indexes = [f for f in os.listdir(pack_dir) if f.endswith(".idx")]
+    except OSError:
+        return None
+    binary = binascii.unhexlify(sha)
+    for index in indexes:
+        offset = _pack_offset(os.path.join(pack_dir, index), binary)
+        if offset is not None:
+            return _read_packed(
+                os.path.join(pack_dir, index[:-len(".idx")] + ".pack"), offset)
+    return None
+
+
+
+def _pack_offset(index_file, binary):
+    """
+    Look up where an object is in a pack, using its (version 2) index.
+
+    Only the fanout table and the entries the search visits are read, not
+    the whole index, which in a large repository is many megabytes.
+    """
+    with open(index_file, "rb") as f:
+        header = f.read(8)
+        if len(header) != 8 or header[:4] != b"\377tOc" or \
+                struct.unpack(">I", header[4:])[0] != 2:
+            return None
+        fanout = struct.unpack(">256I", f.read(1024))
+        first = ord(binary[:1])
+        low = fanout[first - 1] if first else 0
+        high = fanout[first]
+        count = fanout[255]
+        names = 8 + 1024
+        while low < high:
+            mid = (low + high) // 2
+            f.seek(names + 20 * mid)
+            name = f.read(20)
+            if name < binary:
+                low = mid + 1
+            elif name > binary:
+                high = mid
+            else:
+                # Past the names come a CRC and then an offset for each.
+                offsets = names + 24 * count
+                f.seek(offsets + 4 * mid)
+                offset = struct.unpack(">I", f.read(4))[0]
+                if offset & 0x80000000:
+                    f.seek(offsets + 4 * count + 8 * (offset & 0x7fffffff))
+                    offset = struct.unpack(">Q", f.read(8))[0]
+                return offset
+    return None
+
+
+
+def _read_packed(pack_file, offset):
+    """ Read an undeltified commit from a pack; null if it's deltified. """
+    with open(pack_file, "rb") as f:
+        f.seek(offset)
+        byte = ord(f.read(1))
+        kind = (byte >> 4) & 7
+        size = byte & 15
+        shift = 4
+        while byte & 0x80:
+            byte = ord(f.read(1))
+            size |= (byte & 0x7f) << shift
+            shift += 7
+        if kind != _PACK_COMMIT:
+            return None
+        decompressor = zlib.decompressobj()
+        data = b""
+        while len(data) < size:
+            chunk = f.read(4096)
+            if not chunk:
+                break
+            data += decompressor.decompress(chunk)
+    return data[:size]
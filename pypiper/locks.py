@@ -0,0 +1,268 @@
+""" Backends for the lock files that guard targets being produced """
+
+import errno
+import os
+import socket
+import threading
+
+from .filewatch import wait_for
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+__all__ = ["ExclusiveFileLocks", "FlockLocks", "LOCK_BACKENDS",
+           "get_lock_backend"]
+
+
+
+class ExclusiveFileLocks(object):
+    """
+    Locks that are held for as long as the lock file exists.
+
+    A lock file is created exclusively (O_CREAT|O_EXCL), so only one process
+    can create it, and it's removed to release the lock. This works on any
+    file system, but a lock file left behind by a process that was killed
+    keeps the lock held until it's removed (e.g., by running in recover mode).
+    """
+
+    def acquire(self, path, force=False):
+        """
+        Take the lock, failing if it's held.
+
+        :param str path: Path to the lock file.
+        :param bool force: Whether to take the lock even if it's held.
+        :raise OSError: If the lock is held (errno EEXIST)
+        """
+        flags = os.O_CREAT | os.O_WRONLY | (os.O_TRUNC if force else os.O_EXCL)
+        fd = os.open(path, flags)
+        try:
+            os.write(fd, _owner_text())
+        finally:
+            os.close(fd)
+
+
+    def release(self, path):
+        """
+        Give up the lock.
+
+        :param str path: Path to the lock file.
+        """
+        os.remove(path)
+
+
+    def is_locked(self, path):
+        """
+        Determine whether the lock is held.
+
+        :param str path: Path to the lock file.
+        :return bool: Whether the lock is held.
+        """
+        return os.path.isfile(path)
+
+
+    def wait(self, path, on_timeout=None):
+        """
+        Block until the lock's released, i.e. its file's removed.
+
+        :param str path: Path to the lock file.
+        :param callable on_timeout: Function to call, with no arguments,
+            each time that a while passes with the lock still held.
+        """
+        wait_for(lambda: not self.is_locked(path), path, on_timeout=on_timeout)
+
+
+    def owner(self, path):
+        """
+        Determine which process holds the lock.
+
+        :param str path: Path to the lock file.
+        :return dict | NoneType: ID ('pid') and host ('host') of the process
+            that took the lock, if recorded
+        """
+        return read_owner(path)
+
+
+
+class FlockLocks(ExclusiveFileLocks):
+    """
+    Locks held by way of an advisory lock on the lock file (flock).
+
+    The kernel releases a process's locks when it dies, however it dies, so
+    a lock file with no lock on it is known to be stale: anyone waiting for
+    it can go ahead right away, and whoever takes the lock next reuses the
+    file. Note that flock is only reliable on local file systems and those
+    network file systems that support it (e.g., NFSv4).
+    """
+
+    def __init__(self):
+        if fcntl is None:
+            raise OSError("File locking (fcntl) isn't available")
+        self._held = {}
+
+
+    def acquire(self, path, force=False):
+        """
+        Take the lock, failing if it's held.
+
+        :param str path: Path to the lock file.
+        :param bool force: Whether to take the lock even if it's held, by
+            replacing the lock file.
+        :raise OSError: If the lock is held (errno EEXIST)
+        """
+        if force and os.path.isfile(path):
+            os.remove(path)
+        while True:
+            fd = os.open(path, os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                os.close(fd)
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    raise OSError(errno.EEXIST, "Lock is held", path)
+                raise
+            # The previous holder may have removed the file in the meantime,
+            # leaving this one locking a file that no one else can see.
+            try:
+                current = os.stat(path).st_ino == os.fstat(fd).st_ino
+            except OSError:
+                current = False
+            if current:
+                break
+            os.close(fd)
+        os.ftruncate(fd, 0)
+        os.write(fd, _owner_text())
+        self._held[path] = fd
+
+
+    def release(self, path):
+        """
+        Give up the lock.
+
+        :param str path: Path to the lock file.
+        """
+        # Remove the file before unlocking it, so that no one can lock the
+        # old file once it's no longer in use.
+        try:
+            os.remove(path)
+        finally:
+            fd = self._held.pop(path, None)
+            if fd is not None:
+                os.close(fd)
+
+
+    def is_locked(self, path):
+        """
+        Determine whether the lock is held, by a living process.
+
+        :param str path: Path to the lock file.
+        :return bool: Whether the lock is held.
+        """
+        if path in self._held:
+            return True
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+        finally:
+            os.close(fd)
+        return False
+
+
+    def wait(self, path, on_timeout=None, max_interval=60):
+        """
+        Block until the lock's released, by its holder or by its holder's
+        death.
+
+        A helper thread blocks in a shared flock of the lock file, so the
+        wait ends as soon as the holder's lock is dropped, rather than when
+        the lock file next changes (it doesn't, if the holder's killed).
+
+        :param str path: Path to the lock file.
+        :param callable on_timeout: Function to call, with no arguments,
+            each time that a while passes with the lock still held.
+        :param float max_interval: Maximum number of seconds between calls
+            of on_timeout; the intervals double up to this.
+        """
+        interval = 0.5
+        while self.is_locked(path):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                # Removed, so released
+                return
+            released = threading.Event()
+
+            def block(fd=fd, released=released):
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+                except (IOError, OSError):
+                    pass
+                finally:
+                    # Let go right away, so as not to keep out the next
+                    # holder.
+                    os.close(fd)
+                    released.set()
+
+            thread = threading.Thread(target=block)
+            thread.daemon = True
+            thread.start()
+            while not released.wait(interval):
+                interval = min(2 * interval, max_interval)
+                if on_timeout is not None:
+                    on_timeout()
+
+
+
+LOCK_BACKENDS = {"excl": ExclusiveFileLocks, "flock": FlockLocks}
+
+
+
+def get_lock_backend(backend):
+    """
+    Provide the lock backend indicated.
+
+    :param str | object backend: Name of a lock backend ('excl' or 'flock'),
+        or a backend itself.
+    :return object: Lock backend, with acquire, release, is_locked, and
+        owner methods, and optionally a wait method
+    :raise ValueError: If the backend named is unknown.
+    """
+    if not isinstance(backend, str):
+        return backend
+    try:
+        return LOCK_BACKENDS[backend]()
+    except KeyError:
+        raise ValueError("Unknown lock backend: '{}'; choose from: {}".format(
+            backend, ", ".join(sorted(LOCK_BACKENDS))))
+
+
+
+def read_owner(path):
+    """
+    Read the record of the process that took a lock.
+
+    :param str path: Path to the lock file.
+    :return dict | NoneType: ID ('pid') and host ('host') of the process
+        that took the lock, if recorded
+    """
+    try:
+        with open(path) as f:
+            pid, host = f.read().split()
+        return {"pid": int(pid), "host": host}
+    except (IOError, OSError, ValueError):
+        return None
+
+
+
+def _owner_text():
+    """ Describe this process, to be recorded in a lock file it takes. """
+    return "{} {}\n".format(os.getpid(), socket.gethostname()).encode()
@@ -0,0 +1,380 @@
+""" Copying of pipeline and command output to the console and a log file """
+
+import errno
+import fcntl
+import gzip
+import os
+import shutil
+import sys
+import threading
+import traceback
+if sys.version_info < (3, 4):
+    import selectors34 as selectors
+else:
+    import selectors
+
+
+__all__ = ["LogMultiplexer"]
+
+
+
+class LogMultiplexer(object):
+    """
+    Fan-out of output from any number of pipes to the console and a log file.
+
+    One background thread waits on the read ends of all of the pipes at once
+    and copies whatever arrives, in chunks as large as are available, to the
+    console and to the log, so no separate process (e.g., tee) is needed to
+    duplicate the output. The pipeline's own standard output and error can be
+    redirected into a pipe (see redirect_std), and each command gets a pipe
+    of its own (see open_stream), from which the end of its output can be
+    kept. If the log has a size limit, it's rotated when it reaches it, and
+    the rotated logs are compressed in the background.
+
+    :param str log_file: Path to the file to which to append the output;
+        output goes only to the console if not provided.
+    :param int console_fd: File descriptor to which to copy the output; by
+        default, standard output as it is when output is redirected, or as
+        it is now if it never is.
+    :param int max_size: Size (bytes) at which to rotate the log file;
+        never rotated if not provided
+    :param int backups: Number of rotated (compressed) logs to keep.
+    :param int chunk_size: Maximum number of bytes to read from a pipe at once
+    """
+
+    def __init__(self, log_file=None, console_fd=None, max_size=None,
+                 backups=5, chunk_size=65536):
+        self.log_file = log_file
+        self.console_fd = console_fd
+        self.max_size = max_size
+        self.backups = backups
+        self.chunk_size = chunk_size
+        self._log = None if log_file is None else \
+            open(log_file, "ab", buffering=chunk_size)
+        self._lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._pending = []
+        self._streams = set()
+        self._std = None
+        self._saved_fds = {}
+        self._compressor = None
+        self._closing = False
+        self._wake_r, self._wake_w = os.pipe()
+        _set_nonblocking(self._wake_r)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self._thread = threading.Thread(target=self._run, name="log-mux")
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def open_stream(self, tail=0):
+        """
+        Create a pipe whose output is to be copied.
+
+        The caller passes the write end (the stream's fileno()) to whatever
+        writes to the pipe, e.g. as a subprocess's stdout and stderr, and then
+        closes its own copy of it with the stream's close_writer().
+
+        :param int tail: Number of bytes from the end of the output to keep
+        :return OutputStream: The new pipe
+        """
+        stream = OutputStream(tail)
+        with self._lock:
+            self._pending.append(stream)
+        self._wake()
+        return stream
+
+
+    def redirect_std(self):
+        """
+        Send this process's standard output and error through a new pipe.
+
+        The original standard output becomes the console to which output is
+        copied, unless another was specified, and is restored on close().
+        """
+        stream = OutputStream()
+        for fd in (1, 2):
+            self._saved_fds[fd] = os.dup(fd)
+        if self.console_fd is None:
+            self.console_fd = self._saved_fds[1]
+        for fd in (1, 2):
+            os.dup2(stream.fileno(), fd)
+        stream.close_writer()
+        self._std = stream
+        with self._lock:
+            self._pending.append(stream)
+        self._wake()
+
+
+    def drain(self):
+        """
+        Copy out everything written so far to standard output and error.
+
+        Output from this process and from commands goes through different
+        pipes, so this is needed to keep them in order, e.g. for text printed
+        just before a command is started. Python's own buffers should be
+        flushed first.
+        """
+        if self._std is not None:
+            with self._lock:
+                self._read(self._std, drain=True)
+
+
+    def finish(self, stream, timeout=2):
+        """
+        Wait for all of the output of a pipe to have been copied.
+
+        The output is done when every process with the pipe's write end has
+        closed it, usually by exiting. A command that leaves something running
+        in the background may keep it open; rather than wait for that, what's
+        been written so far is copied after the timeout, and the rest follows
+        whenever it's written.
+
+        :param OutputStream stream: The pipe, as from open_stream()
+        :param float timeout: Maximum number of seconds to wait.
+        :return str: End of the output, as much as was asked to be kept.
+        """
+        if not stream.done.wait(timeout):
+            with self._lock:
+                self._read(stream, drain=True)
+        return stream.tail.decode("utf-8", "replace")
+
+
+    def close(self):
+        """ Restore standard output and error, and finish writing the log. """
+        if self._closing:
+            return
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except (IOError, OSError, ValueError):
+                pass
+        for fd, saved in self._saved_fds.items():
+            os.dup2(saved, fd)
+        self._closing = True
+        self._wake()
+        self._thread.join()
+        # Anything still running may hold a pipe open; don't wait on it.
+        with self._lock:
+            for stream in list(self._streams) + self._pending:
+                self._read(stream, drain=True)
+            if self._log is not None:
+                self._log.close()
+            if self.console_fd in self._saved_fds.values():
+                self.console_fd = 1
+            for saved in self._saved_fds.values():
+                os.close(saved)
+            self._saved_fds = {}
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        if self._compressor is not None:
+            self._compressor.join()
+
+
+    def _run(self):
+        """
+        Copy output as it arrives, until closed.
+
+        If copying fails, the thread mustn't just die: the pipes would fill,
+        and whatever writes to them, including this process, would hang. The
+        error is reported, the log is given up, and copying to the console
+        goes on.
+        """
+        while True:
+            try:
+                self._copy()
+                return
+            except Exception:
+                with self._lock:
+                    self._drop_log(traceback.format_exc())
+
+
+    def _copy(self):
+        """ Wait on the pipes and copy their output, until closed. """
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    self._clear_wake()
+                    continue
+                with self._lock:
+                    self._read(key.data)
+                    if key.data.done.is_set():
+                        self._selector.unregister(key.fd)
+                        self._streams.discard(key.data)
+                        os.close(key.data.read_fd)
+            with self._lock:
+                self._flush()
+                for stream in self._pending:
+                    self._selector.register(
+                        stream.read_fd, selectors.EVENT_READ, stream)
+                    self._streams.add(stream)
+                self._pending = []
+                if self._closing:
+                    return
+
+
+    def _read(self, stream, drain=False):
+        """
+        Copy what's available from a pipe; call with the lock held.
+
+        :param OutputStream stream: Pipe from which to read
+        :param bool drain: Whether to read all that's available, rather than
+            at most one chunk
+        """
+        while not stream.done.is_set():
+            try:
+                data = os.read(stream.read_fd, self.chunk_size)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if not data:
+                stream.done.set()
+                return
+            self._emit(data)
+            if stream.tail_size:
+                stream.tail = (stream.tail + data)[-stream.tail_size:]
+            if not drain:
+                return
+
+
+    def _emit(self, data):
+        """ Write output to the console and log; call with the lock held. """
+        if self.console_fd is None:
+            self.console_fd = 1
+        view = memoryview(data)
+        try:
+            while view:
+                view = view[os.write(self.console_fd, view):]
+        except OSError as e:
+            # The console may go away (e.g., a closed terminal); keep logging.
+            if e.errno not in (errno.EPIPE, errno.EIO, errno.EBADF):
+                raise
+        if self._log is not None:
+            try:
+                self._log.write(data)
+                if self.max_size is not None and \
+                        self._log.tell() >= self.max_size:
+                    self._rotate()
+            except (IOError, OSError, ValueError):
+                self._drop_log(traceback.format_exc())
+
+
+    def _flush(self):
+        if self._log is not None and not self._log.closed:
+            try:
+                self._log.flush()
+            except (IOError, OSError, ValueError):
+                self._drop_log(traceback.format_exc())
+
+
+    def _drop_log(self, error):
+        """
+        Report a failure and copy output only to the console from now on.
+
+        Call with the lock held.
+
+        :param str error: Description of the failure, e.g. a traceback
+        """
+        if self._log is not None:
+            try:
+                self._log.close()
+            except (IOError, OSError, ValueError):
+                pass
+            self._log = None
+        message = "Failed to copy output to log file {}; copying it only to " \
+            "the console from now on.\n{}".format(self.log_file, error)
+        try:
+            os.write(self._saved_fds.get(2, 2), message.encode("utf-8"))
+        except OSError:
+            pass
+
+
+    def _rotate(self):
+        """ Move the log aside and start a new one; call with the lock held. """
+        self._log.close()
+        if self._compressor is not None:
+            self._compressor.join()
+        for i in range(self.backups, 0, -1):
+            older = "{}.{}.gz".format(self.log_file, i)
+            if not os.path.exists(older):
+                continue
+            if i == self.backups:
+                os.remove(older)
+            else:
+                os.rename(older, "{}.{}.gz".format(self.log_file, i + 1))
+        rotated = "{}.1".format(self.log_file)
+        os.rename(self.log_file, rotated)
+        self._log = open(self.log_file, "ab", buffering=self.chunk_size)
+        if self.backups > 0:
+            self._compressor = threading.Thread(target=_compress, args=(rotated,))
+            self._compressor.daemon = True
+            self._compressor.start()
+        else:
+            os.remove(rotated)
+
+
+    def _wake(self):
+        """ Have the thread take note of new pipes or of closing. """
+        try:
+            os.write(self._wake_w, b"\0")
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+
+    def _clear_wake(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+
+
+class OutputStream(object):
+    """
+    Pipe whose output is copied by a LogMultiplexer.
+
+    :param int tail: Number of bytes from the end of the output to keep
+    """
+
+    def __init__(self, tail=0):
+        self.read_fd, self.write_fd = os.pipe()
+        _set_nonblocking(self.read_fd)
+        self.tail_size = tail
+        self.tail = b""
+        self.done = threading.Event()
+
+
+    def fileno(self):
+        """
+        Provide the write end of the pipe.
+
+        :return int: File descriptor to which to write output
+        """
+        return self.write_fd
+
+
+    def close_writer(self):
+        """ Close this process's copy of the write end of the pipe. """
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+            self.write_fd = None
+
+
+
+def _compress(path):
+    """ Compress a rotated log, replacing it with the compressed file. """
+    with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+        shutil.copyfileobj(src, dst)
+    os.remove(path)
+
+
+
+def _set_nonblocking(fd):
+    """ Make reads from a file descriptor return rather than wait. """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
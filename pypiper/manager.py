@@ -8,6 +8,7 @@ The PipelineManager class can be used to create a procedural pipeline in python.
 """
 
 import atexit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 import datetime
 import errno
 import glob
@@ -18,11 +19,24 @@ import shlex  # for splitting commands like a shell does
 import signal
 import subprocess
 import sys
+import threading
 import time
 
 from .AttributeDict import AttributeDict
-from .exceptions import PipelineHalt
+from .exceptions import PipelineError, PipelineHalt
 from .flags import *
+from .cache import ResultCache
+from .filewatch import wait_for
+from .gitinfo import diff_stat, diff_stat_async, repo_info
+from .locks import get_lock_backend
+from .logmux import LogMultiplexer
+from .manifest import BuildManifest
+from .monitor import \
+    ExitWatcher, ResourceSampler, read_cpu_times, read_memory
+from .profiling import PROFILE_SUFFIX, ProfileWriter
+from .scheduler import ResourcePool, parse_mem
+from .stats import RecordWriter, StatsStore
+from .yamlconfig import load_yaml
 from .utils import \
     check_shell, checkpoint_filepath, clear_flags, flag_name, make_lock_name, \
     pipeline_filepath, CHECKPOINT_SPECIFICATIONS
@@ -49,8 +63,8 @@ class PipelineManager(object):
     :param argparse.Namespace args: Optional args object from ArgumentParser;
         Pypiper will simply record these arguments from your script
     :param bool multi: Enables running multiple pipelines in one script
-        or for interactive use. It simply disables the tee of the output,
-        so you won't get output logged to a file.
+        or for interactive use. It simply disables the copying of output
+        to the log, so you won't get output logged to a file.
     :param bool manual_clean: Overrides the pipeline's clean_add()
         manual parameters, to *never* clean up intermediate files automatically.
         Useful for debugging; all cleanup files are added to manual cleanup script.
@@ -62,9 +76,32 @@ class PipelineManager(object):
         even if  the preceding command is not run. By default,
         following functions  are only run if the preceding command is run.
     :param int cores: number of processors to use, default 1
-    :param str mem: amount of memory to use, in Mb
+    :param str mem: amount of memory to use, in Mb unless given with a unit
+        suffix (e.g., '8g')
     :param str config_file: path to pipeline configuration file, optional
     :param str output_parent: path to folder in which output folder will live
+    :param float sampling_interval: number of seconds between measurements
+        of memory and CPU use of running processes, default 1
+    :param str cache_folder: path to folder in which to cache the targets of
+        commands run with declared inputs, to be reused by any run of the
+        same command on the same inputs; no caching if not provided
+    :param str cache_size: maximum total size of the cache, in Mb or with a
+        unit suffix (e.g., '50g'); unlimited if not provided
+    :param str lock_backend: how target lock files are held: 'excl' (the
+        default) for lock files that are exclusively created, or 'flock' for
+        lock files that are locked with flock, which the system releases if
+        the holder dies, so that a lock left behind is recognized as stale
+    :param bool batch_results: whether to hold reported stats and figures
+        in memory, writing them out together at the next timestamp or when
+        the pipeline stops, rather than as each is reported
+    :param int output_tail: number of bytes from the end of each command's
+        output to keep in its record in the profile; none by default
+    :param str log_max_size: size of the log file at which to rotate it, in
+        Mb or with a unit suffix (e.g., '500m'), keeping the older logs
+        compressed; never rotated if not provided
+    :param bool lazy_git_diff: whether to summarize uncommitted changes to
+        the pipeline's and pypiper's code in the background, reporting them
+        when the pipeline completes, rather than before the pipeline starts
     :param bool overwrite_checkpoints: Whether to override the stage-skipping
         logic provided by the checkpointing system. This is useful if the
         calls to this manager's run() method will be coming from a class
@@ -81,7 +118,9 @@ class PipelineManager(object):
         self, name, outfolder, version=None, args=None, multi=False,
         manual_clean=False, recover=False, fresh=False, force_follow=False,
         cores=1, mem="1000", config_file=None, output_parent=None,
-        overwrite_checkpoints=False, **kwargs):
+        overwrite_checkpoints=False, sampling_interval=1, cache_folder=None,
+        cache_size=None, lock_backend="excl", batch_results=False,
+        output_tail=0, log_max_size=None, lazy_git_diff=False, **kwargs):
 
         # Params defines the set of options that could be updated via
         # command line args to a pipeline run, that can be forwarded
@@ -142,10 +181,12 @@ class PipelineManager(object):
         self.manual_clean = params['manual_clean']
         self.cores = params['cores']
         self.output_parent = params['output_parent']
-        # For now, we assume the memory is in megabytes.
-        # this could become customizable if necessary
-        self.mem = params['mem'] + "m"
+        # The memory is in megabytes, unless given with a unit suffix.
+        mem_mb = parse_mem(params['mem'])
+        self.mem = str(int(mem_mb)) + "m"
         self.container = None
+        # Commands run concurrently share the cores and memory budget.
+        self.resources = ResourcePool(int(self.cores), mem_mb)
 
         # Do some cores math for split processes
         # If a pipeline wants to run a process using half the cores, or 1/4 of the cores,
@@ -170,7 +211,7 @@ class PipelineManager(object):
         # As a kind of hack, we'll set the java processes heap limit to 95% of the
         # total memory limit provided.
         # This will give a little breathing room for non-heap java memory use.
-        self.javamem = str(int(int(params['mem']) * 0.95)) + "m"
+        self.javamem = str(int(mem_mb * 0.95)) + "m"
 
         self.pl_version = version
         # Set relative output_parent directory to absolute
@@ -181,6 +222,15 @@ class PipelineManager(object):
         # File paths:
         self.outfolder = os.path.join(outfolder, '')  # trailing slash
         self.pipeline_log_file = pipeline_filepath(self, suffix="_log.md")
+        self.log_max_size = None if log_max_size is None \
+                else int(parse_mem(log_max_size) * 1024 ** 2)
+        self.output_tail = output_tail
+        # Copier of output to the console and log, set up on start.
+        self._log_mux = None
+        self.lazy_git_diff = lazy_git_diff
+        # Uncommitted changes to code, by name, if they're being summarized
+        # in the background.
+        self._git_diffs = {}
 
         self.pipeline_profile_file = \
                 pipeline_filepath(self, suffix="_profile.tsv")
@@ -190,20 +240,52 @@ class PipelineManager(object):
                 pipeline_filepath(self, filename="stats.tsv")
         self.pipeline_figures_file = \
                 pipeline_filepath(self, filename="figures.tsv")
+        self._stats_writer = RecordWriter(
+                self.pipeline_stats_file, buffered=batch_results)
+        self._figures_writer = RecordWriter(
+                self.pipeline_figures_file, buffered=batch_results)
 
         # Record commands used and provide manual cleanup script.
         self.pipeline_commands_file = \
                 pipeline_filepath(self, suffix="_commands.sh")
         self.cleanup_file = pipeline_filepath(self, suffix="_cleanup.sh")
 
+        self.lock_backend = get_lock_backend(lock_backend)
+
+        # Record of how targets were made, to tell when they're out of date.
+        self.manifest = BuildManifest(
+                pipeline_filepath(self, suffix="_manifest.json"))
+        self.cache = None if cache_folder is None else ResultCache(
+                cache_folder, max_size=None if cache_size is None
+                else int(parse_mem(cache_size) * 1024 ** 2))
+
         # Pipeline status variables
         self.peak_memory = 0  # memory high water mark
         self.starttime = time.time()
+
+        # Machine-readable profile, one JSON record per command.
+        self.pipeline_profile_records_file = \
+                pipeline_filepath(self, suffix=PROFILE_SUFFIX)
+        self._profile_writer = ProfileWriter(
+                self.pipeline_profile_records_file, self.name, self.starttime)
+        # Stage in progress in each thread, for the profile.
+        self._thread_state = threading.local()
         self.last_timestamp = self.starttime  # time of the last call to timestamp()
 
         self.locks = []
         self.procs = {}
-        
+        # Resource use of running processes is measured in the background.
+        self.sampling_interval = sampling_interval
+        self._sampler = None
+        # Worker threads and pending results for commands run in parallel.
+        self._executor = None
+        self._futures = set()
+        # Set once the pipeline's failing, so no more commands are started in
+        # parallel, and the error with which a command run in parallel failed
+        # it, if it was one.
+        self._stopping = False
+        self._parallel_failure = None
+
         self.wait = True  # turn off for debugging
 
         # Initialize status and flags
@@ -212,8 +294,9 @@ class PipelineManager(object):
         # previous runs of this pipeline
         clear_flags(self)
 
-        # In-memory holder for report_result
-        self.stats_dict = {}
+        # In-memory index of reported stats, kept current with the stats file
+        self._stats = StatsStore(self.pipeline_stats_file, [self.name, "shared"])
+        self.stats_dict = self._stats.values
 
         # Register handler functions to deal with interrupt and termination signals;
         # If received, we would then clean up properly (set pipeline status to FAIL, etc).
@@ -224,8 +307,12 @@ class PipelineManager(object):
         # Checkpoint-related parameters
         self.overwrite_checkpoints = overwrite_checkpoints
         self.halt_on_next = False
-        self.prev_checkpoint = None
-        self.curr_checkpoint = None
+        # Previous and current checkpoints, kept apart for each stage that's
+        # run in a thread of its own (see current_stage), and guarded so that
+        # stages run at the same time don't interleave their bookkeeping.
+        self._main_checkpoints = [None, None]
+        self._checkpoint_lock = threading.RLock()
+        self._main_thread = threading.current_thread()
 
         # Pypiper can keep track of intermediate files to clean up at the end
         self.cleanup_list = []
@@ -272,15 +359,13 @@ class PipelineManager(object):
                     print("Using default pipeline config file: {}".
                           format(config_to_load))
 
-        # Finally load the config we found.
+        # Finally load the config we found. Keep its path, so it can be used
+        # later to pass to, for example, toolkits; they'll share the parse.
+        self.config_file = config_to_load
         if config_to_load is not None:
             print("Loading config file: {}".format(config_to_load))
-            with open(config_to_load, 'r') as conf:
-                # Set the args to the new config file, so it can be used
-                # later to pass to, for example, toolkits
-                import yaml
-                config = yaml.load(conf)
-                self.config = AttributeDict(config, default=True)
+            config = load_yaml(config_to_load)
+            self.config = AttributeDict(config or {}, default=True)
         else:
             print("No config file")
             self.config = None
@@ -358,7 +443,7 @@ class PipelineManager(object):
         # By default, Pypiper will mirror every operation so it is displayed both
         # on sys.stdout **and** to a log file. Unfortunately, interactive python sessions
         # ruin this by interfering with stdout. So, for interactive mode, we do not enable 
-        # the tee subprocess, sending all output to screen only.
+        # the copying of output to the log, sending all output to screen only.
         # Starting multiple PipelineManagers in the same script has the same problem, and
         # must therefore be run in interactive_mode.
 
@@ -367,34 +452,25 @@ class PipelineManager(object):
             print("Warning: You're running an interactive python session. "
                   "This works, but pypiper cannot tee the output, so results "
                   "are only logged to screen.")
+            if self.output_tail:
+                # Commands' output is still needed for the profile.
+                self._log_mux = LogMultiplexer(console_fd=sys.stdout.fileno())
         else:
-            sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)  # Unbuffer output
-
-            # The tee subprocess must be instructed to ignore TERM and INT signals;
-            # Instead, I will clean up this process in the signal handler functions.
-            # This is required because otherwise, if pypiper receives a TERM or INT,
-            # the tee will be automatically terminated by python before I have a chance to
-            # print some final output (for example, about when the process stopped),
-            # and so those things don't end up in the log files because the tee
-            # subprocess is dead. Instead, I will handle the killing of the tee process
-            # manually (in the exit handler).
-
-            # a for append to file
-            
-            tee = subprocess.Popen(
-                ["tee", "-a", self.pipeline_log_file], stdin=subprocess.PIPE,
-                preexec_fn=self._ignore_interrupts)
-
-            # If the pipeline is terminated with SIGTERM/SIGINT,
-            # make sure we kill this spawned tee subprocess as well.
-            atexit.register(self._kill_child_process, tee.pid, proc_name="tee")
-            os.dup2(tee.stdin.fileno(), sys.stdout.fileno())
-            os.dup2(tee.stdin.fileno(), sys.stderr.fileno())
-
-        # A future possibility to avoid this tee, is to use a Tee class; this works for anything printed here
-        # by pypiper, but can't tee the subprocess output. For this, it would require using threading to
-        # simultaneously capture and display subprocess output. I shelve this for now and stick with the tee option.
-        # sys.stdout = Tee(self.pipeline_log_file)
+            try:
+                sys.stdout.reconfigure(line_buffering=True)
+            except AttributeError:
+                sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 1)  # Line-buffer output
+
+            # Everything written to stdout and stderr, by pypiper or by the
+            # commands it runs, is copied to the screen and the log file by a
+            # thread of this process. Since no separate process (formerly tee)
+            # does the logging, there's nothing for a TERM or INT signal to
+            # kill before the final output (for example, about when the
+            # process stopped) has made it into the log; the log is finished
+            # in the exit handler.
+            self._log_mux = LogMultiplexer(
+                self.pipeline_log_file, max_size=self.log_max_size)
+            self._log_mux.redirect_std()
 
         # Record the git version of the pipeline and pypiper used. This gets (if it is in a git repo):
         # dir: the directory where the code is stored
@@ -402,29 +478,26 @@ class PipelineManager(object):
         # date: the date of the last commit in this repo
         # diff: a summary of any differences in the current (run) version vs. the committed version
 
-        # Wrapped in try blocks so that the code will not fail if the pipeline or pypiper are not git repositories
+        # These are read from the repositories' files rather than from git
+        # itself, except for the diff, which may be left to a background
+        # thread. Either may not be in a git repository.
         gitvars = {}
-        try:
-            # pypiper dir
-            ppd = os.path.dirname(os.path.realpath(__file__))
-            gitvars['pypiper_dir'] = ppd
-            gitvars['pypiper_hash'] = subprocess.check_output("cd " + ppd + "; git rev-parse --verify HEAD 2>/dev/null", shell=True)
-            gitvars['pypiper_date'] = subprocess.check_output("cd " + ppd + "; git show -s --format=%ai HEAD 2>/dev/null", shell=True)
-            gitvars['pypiper_diff'] = subprocess.check_output("cd " + ppd + "; git diff --shortstat HEAD 2>/dev/null", shell=True)
-            gitvars['pypiper_branch'] = subprocess.check_output("cd " + ppd + "; git branch | grep '*' 2>/dev/null", shell=True)
-        except Exception:
-            pass
-        try:
-            # pipeline dir
-            pld = os.path.dirname(os.path.realpath(sys.argv[0]))
-            gitvars['pipe_dir'] = pld
-            gitvars['pipe_hash'] = subprocess.check_output("cd " + pld + "; git rev-parse --verify HEAD 2>/dev/null", shell=True)
-            gitvars['pipe_date'] = subprocess.check_output("cd " + pld + "; git show -s --format=%ai HEAD 2>/dev/null", shell=True)
-            gitvars['pipe_diff'] = subprocess.check_output("cd " + pld + "; git diff --shortstat HEAD 2>/dev/null", shell=True)
-            gitvars['pipe_branch'] = subprocess.check_output("cd " + pld + "; git branch | grep '*' 2>/dev/null", shell=True)
-        except Exception:
-            pass
-        
+        code_dirs = [
+            ("pypiper", os.path.dirname(os.path.realpath(__file__))),
+            ("pipe", os.path.dirname(os.path.realpath(sys.argv[0])))]
+        for prefix, folder in code_dirs:
+            info = repo_info(folder)
+            if info is None:
+                continue
+            gitvars[prefix + '_dir'] = folder
+            for key in ["hash", "date", "branch"]:
+                gitvars[prefix + '_' + key] = info[key]
+            if self.lazy_git_diff:
+                self._git_diffs[prefix] = diff_stat_async(folder)
+                gitvars[prefix + '_diff'] = ""
+            else:
+                gitvars[prefix + '_diff'] = diff_stat(folder)
+
         # Print out a header section in the pipeline log:
         # Wrap things in backticks to prevent markdown from interpreting underscores as emphasis.
         print("----------------------------------------")
@@ -528,7 +601,7 @@ class PipelineManager(object):
     ###################################
     def run(self, cmd, target=None, lock_name=None, shell="guess",
             nofail=False, errmsg=None, clean=False, follow=None,
-            container=None):
+            container=None, cores=1, mem=0, inputs=None):
         """
         The primary workhorse function of PipelineManager, this runs a command.
 
@@ -566,6 +639,19 @@ class PipelineManager(object):
         :type follow: callable
         :param container: Name for Docker container in which to run commands.
         :type container: str
+        :param cores: Number of cores the command uses; the command waits to
+            start until this many of the pipeline's cores are free.
+        :type cores: int
+        :param mem: Memory the command uses, in megabytes or with a unit
+            suffix (e.g., '8g'); the command waits to start until this much of
+            the pipeline's memory is free. Only commands that declare their
+            memory are held to the budget; by default (0), a command starts
+            as soon as its cores are free.
+        :type mem: int or str
+        :param inputs: Files from which the target is made. If given, an
+            existing target is remade if it's out of date, i.e. if the command
+            or any of these inputs has changed since the target was made.
+        :type inputs: list[str]
         :return: Return code of process. If a list of commands is passed,
             this is the maximum of all return codes for all commands.
         :rtype: int
@@ -610,6 +696,8 @@ class PipelineManager(object):
         # Default lock_name (if not provided) is based on the target file name,
         # but placed in the parent pipeline outfolder, and not in a subfolder, if any.
         lock_name = lock_name or make_lock_name(target, self.outfolder)
+        cmd_text = cmd if isinstance(cmd, str) else "\n".join(
+            c if isinstance(c, str) else " ".join(c) for c in cmd)
         lock_file = self._make_lock_path(lock_name)
         recover_file = self._recoverfile_from_lockfile(lock_file)
         recover_mode = False
@@ -641,7 +729,8 @@ class PipelineManager(object):
             # Base case: Target exists (and we don't overwrite); break loop, don't run process.
             # os.path.exists allows the target to be either a file or directory; .isfile is file-only
             if target is not None and os.path.exists(target) \
-                    and not os.path.isfile(lock_file):
+                    and not os.path.isfile(lock_file) \
+                    and not self._target_stale(target, cmd_text, inputs):
                 print("\nTarget exists: `" + target + "`")
                 # Normally we don't run the follow, but if you want to force...
                 if self.force_follow:
@@ -658,6 +747,9 @@ class PipelineManager(object):
                     recover_mode = True
                     # the recovery flag is now spent, so remove so we don't accidentally re-recover a failed job
                     os.remove(recover_file)
+                elif not self.lock_backend.is_locked(lock_file):
+                    # The lock's owner is gone, and the target may be partial.
+                    print("Found stale lock file; overwriting this target...")
                 else:  # don't overwrite locks
                     self._wait_for_lock(lock_file)
                     # when it's done loop through again to try one more time (to see if the target exists now)
@@ -665,44 +757,78 @@ class PipelineManager(object):
 
             # If you get to this point, the target doesn't exist, and the lock_file doesn't exist 
             # (or we should overwrite). create the lock (if you can)
+            try:
+                self.lock_backend.acquire(lock_file,
+                    force=self.overwrite_locks or recover_mode)  # Create lock
+            except OSError as e:
+                if e.errno == errno.EEXIST:  # File already exists
+                    print ("Lock file created after test! Looping again.")
+                    continue  # Go back to start
+                raise
             # Initialize lock in master lock list
             self.locks.append(lock_file)
-            if self.overwrite_locks or recover_mode:
-                self._create_file(lock_file)
-            else:
-                try:
-                    self._create_file_racefree(lock_file)  # Create lock
-                except OSError as e:
-                    if e.errno == errno.EEXIST:  # File already exists
-                        print ("Lock file created after test! Looping again.")
-                        continue  # Go back to start
 
             ##### End tests block
             # If you make it past these tests, we should proceed to run the process.
 
-            if target is not None:
-                print("\nTarget to produce: `" + target + "`")
+            # The same command on the same inputs may have been run before.
+            cache_key = self._cache_key(target, cmd_text, inputs)
+            if cache_key is not None and self.cache.fetch(cache_key, target):
+                print("\nTarget restored from cache: `" + target + "`")
+                self._report_cache("hit", target, cache_key)
             else:
-                print("\nTargetless command, running...")
-
-            if isinstance(cmd, list):  # Handle command lists
-                for cmd_i in cmd:
-                    list_ret, list_maxmem = \
-                        self.callprint(cmd_i, shell, nofail, container)
-                    local_maxmem = max(local_maxmem, list_maxmem)
-                    process_return_code = max(process_return_code, list_ret)
+                if cache_key is not None:
+                    self._report_cache("miss", target, cache_key)
+                    # Don't overwrite a result that's shared with the cache.
+                    if os.path.isfile(target) and os.stat(target).st_nlink > 1:
+                        os.remove(target)
+
+                if target is not None:
+                    print("\nTarget to produce: `" + target + "`")
+                else:
+                    print("\nTargetless command, running...")
 
-            else:  # Single command (most common)
-                process_return_code, local_maxmem = \
-                    self.callprint(cmd, shell, nofail, container)  # Run command
+                reserved = self.resources.acquire(cores, parse_mem(mem), blocking=False)
+                if reserved is None:
+                    print("Waiting for {} core(s) and {} MB of memory; {}".format(
+                        cores, parse_mem(mem), self.resources))
+                    reserved = self.resources.acquire(cores, parse_mem(mem))
+                try:
+                    # A submitted command isn't started if the pipeline's
+                    # stopped while it waited (e.g., for resources or a lock).
+                    if getattr(self._thread_state, "submitted", False) and \
+                            (self._stopping or self.failed or self.halted):
+                        self.lock_backend.release(lock_file)
+                        self.locks.remove(lock_file)
+                        raise PipelineError(
+                            "Pipeline stopped; not running: {}".format(cmd_text))
+                    if isinstance(cmd, list):  # Handle command lists
+                        for cmd_i in cmd:
+                            list_ret, list_maxmem = \
+                                self.callprint(cmd_i, shell, nofail, container, lock_name)
+                            local_maxmem = max(local_maxmem, list_maxmem)
+                            process_return_code = max(process_return_code, list_ret)
+
+                    else:  # Single command (most common)
+                        process_return_code, local_maxmem = \
+                            self.callprint(cmd, shell, nofail, container, lock_name)  # Run command
+                finally:
+                    self.resources.release(reserved)
+
+                if cache_key is not None and process_return_code == 0:
+                    self.cache.store(cache_key, target)
 
             # For temporary files, you can specify a clean option to automatically
             # add them to the clean list, saving you a manual call to clean_add
             if target is not None and clean:
                 self.clean_add(target)
 
+            if target is not None and inputs is not None \
+                    and process_return_code == 0:
+                self.manifest.record(target, cmd_text, inputs)
+
             call_follow()
-            os.remove(lock_file)  # Remove lock file
+            self.lock_backend.release(lock_file)  # Remove lock file
             self.locks.remove(lock_file)
 
             # If you make it to the end of the while loop, you're done
@@ -711,6 +837,198 @@ class PipelineManager(object):
         return process_return_code
 
 
+    def _cache_key(self, target, cmd, inputs):
+        """
+        Determine the key under which a command's result is cached.
+
+        :param str target: Path to the target.
+        :param str cmd: Command that makes the target.
+        :param Iterable[str] inputs: Files from which the target is made.
+        :return str | NoneType: Key for the command's result, or null if
+            there's no cache, or the target or its inputs aren't known.
+        """
+        if self.cache is None or target is None or inputs is None \
+                or not all(os.path.isfile(i) for i in inputs):
+            return None
+        return self.cache.key(cmd, inputs)
+
+
+    def _target_stale(self, target, cmd, inputs):
+        """
+        Determine whether an existing target needs to be remade.
+
+        :param str target: Path to the target.
+        :param str cmd: Command that makes the target.
+        :param Iterable[str] inputs: Files from which the target is made;
+            null if they're not declared, in which case the target is taken
+            to be current.
+        :return bool: Whether the target is out of date.
+        """
+        if inputs is None:
+            return False
+        if self.manifest.is_stale(target, cmd, inputs):
+            print("\nTarget is out of date: `" + target + "`")
+            return True
+        return False
+
+
+    @property
+    def current_stage(self):
+        """
+        Determine the pipeline stage in progress, in the calling thread.
+
+        :return str | NoneType: Name of the stage in progress, as set by the
+            Pipeline running it or by the most recent checkpoint, if any
+        """
+        return getattr(self._thread_state, "stage", None) or self.curr_checkpoint
+
+
+    @current_stage.setter
+    def current_stage(self, stage):
+        self._thread_state.stage = stage
+        if threading.current_thread() is self._main_thread:
+            return
+        # A stage run in another thread may overlap others, so it keeps
+        # track of its own checkpoints.
+        if stage is None:
+            self._thread_state.__dict__.pop("checkpoints", None)
+        else:
+            self._thread_state.checkpoints = [None, None]
+
+
+    @property
+    def prev_checkpoint(self):
+        """
+        Determine the checkpoint most recently passed, in the calling thread.
+
+        :return str | NoneType: Name of the previous checkpoint, if any
+        """
+        return self._checkpoint_state()[0]
+
+
+    @prev_checkpoint.setter
+    def prev_checkpoint(self, checkpoint):
+        self._checkpoint_state()[0] = checkpoint
+
+
+    @property
+    def curr_checkpoint(self):
+        """
+        Determine the checkpoint in progress, in the calling thread.
+
+        :return str | NoneType: Name of the current checkpoint, if any
+        """
+        return self._checkpoint_state()[1]
+
+
+    @curr_checkpoint.setter
+    def curr_checkpoint(self, checkpoint):
+        self._checkpoint_state()[1] = checkpoint
+
+
+    def _checkpoint_state(self):
+        """ Previous and current checkpoints of the calling thread. """
+        return getattr(
+            self._thread_state, "checkpoints", self._main_checkpoints)
+
+
+    @property
+    def proc_name(self):
+        """
+        Name of the program most recently run, in the calling thread.
+
+        :return str | NoneType: First word of the last command run by this
+            thread, if any
+        """
+        return getattr(self._thread_state, "proc_name", None)
+
+
+    @proc_name.setter
+    def proc_name(self, name):
+        self._thread_state.proc_name = name
+
+
+    def submit(self, cmd, target=None, lock_name=None, **kwargs):
+        """
+        Start running a command in the background, returning right away.
+
+        This is the asynchronous counterpart of run(): the command is run
+        by a worker thread, with all of run()'s target, lock, and recovery
+        semantics and process profiling. Commands start as the cores and
+        memory declared for each of them (run()'s cores and mem) become
+        free; commands submitted together may be admitted in any order. If
+        a command fails (and isn't nofail), the pipeline fails, terminating
+        any other running commands and cancelling those that are queued.
+
+        :param str | list[str] cmd: Shell command(s) to be run.
+        :param str target: Output file to be produced. Optional.
+        :param str lock_name: Name of lock file. Optional.
+        :param kwargs: Additional keyword arguments for run()
+        :return concurrent.futures.Future: Eventual result of the run() call,
+            i.e. the command's return code
+        :raise PipelineError: If the pipeline's already failing.
+        """
+        if self._stopping or self.failed:
+            raise PipelineError("Pipeline stopped; not running: {}".format(cmd))
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=max(1, int(self.cores)))
+        future = self._executor.submit(self._run_in_stage, self.current_stage,
+            list(self._checkpoint_state()), cmd, target=target,
+            lock_name=lock_name, **kwargs)
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+        return future
+
+
+    def _run_in_stage(self, stage, checkpoints, *args, **kwargs):
+        """ Call run() in a worker thread on behalf of a stage. """
+        self.current_stage = stage
+        self._thread_state.checkpoints = checkpoints
+        self._thread_state.submitted = True
+        try:
+            return self.run(*args, **kwargs)
+        finally:
+            self.current_stage = None
+
+
+    def run_parallel(self, jobs, **kwargs):
+        """
+        Run several independent commands at once, and wait for them all.
+
+        This is a convenience for submitting a batch of commands, e.g.
+        fastqc for each read file, or indexing several BAM files, and
+        waiting for their completion.
+
+        :param Iterable[(str, str) | Mapping] jobs: Commands to run; each
+            is either a pair of command and target, or a mapping of keyword
+            arguments for run(). As for run(), each job needs its own target
+            or lock_name.
+        :param kwargs: Keyword arguments for run() shared by all of the jobs
+        :return list[int]: Return code for each job, in the order given.
+        :raise Exception: If a job fails, the first error is raised once
+            the pipeline's been failed.
+        """
+        futures = []
+        for job in jobs:
+            job_kwargs = dict(kwargs)
+            if isinstance(job, dict):
+                job_kwargs.update(job)
+            else:
+                job_kwargs["cmd"], job_kwargs["target"] = job
+            futures.append(self.submit(**job_kwargs))
+
+        done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        for future in futures:
+            if future.done() and future.exception() is not None:
+                for pending in not_done:
+                    pending.cancel()
+                if self._parallel_failure is None:
+                    self._parallel_failure = future.exception()
+                self.fail_pipeline(future.exception())
+                break
+        return [f.result() for f in futures]
+
+
     def checkprint(self, cmd, shell="guess", nofail=False, errmsg=None):
         """
         Just like callprint, but checks output -- so you can get a variable
@@ -759,9 +1077,9 @@ class PipelineManager(object):
         return code of the command.
 
         Uses python's subprocess.Popen() to execute the given command. The shell argument is simply
-        passed along to Popen(). You should use shell=False (default) where possible, because this enables memory
-        profiling. You should use shell=True if you require shell functions like redirects (>) or pipes (|), but this
-        will prevent the script from monitoring memory use.
+        passed along to Popen(). You should use shell=False (default) where possible, as this avoids an
+        extra shell process. You should use shell=True if you require shell functions like redirects (>) or
+        pipes (|); memory and CPU use are then profiled for the whole tree of processes that the shell spawns.
 
         cmd can also be a series (a dict object) of multiple commands, which will be run in succession.
 
@@ -790,9 +1108,10 @@ class PipelineManager(object):
         if container:
             cmd = "docker exec " + container + " " + cmd
         self._report_command(cmd)
+        cmd_text = cmd
         # self.proc_name = cmd[0] + " " + cmd[1]
-        self.proc_name = "".join(cmd).split()[0]
         proc_name = "".join(cmd).split()[0]
+        self.proc_name = proc_name
 
 
         likely_shell = check_shell(cmd)
@@ -818,47 +1137,74 @@ class PipelineManager(object):
             # Capture the subprocess output in <pre> tags to make it format nicely
             # if the markdown log file is displayed as HTML.
             print("<pre>")
-            p = subprocess.Popen(cmd, shell=shell)
+            if self._log_mux is None:
+                stream = None
+                p = subprocess.Popen(cmd, shell=shell)
+            else:
+                # The command gets a pipe of its own, so that its output can be
+                # kept for the profile; what's printed here must come first.
+                sys.stdout.flush()
+                sys.stderr.flush()
+                self._log_mux.drain()
+                stream = self._log_mux.open_stream(tail=self.output_tail)
+                try:
+                    p = subprocess.Popen(cmd, shell=shell,
+                                         stdout=stream.fileno(),
+                                         stderr=stream.fileno())
+                finally:
+                    stream.close_writer()
 
             # Keep track of the running process ID in case we need to kill it when the pipeline is interrupted.
-            self.procs[p.pid] = {
+            proc = {
                 "proc_name":proc_name,
                 "start_time":time.time(),
                 "pre_block":True,
                 "container":container,
+                "tree":bool(shell),
+                "stage":self.current_stage,
+                "command":cmd_text,
                 "p": p}
-
-            sleeptime = .25
+            self.procs[p.pid] = proc
 
             if not self.wait:
                 print("</pre>")
                 print ("Not waiting for subprocess: " + str(p.pid))
                 return [0, -1]
 
-            while p.poll() is None:
-                if not shell:
-                    local_maxmem = max(local_maxmem, self._memory_usage(p.pid, container=container)/1e6)
-                    # print("int.maxmem (pid:" + str(p.pid) + ") " + str(local_maxmem))
-                time.sleep(sleeptime)
-                sleeptime = min(sleeptime + 5, 60)
+            # The watcher reaps the process as soon as it exits, while the
+            # sampler measures its resource use on a fixed schedule.
+            self._ensure_sampler()
+            watcher = ExitWatcher(p, before_reap=self._final_sample)
+            watcher.start()
+            watcher.wait()
+            output = None if stream is None else self._log_mux.finish(stream)
+            peak_mem, cpu_user, cpu_sys = self._final_usage(proc, watcher.rusage)
+            cpu_time = cpu_user + cpu_sys
+            local_maxmem = peak_mem / 1e6
 
             returncode = p.returncode
             info = "Process " + str(p.pid) + " returned: (" + str(p.returncode) + ")."
-            info += " Elapsed: " + str(datetime.timedelta(seconds=self.time_elapsed(self.procs[p.pid]["start_time"]))) + "."
-            if not shell:
-                info += " Peak memory: (Process: " + str(round(local_maxmem, 3)) + "GB;"
-                info += " Pipeline: " + str(round(self.peak_memory, 3)) + "GB)"
+            info += " Elapsed: " + str(datetime.timedelta(seconds=self.time_elapsed(proc["start_time"]))) + "."
+            info += " CPU time: " + str(round(cpu_time, 2)) + "s."
+            info += " Peak memory: (Process: " + str(round(local_maxmem, 3)) + "GB;"
+            info += " Pipeline: " + str(round(self.peak_memory, 3)) + "GB)"
             # Close the preformat tag for markdown output
             print("</pre>")
             print(info)
             # set self.maxmem
             self.peak_memory = max(self.peak_memory, local_maxmem)
 
-            # report process profile
-            self._report_profile(self.procs[p.pid]["proc_name"], lock_name, time.time() - self.procs[p.pid]["start_time"], local_maxmem)
-            
-            # Remove this as a running subprocess
-            del self.procs[p.pid]
+            # Remove this as a running subprocess and report its profile; if
+            # the pipeline is failing, another thread may already have
+            # removed (and killed) it, and recorded its profile then.
+            if self.procs.pop(p.pid, None) is not None:
+                self._report_profile(proc["proc_name"], lock_name, time.time() - proc["start_time"], local_maxmem, cpu_time)
+                self._profile_writer.write(
+                    command=cmd_text, lock_name=lock_name, stage=proc["stage"],
+                    pid=p.pid, start=proc["start_time"], end=time.time(),
+                    wall=time.time() - proc["start_time"], cpu_user=cpu_user,
+                    cpu_sys=cpu_sys, peak_mem=local_maxmem, exit_code=returncode,
+                    output=output if self.output_tail else None)
 
             if p.returncode != 0:
                 raise OSError("Subprocess returned nonzero result.")
@@ -879,25 +1225,24 @@ class PipelineManager(object):
 
         :param p: A subprocess.Popen process.
         :param shell: If command requires should be run in its own shell. Optional. Default: False.
+            Memory of a shell is profiled for its whole process tree.
         :type shell: bool
         """
-        local_maxmem = -1
-        sleeptime = .5
-        while p.poll() is None:
-            if not shell:
-                local_maxmem = max(local_maxmem, self._memory_usage(p.pid) / 1e6)
-                # print("int.maxmem (pid:" + str(p.pid) + ") " + str(local_maxmem))
-            time.sleep(sleeptime)
-            sleeptime = min(sleeptime + 5, 60)
+        self._ensure_sampler()
+        self.procs[p.pid]["tree"] = self.procs[p.pid].get("tree") or shell
+        watcher = ExitWatcher(p, before_reap=self._final_sample)
+        watcher.start()
+        watcher.wait()
+        peak_mem, _, _ = self._final_usage(self.procs[p.pid], watcher.rusage)
+        local_maxmem = peak_mem / 1e6
 
         self.peak_memory = max(self.peak_memory, local_maxmem)
         
         del self.procs[p.pid]
 
         info = "Process " + str(p.pid) + " returned: (" + str(p.returncode) + ")."
-        if not shell:
-            info += " Peak memory: (Process: " + str(round(local_maxmem,3)) + "GB;"
-            info += " Pipeline: " + str(round(self.peak_memory,3)) + "GB)"
+        info += " Peak memory: (Process: " + str(round(local_maxmem,3)) + "GB;"
+        info += " Pipeline: " + str(round(self.peak_memory,3)) + "GB)"
 
         print(info + "\n")
         if p.returncode != 0:
@@ -905,6 +1250,60 @@ class PipelineManager(object):
         return [p.returncode, local_maxmem]
 
 
+    def _ensure_sampler(self):
+        """ Start the background resource sampler if it's not running. """
+        if self._sampler is None or not self._sampler.is_alive():
+            self._sampler = ResourceSampler(
+                self.procs, self.sampling_interval,
+                memory_usage=self._memory_usage)
+            self._sampler.start()
+
+
+    def _stop_sampler(self):
+        """ Stop the background resource sampler, if one is running. """
+        if self._sampler is not None:
+            self._sampler.stop()
+            self._sampler = None
+
+
+    def _final_sample(self, pid):
+        """
+        Measure a process once more, after it's exited but before it's reaped.
+
+        :param int pid: ID of the process that's exited
+        """
+        sampler = self._sampler
+        if sampler is not None:
+            sampler.sample(pids=[pid])
+
+
+    def _final_usage(self, proc, rusage=None):
+        """
+        Settle on peak memory and CPU time for a process that's done.
+
+        :param dict proc: the process's entry in self.procs, with whatever
+            the sampler has recorded for it
+        :param resource.struct_rusage rusage: resource use reported by the
+            kernel when the process was reaped, if any
+        :return (float, float, float): peak memory in kilobytes, and user
+            and system CPU seconds
+        """
+        peak_mem = proc.get("peak_mem", 0)
+        cpu_user, cpu_sys = proc.get("cpu_user", 0), proc.get("cpu_sys", 0)
+        if rusage is not None:
+            # The kernel's CPU accounting is exact, so trust it over the
+            # samples; it covers the process and all of the descendants that
+            # it waited for. Its ru_maxrss (kilobytes, on Linux) carries over
+            # the memory that the forked child shared with this process
+            # before exec, so it's only the command's own peak if it's above
+            # what this process has ever used; otherwise the samples stand.
+            if not proc["container"] and \
+                    rusage.ru_maxrss > read_memory("self")["hwm"]:
+                peak_mem = max(peak_mem, rusage.ru_maxrss)
+            cpu_user, cpu_sys = rusage.ru_utime, rusage.ru_stime
+        return peak_mem, cpu_user, cpu_sys
+
+
     def _wait_for_lock(self, lock_file):
         """
         Just sleep until the lock_file does not exist.
@@ -912,25 +1311,38 @@ class PipelineManager(object):
         :param lock_file: Lock file to wait upon.
         :type lock_file: str
         """
-        sleeptime = .5
-        first_message_flag = False
-        dot_count = 0
-        while os.path.isfile(lock_file):
-            if first_message_flag is False:
-                self.timestamp("Waiting for file lock: " + lock_file)
-                self.set_status_flag(WAIT_FLAG)
-                first_message_flag = True
-            else:
-                sys.stdout.write(".")
-                dot_count = dot_count + 1
-                if dot_count % 60 == 0:
-                    print("")  # linefeed
-            time.sleep(sleeptime)
-            sleeptime = min(sleeptime + 2.5, 60)
+        if not self.lock_backend.is_locked(lock_file):
+            return
+        owner = self.lock_backend.owner(lock_file)
+        self.timestamp("Waiting for file lock: " + lock_file + (
+            "" if owner is None else
+            " (held by process {pid} on {host})".format(**owner)))
+        self.set_status_flag(WAIT_FLAG)
+        wait = getattr(self.lock_backend, "wait", None)
+        if wait is not None:
+            wait(lock_file, on_timeout=self._waiting_dots())
+        else:
+            wait_for(lambda: not self.lock_backend.is_locked(lock_file),
+                     lock_file, on_timeout=self._waiting_dots())
+        self.timestamp("File unlocked.")
+        self.set_status_flag(RUN_FLAG)
 
-        if first_message_flag:
-            self.timestamp("File unlocked.")
-            self.set_status_flag(RUN_FLAG)
+
+    @staticmethod
+    def _waiting_dots():
+        """
+        Create a function to mark the passage of time while waiting.
+
+        :return callable: Function that writes a dot each time it's called,
+            with a line break after every 60.
+        """
+        dot_count = [0]
+        def write_dot():
+            sys.stdout.write(".")
+            dot_count[0] += 1
+            if dot_count[0] % 60 == 0:
+                print("")  # linefeed
+        return write_dot
 
 
     def _wait_for_file(self, file_name, lock_name=None):
@@ -943,24 +1355,10 @@ class PipelineManager(object):
         :type lock_name: str
         """
 
-        # Waiting loop/state variables
-        sleeptime = .5
-        first_message_flag = False
-        dot_count = 0
-
-        while not os.path.isfile(file_name):
-            if first_message_flag is False:
-                self.timestamp("Waiting for file: " + file_name)
-                first_message_flag = True
-            else:
-                sys.stdout.write(".")
-                dot_count = dot_count + 1
-                if dot_count % 60 == 0:
-                    print("")  # linefeed
-            time.sleep(sleeptime)
-            sleeptime = min(sleeptime + 2.5, 60)
-
-        if first_message_flag:
+        if not os.path.isfile(file_name):
+            self.timestamp("Waiting for file: " + file_name)
+            wait_for(lambda: os.path.isfile(file_name), file_name,
+                     on_timeout=self._waiting_dots())
             self.timestamp("File exists.")
 
         # Finalize lock file path and begin waiting.
@@ -1003,34 +1401,37 @@ class PipelineManager(object):
             checkpoint or current state indicates that a halt should occur.
         """
 
-        # Halt if the manager's state has been set such that this call
-        # should halt the pipeline.
-        if self.halt_on_next:
-            self.halt(checkpoint, finished, raise_error=raise_error)
+        self._flush_results()
 
-        # Determine action to take with respect to halting if needed.
-        if checkpoint:
-            if finished:
-                # Write the file.
-                self._checkpoint(checkpoint)
-                self.prev_checkpoint = checkpoint
-                self.curr_checkpoint = None
-            else:
-                self.prev_checkpoint = self.curr_checkpoint
-                self.curr_checkpoint = checkpoint
-                self._checkpoint(self.prev_checkpoint)
-            # Handle the two halting conditions.
-            if (finished and checkpoint == self.stop_after) or \
-                    (not finished and checkpoint == self.stop_before):
+        with self._checkpoint_lock:
+            # Halt if the manager's state has been set such that this call
+            # should halt the pipeline.
+            if self.halt_on_next:
                 self.halt(checkpoint, finished, raise_error=raise_error)
-            # Determine if we've started executing.
-            elif checkpoint == self.start_point:
-                self._active = True
-            # If this is a prospective checkpoint, set the current checkpoint
-            # accordingly and whether we should halt the pipeline on the
-            # next timestamp call.
-            if not finished and checkpoint == self.stop_after:
-                self.halt_on_next = True
+
+            # Determine action to take with respect to halting if needed.
+            if checkpoint:
+                if finished:
+                    # Write the file.
+                    self._checkpoint(checkpoint)
+                    self.prev_checkpoint = checkpoint
+                    self.curr_checkpoint = None
+                else:
+                    self.prev_checkpoint = self.curr_checkpoint
+                    self.curr_checkpoint = checkpoint
+                    self._checkpoint(self.prev_checkpoint)
+                # Handle the two halting conditions.
+                if (finished and checkpoint == self.stop_after) or \
+                        (not finished and checkpoint == self.stop_before):
+                    self.halt(checkpoint, finished, raise_error=raise_error)
+                # Determine if we've started executing.
+                elif checkpoint == self.start_point:
+                    self._active = True
+                # If this is a prospective checkpoint, set the current
+                # checkpoint accordingly and whether we should halt the
+                # pipeline on the next timestamp call.
+                if not finished and checkpoint == self.stop_after:
+                    self.halt_on_next = True
 
         elapsed = self.time_elapsed(self.last_timestamp)
         t = time.strftime("%m-%d %H:%M:%S")
@@ -1058,7 +1459,19 @@ class PipelineManager(object):
         return round(time.time() - time_since, 0)
 
 
-    def _report_profile(self, command, lock_name, elapsed_time, memory):
+    def _report_cache(self, outcome, target, key):
+        """
+        Note in the profile whether a target was found in the result cache.
+
+        :param str outcome: 'hit' or 'miss'
+        :param str target: Path to the target.
+        :param str key: Key for the target in the cache.
+        """
+        with open(self.pipeline_profile_file, "a") as myfile:
+            myfile.write("# Cache {}: {}\t{}\n".format(outcome, target, key))
+
+
+    def _report_profile(self, command, lock_name, elapsed_time, memory, cpu_time=None):
         """
         Writes a string to self.pipeline_profile_file.
 
@@ -1068,6 +1481,8 @@ class PipelineManager(object):
             str(lock_name) + "\t" + \
             str(datetime.timedelta(seconds = round(elapsed_time, 2))) + "\t " + \
             str(memory)
+        if cpu_time is not None:
+            message_raw += "\t " + str(round(cpu_time, 2))
 
         with open(self.pipeline_profile_file, "a") as myfile:
             myfile.write(message_raw + "\n")
@@ -1092,7 +1507,7 @@ class PipelineManager(object):
         value = str(value).strip()
 
         # keep the value in memory:
-        self.stats_dict[key] = value
+        self._stats[key] = value
         message_raw = "{key}\t{value}\t{annotation}".format(
             key=key, value=value, annotation=annotation)
 
@@ -1101,9 +1516,9 @@ class PipelineManager(object):
 
         print(message_markdown)
 
-        # Just to be extra careful, let's lock the file while we we write
-        # in case multiple pipelines write to the same file.
-        self._safe_write_to_file(self.pipeline_stats_file, message_raw)
+        # Multiple pipelines may write to the same file; each record is
+        # appended in one piece.
+        self._stats_writer.write(message_raw)
 
 
     def report_figure(self, key, filename, annotation=None):
@@ -1139,38 +1554,13 @@ class PipelineManager(object):
 
         print(message_markdown)
 
-        self._safe_write_to_file(self.pipeline_figures_file, message_raw)
-
+        self._figures_writer.write(message_raw)
 
-    def _safe_write_to_file(self, file, message):
-        """
-        Writes a string to a file safely (with file locks).
-        """
-        target = file
-        lock_name = make_lock_name(target, self.outfolder)
-        lock_file = self._make_lock_path(lock_name)
 
-        while True:
-            if os.path.isfile(lock_file):
-                self._wait_for_lock(lock_file)
-            else:
-                try:
-                    self.locks.append(lock_file)
-                    self._create_file_racefree(lock_file)
-                except OSError as e:
-                    if e.errno == errno.EEXIST:
-                        print ("Lock file created after test! Looping again.")
-                        continue  # Go back to start
-
-                # Proceed with file writing
-                with open(file, "a") as myfile:
-                    myfile.write(message + "\n")
-
-                os.remove(lock_file)
-                self.locks.remove(lock_file)
-                
-                # If you make it to the end of the while loop, you're done
-                break
+    def _flush_results(self):
+        """ Write out any stats and figures reports being held. """
+        self._stats_writer.flush()
+        self._figures_writer.flush()
 
 
     def _report_command(self, cmd):
@@ -1282,30 +1672,10 @@ class PipelineManager(object):
         Loads up the stats sheet created for this pipeline run and reads
         those stats into memory
         """
-
-        # regex identifies all possible stats files.
-        #regex = self.outfolder +  "*_stats.tsv"       
-        #stats_files = glob.glob(regex)
-        #stats_files.insert(self.pipeline_stats_file) # last one is the current pipeline
-        #for stats_file in stats_files:
-
-        stats_file = self.pipeline_stats_file
-        if os.path.isfile(self.pipeline_stats_file):
-            with open(stats_file, 'r') as stat_file:
-                for line in stat_file:
-                    try:
-                        # Someone may have put something that's not 3 columns in the stats file
-                        # if so, shame on him, but we can just ignore it.
-                        key, value, annotation  = line.split('\t')
-                    except ValueError:
-                        print("WARNING: Each row in a stats file is expected to have 3 columns")
-
-                    if annotation.rstrip() == self.name or annotation.rstrip() == "shared":
-                        self.stats_dict[key] = value.strip()
+        self._stats_writer.flush()
+        self._stats.refresh()
 
 
-        #if os.path.isfile(self.pipeline_stats_file):
-
     def get_stat(self, key):
         """
         Returns a stat that was previously reported. This is necessary for reporting new stats that are
@@ -1315,18 +1685,14 @@ class PipelineManager(object):
         first stat (number of trimmed reads); however, that may not have been calculated in the current
         pipeline run, so we must retrieve it from the stats.tsv output file. This command will retrieve
         such previously reported stats if they were not already calculated in the current pipeline run.
+        Stats written as numbers are returned as numbers (int or float);
+        text such as "007" or "1.10" is returned as it was written.
         :param key: key of stat to retrieve     
         """
-
-        try:
-            return self.stats_dict[key]
-        except KeyError:
-            self._refresh_stats()
-            try:
-                return self.stats_dict[key]
-            except KeyError:
-                print("Missing stat '{}'".format(key))
-                return None
+        value = self._stats.get(key)
+        if value is None:
+            print("Missing stat '{}'".format(key))
+        return value
 
 
     ###################################
@@ -1448,9 +1814,23 @@ class PipelineManager(object):
         :param dynamic_recover: Whether to recover e.g. for job termination.
         :type dynamic_recover: bool
         """
-        # Take care of any active running subprocess
+        # Take care of any active running subprocess, first making sure
+        # that no more commands are started in parallel. Workers already in
+        # run() check for this before starting their commands; this may be
+        # one of them, so it mustn't wait for them.
+        self._stopping = True
+        if self._parallel_failure is None and \
+                getattr(self._thread_state, "submitted", False):
+            self._parallel_failure = e
         sys.stdout.flush()
+        for future in list(self._futures):
+            future.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
         self._terminate_running_subprocesses()
+        self._stop_sampler()
+        self._flush_results()
 
         if dynamic_recover:
             # job was terminated, not failed due to a bad process.
@@ -1503,27 +1883,55 @@ class PipelineManager(object):
         The normal pipeline completion function, to be run by the pipeline
         at the end of the script. It sets status flag to completed and records 
         some time and memory statistics to the log file.
+
+        :raise Exception: If a command run in parallel (see submit) failed
+            the pipeline, the error with which it did so.
         """
+        # Commands still running in parallel must finish first; any of them
+        # may fail the pipeline, which then can't be called complete.
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._parallel_failure is not None:
+            raise self._parallel_failure
         self.set_status_flag(status)
         self._cleanup()
+        self._stop_sampler()
         self.report_result("Time", str(datetime.timedelta(seconds = self.time_elapsed(self.starttime))))
         self.report_result("Success", time.strftime("%m-%d-%H:%M:%S"))
+        self._flush_results()
         print("\n##### [Epilogue:]")
         print("* " + "Total elapsed time".rjust(20) + ":  " + str(datetime.timedelta(seconds = self.time_elapsed(self.starttime))))
         # print("Peak memory used: " + str(memory_usage()["peak"]) + "kb")
         print("* " + "Peak memory used".rjust(20) + ":  " + str(round(self.peak_memory, 2)) + " GB")
+        self._report_git_diffs()
         if self.halted:
             return
         self.timestamp("* Pipeline completed at: ".rjust(20))
 
 
+    def _report_git_diffs(self):
+        """
+        Print the summaries of uncommitted changes to code made in the
+        background (see lazy_git_diff), waiting briefly for any not yet done.
+        """
+        labels = {"pypiper": "Pypiper diff", "pipe": "Pipeline diff"}
+        for prefix, future in sorted(self._git_diffs.items()):
+            try:
+                diff = future.result(timeout=10)
+            except Exception:
+                continue
+            if diff:
+                print("* " + labels[prefix].rjust(20) + ":  " + diff)
+
+
     def _signal_term_handler(self, signal, frame):
         """
         TERM signal handler function: this function is run if the process receives a termination signal (TERM).
         This may be invoked, for example, by SLURM if the job exceeds its memory or time limits.
         It will simply record a message in the log file, stating that the process was terminated, and then
         gracefully fail the pipeline. This is necessary to 1. set the status flag and 2. provide a meaningful
-        error message in the tee'd output; if you do not handle this, then the tee process will be terminated
+        error message in the log; if you do not handle this, then the pipeline will stop
         before the TERM error message, leading to a confusing log file.
         """
         signal_type = "SIGTERM"
@@ -1581,24 +1989,38 @@ class PipelineManager(object):
             print("Pipeline status: {}".format(self.status))
             self.fail_pipeline(Exception("Unknown exit failure"))
 
+        # Everything has been printed; finish the log.
+        if self._log_mux is not None:
+            self._log_mux.close()
+
 
     def _terminate_running_subprocesses(self):
 
-        # make a copy of the list to iterate over since we'll be removing items
-        for pid in self.procs.copy():
-            proc_dict = self.procs[pid]
+        # make a copy of the list to iterate over since we'll be removing items;
+        # commands run in parallel may also finish (and remove themselves).
+        for pid in list(self.procs):
+            proc_dict = self.procs.pop(pid, None)
+            if proc_dict is None:
+                continue
 
             # Close the preformat tag that we opened when the process was spawned.
             # record profile of any running processes before killing
-            elapsed_time = time.time() - self.procs[pid]["start_time"]
-            process_peak_mem = self._memory_usage(pid, container=proc_dict["container"])/1e6
-            self._report_profile(self.procs[pid]["proc_name"], None, elapsed_time, process_peak_mem)
+            elapsed_time = time.time() - proc_dict["start_time"]
+            process_peak_mem = max(proc_dict.get("peak_mem", 0), self._memory_usage(pid, container=proc_dict["container"]))/1e6
+            cpu = read_cpu_times(pid)
+            cpu_time = sum(cpu) if cpu else None
+            self._report_profile(proc_dict["proc_name"], None, elapsed_time, process_peak_mem, cpu_time)
+            self._profile_writer.write(
+                command=proc_dict.get("command", proc_dict["proc_name"]),
+                stage=proc_dict.get("stage"),
+                pid=pid, start=proc_dict["start_time"], end=time.time(),
+                wall=elapsed_time, cpu_user=cpu[0] if cpu else None,
+                cpu_sys=cpu[1] if cpu else None, peak_mem=process_peak_mem)
         
             if proc_dict["pre_block"]:
                 print("</pre>")
                 sys.stdout.flush()
             self._kill_child_process(pid, proc_dict["proc_name"])
-            del self.procs[pid]
 
 
     def _kill_child_process(self, child_pid, proc_name=None):
@@ -1622,8 +2044,13 @@ class PipelineManager(object):
 
             # First a gentle kill            
             sys.stdout.flush()
-            os.kill(child_pid, signal.SIGINT)
-            os.kill(child_pid, signal.SIGTERM)
+            try:
+                os.kill(child_pid, signal.SIGINT)
+                os.kill(child_pid, signal.SIGTERM)
+            except OSError:
+                # Already exited and reaped.
+                print("Child process already terminated.")
+                return
 
             # If not terminated after 10 seconds, send a SIGKILL
             sleeptime = .25
@@ -1828,24 +2255,9 @@ class PipelineManager(object):
                 return 0
 
         # Thanks Martin Geisler:
-        status = None
-        result = {'peak': 0, 'rss': 0, 'hwm': 0}
-        try:
-            # This will only work on systems with a /proc file system
-            # (like Linux).
-            # status = open('/proc/self/status')
-            proc_spot = '/proc/%s/status' % pid
-            status = open(proc_spot)
-            for line in status:
-                parts = line.split()
-                key = parts[0][2:-1].lower()
-                if key in result:
-                    result[key] = int(parts[1])
-        finally:
-            if status is not None:
-                status.close()
-        # print(result[category])
-        return result[category]
+        # This will only work on systems with a /proc file system
+        # (like Linux); a process that's already gone uses no memory.
+        return read_memory(pid)[category]
 
 
     def _triage_error(self, e, nofail, errmsg):
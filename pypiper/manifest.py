@@ -0,0 +1,168 @@
+""" Record of how targets were built, for incremental reruns """
+
+import hashlib
+import json
+import os
+import threading
+
+
+__all__ = ["BuildManifest", "file_digest"]
+
+
+
+class BuildManifest(object):
+    """
+    On-disk record of the command and inputs from which each target was made.
+
+    Like make, this determines whether a target needs to be rebuilt, but
+    rather than comparing modification times alone, it compares the inputs
+    and command from which the target was last made. Only an input's
+    modification time and size are recorded, so recording costs no reading
+    of inputs. An input of a different size has changed; one with a new time
+    but the same size is hashed, and if its content is known from an earlier
+    check to be the same as when the target was made, touching it doesn't
+    trigger a rebuild. The manifest is read when it's first needed, and
+    written whenever a target is recorded.
+
+    :param str path: Path to the manifest (JSON) file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._digests = {}
+        self._lock = threading.Lock()
+
+
+    @property
+    def entries(self):
+        """
+        Fetch the records of built targets, reading the manifest if needed.
+
+        :return dict[str, dict]: For each target path, the command that made
+            it ('cmd') and the state of each of its inputs ('inputs').
+        """
+        if self._entries is None:
+            try:
+                with open(self.path) as f:
+                    self._entries = json.load(f)
+            except (IOError, OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+
+    def is_stale(self, target, cmd, inputs):
+        """
+        Determine whether a target needs to be rebuilt.
+
+        A target that's been recorded is stale if its command or any of its
+        inputs has changed since. For a target that's not been recorded, the
+        make rule applies: it's stale if any input is newer than it.
+
+        :param str target: Path to the target file.
+        :param str cmd: Command that makes the target.
+        :param Iterable[str] inputs: Paths to the files used to make target.
+        :return bool: Whether the target is missing or out of date.
+        """
+        if not os.path.exists(target):
+            return True
+        with self._lock:
+            entry = self.entries.get(os.path.abspath(target))
+        if entry is None:
+            target_mtime = os.path.getmtime(target)
+            return any(os.path.getmtime(i) > target_mtime
+                       for i in inputs if os.path.exists(i))
+        if entry["cmd"] != cmd:
+            return True
+        recorded = entry["inputs"]
+        inputs = [os.path.abspath(i) for i in inputs]
+        if set(inputs) != set(recorded):
+            return True
+        return any(self._changed(i, recorded[i]) for i in inputs)
+
+
+    def record(self, target, cmd, inputs):
+        """
+        Note the command and inputs from which a target's been made.
+
+        :param str target: Path to the target file.
+        :param str cmd: Command that made the target.
+        :param Iterable[str] inputs: Paths to the files used to make target.
+        """
+        target = os.path.abspath(target)
+        with self._lock:
+            previous = self.entries.get(target, {}).get("inputs", {})
+        state = {}
+        for i in inputs:
+            i = os.path.abspath(i)
+            state[i] = _file_state(i) if os.path.exists(i) else None
+            if state[i] is None:
+                continue
+            # Keep a hash only if one's already known for this version.
+            known = (i, state[i]["mtime"], state[i]["size"])
+            before = previous.get(i) or {}
+            if "md5" in before and \
+                    (i, before["mtime"], before["size"]) == known:
+                state[i]["md5"] = before["md5"]
+            elif known in self._digests:
+                state[i]["md5"] = self._digests[known]
+        with self._lock:
+            self.entries[target] = {"cmd": cmd, "inputs": state}
+            self._write()
+
+
+    def _changed(self, path, recorded):
+        """ Determine whether a file differs from the recorded state. """
+        if recorded is None or not os.path.exists(path):
+            return recorded is not None or os.path.exists(path)
+        current = _file_state(path)
+        if current["mtime"] == recorded["mtime"] and \
+                current["size"] == recorded["size"]:
+            return False
+        if current["size"] != recorded["size"]:
+            return True
+        # Same size but new time; only the content can tell. Without the
+        # recorded content's hash, that can't be known, so the target's
+        # remade, but this hash is kept, to be recorded along with it.
+        digest = file_digest(path)
+        self._digests[(path, current["mtime"], current["size"])] = digest
+        if digest != recorded.get("md5"):
+            return True
+        # Unchanged, so spare rehashing next time.
+        recorded["mtime"] = current["mtime"]
+        return False
+
+
+    def _write(self):
+        """ Replace the manifest file with the current records. """
+        temp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(self._entries, f, indent=1, sort_keys=True)
+        os.rename(temp, self.path)
+
+
+
+def _file_state(path):
+    """
+    Describe the current state of a file.
+
+    :param str path: Path to the file.
+    :return dict: modification time and size of the file
+    """
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size}
+
+
+
+def file_digest(path):
+    """
+    Hash the content of a file.
+
+    :param str path: Path to the file.
+    :return str: MD5 digest of the file's content, in hexadecimal
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
@@ -0,0 +1,318 @@
+""" Subprocess reaping and resource monitoring """
+
+import os
+import threading
+
+
+__all__ = ["ExitWatcher", "ResourceSampler", "process_tree"]
+
+
+
+# Clock ticks per second, for converting /proc/<pid>/stat CPU times, and
+# memory page size, for converting /proc/<pid>/stat resident set size.
+try:
+    _CLOCK_TICKS = float(os.sysconf("SC_CLK_TCK"))
+    _PAGE_KB = os.sysconf("SC_PAGE_SIZE") / 1024
+except (AttributeError, ValueError, OSError):
+    _CLOCK_TICKS = 100.0
+    _PAGE_KB = 4
+
+
+
+class ExitWatcher(threading.Thread):
+    """
+    Reap a child process from a dedicated thread.
+
+    The thread blocks in the kernel (wait4/waitpid) until the child exits, so
+    the exit is observed as soon as it happens rather than whenever a polling
+    loop next wakes up. The caller is free to do other periodic work, like
+    memory sampling, on its own timer by passing a timeout to wait().
+
+    :param subprocess.Popen proc: the child process to reap
+    :param callable before_reap: function to call with the child's ID once
+        it's exited but before it's reaped, while what's left of it (e.g.,
+        any descendants) can still be measured; only where the platform can
+        wait for an exit without reaping (waitid with WNOWAIT)
+    """
+
+    def __init__(self, proc, before_reap=None):
+        super(ExitWatcher, self).__init__(name="reaper-{}".format(proc.pid))
+        self.daemon = True
+        self.proc = proc
+        self.before_reap = before_reap
+        self.rusage = None
+        self._exited = threading.Event()
+
+
+    def run(self):
+        try:
+            if self.before_reap is not None and hasattr(os, "waitid") \
+                    and hasattr(os, "WNOWAIT"):
+                os.waitid(os.P_PID, self.proc.pid, os.WEXITED | os.WNOWAIT)
+                try:
+                    self.before_reap(self.proc.pid)
+                except Exception:
+                    # Measuring is best effort; the child must still be reaped.
+                    pass
+            if hasattr(os, "wait4"):
+                _, status, self.rusage = os.wait4(self.proc.pid, 0)
+                self.proc.returncode = _decode_wait_status(status)
+            else:
+                self.proc.wait()
+        except OSError:
+            # The child was reaped elsewhere; let Popen sort out the status.
+            self.proc.wait()
+        finally:
+            self._exited.set()
+
+
+    @property
+    def exited(self):
+        """
+        Has the child process been reaped?
+
+        :return bool: Whether the child process has exited and been reaped.
+        """
+        return self._exited.is_set()
+
+
+    def wait(self, timeout=None):
+        """
+        Block until the child exits or the timeout elapses.
+
+        :param float timeout: maximum number of seconds to block; wait
+            indefinitely if unspecified
+        :return bool: Whether the child process has exited.
+        """
+        return self._exited.wait(timeout)
+
+
+
+class ResourceSampler(threading.Thread):
+    """
+    Periodically sample memory and CPU use of a collection of processes.
+
+    This is a daemon thread that wakes at a fixed interval, independent of
+    any waiting for processes to exit, and updates each entry of the mapping
+    of running processes that it watches. For each process, the high water
+    mark of memory use ('peak_mem', in kilobytes) and the CPU time consumed
+    ('cpu_user' and 'cpu_sys', in seconds) are recorded in the entry itself.
+
+    An entry flagged with a true 'tree' value (e.g., a shell running a
+    pipeline of commands) is measured as a whole process tree: memory is the
+    summed resident set size of the process and all of its descendants, and
+    CPU time includes that of descendants, whether running or finished.
+
+    :param Mapping[int, dict] procs: running processes, keyed by process ID;
+        entries may name a 'container' in which the process runs
+    :param float interval: number of seconds between samples
+    :param callable memory_usage: function to measure a process's memory
+        use in kilobytes, given its ID and (keyword) container
+    """
+
+    def __init__(self, procs, interval, memory_usage=None):
+        super(ResourceSampler, self).__init__(name="resource-sampler")
+        self.daemon = True
+        self.procs = procs
+        self.interval = interval
+        self.memory_usage = memory_usage or \
+            (lambda pid, container=None: read_memory(pid)["hwm"])
+        self._stopped = threading.Event()
+
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+
+    def sample(self, pids=None):
+        """
+        Take one measurement of each of the watched processes.
+
+        :param Iterable[int] pids: IDs of the processes to measure, if not
+            all of them
+        """
+        # Copy the items since processes come and go as we sample.
+        procs = list(self.procs.items())
+        if pids is not None:
+            pids = set(pids)
+            procs = [(pid, proc) for pid, proc in procs if pid in pids]
+        # One scan of the process table serves all of the trees.
+        trees = {pid for pid, proc in procs
+                 if proc.get("tree") and not proc.get("container")}
+        table = process_table() if trees else {}
+        for pid, proc in procs:
+            if pid in trees:
+                self.sample_tree(pid, proc, table)
+            else:
+                self.sample_process(pid, proc)
+
+
+    def sample_process(self, pid, proc):
+        """
+        Update a single process entry with a new measurement.
+
+        :param int pid: ID of process to measure
+        :param dict proc: the process's entry, updated in place
+        """
+        try:
+            mem = self.memory_usage(pid, container=proc.get("container"))
+        except Exception:
+            # A process may exit mid-sample, and container stats can fail.
+            mem = 0
+        proc["peak_mem"] = max(proc.get("peak_mem", 0), mem)
+        cpu = read_cpu_times(pid)
+        if cpu is not None:
+            proc["cpu_user"], proc["cpu_sys"] = cpu
+
+
+    def sample_tree(self, pid, proc, table):
+        """
+        Update a process entry with a measurement of its whole tree.
+
+        :param int pid: ID of the process at the root of the tree
+        :param dict proc: the process's entry, updated in place
+        :param Mapping[int, dict] table: process table snapshot, as from
+            process_table()
+        """
+        members = [table[p] for p in process_tree(pid, table)]
+        if not members:
+            return
+        mem = sum(m["rss"] for m in members)
+        proc["peak_mem"] = max(proc.get("peak_mem", 0), mem)
+        proc["tree_size"] = max(proc.get("tree_size", 0), len(members))
+        # Each process's 'children' times cover descendants that it has
+        # already reaped, which are no longer in the table themselves.
+        proc["cpu_user"] = sum(m["utime"] + m["cutime"] for m in members)
+        proc["cpu_sys"] = sum(m["stime"] + m["cstime"] for m in members)
+
+
+    def stop(self):
+        """ Ask the sampling thread to finish. """
+        self._stopped.set()
+
+
+
+def process_table():
+    """
+    Take a snapshot of the system's processes.
+
+    :return dict[int, dict]: for each process, keyed by ID, its parent's ID
+        ('ppid'), resident set size in kilobytes ('rss'), and own and reaped
+        children's user/system CPU seconds ('utime', 'stime', 'cutime',
+        'cstime'); empty if there's no /proc file system
+    """
+    table = {}
+    try:
+        entries = os.listdir("/proc")
+    except OSError:
+        return table
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        stat = _read_stat(entry)
+        if stat is not None:
+            table[int(entry)] = stat
+    return table
+
+
+
+def process_tree(pid, table=None):
+    """
+    Determine the IDs of a process and all of its descendants.
+
+    :param int pid: ID of the process at the root of the tree
+    :param Mapping[int, dict] table: process table snapshot, as from
+        process_table(); a fresh one is taken if not provided
+    :return list[int]: IDs of the processes in the tree that are still
+        present, root first
+    """
+    table = process_table() if table is None else table
+    children = {}
+    for child, stat in table.items():
+        children.setdefault(stat["ppid"], []).append(child)
+    tree = [pid] if pid in table else []
+    frontier = list(tree)
+    while frontier:
+        frontier = [c for p in frontier for c in children.get(p, [])]
+        tree.extend(frontier)
+    return tree
+
+
+
+def read_cpu_times(pid):
+    """
+    Determine the CPU time consumed so far by a process.
+
+    :param int | str pid: ID of the process of interest
+    :return (float, float) | NoneType: user and system CPU seconds, or null
+        if the process can't be found (or there's no /proc file system)
+    """
+    stat = _read_stat(pid)
+    return None if stat is None else (stat["utime"], stat["stime"])
+
+
+
+def read_memory(pid):
+    """
+    Determine memory use of a process.
+
+    :param int | str pid: ID of the process of interest
+    :return dict[str, int]: high water mark ('hwm'), resident set size
+        ('rss') and peak virtual size ('peak'), each in kilobytes; zeros if
+        the process can't be found (or there's no /proc file system)
+    """
+    result = {'peak': 0, 'rss': 0, 'hwm': 0}
+    try:
+        with open("/proc/{}/status".format(pid)) as status:
+            for line in status:
+                parts = line.split()
+                key = parts[0][2:-1].lower()
+                if key in result:
+                    result[key] = int(parts[1])
+    except (IOError, OSError):
+        pass
+    return result
+
+
+
+def _read_stat(pid):
+    """
+    Parse the fields of interest from a process's /proc/<pid>/stat file.
+
+    :param int | str pid: ID of the process of interest
+    :return dict | NoneType: parent ID, resident set size (kilobytes), and
+        CPU times (seconds), or null if the process can't be found
+    """
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return None
+    # The command name field may contain spaces, so skip past its closing
+    # parenthesis; the remaining fields are numbered from the 3rd (state).
+    fields = stat[stat.rfind(")") + 2:].split()
+    try:
+        return {"ppid": int(fields[1]),
+                "utime": int(fields[11]) / _CLOCK_TICKS,
+                "stime": int(fields[12]) / _CLOCK_TICKS,
+                "cutime": int(fields[13]) / _CLOCK_TICKS,
+                "cstime": int(fields[14]) / _CLOCK_TICKS,
+                "rss": int(fields[21]) * _PAGE_KB}
+    except (IndexError, ValueError):
+        return None
+
+
+
+def _decode_wait_status(status):
+    """
+    Translate a raw wait() status into a Popen-style return code.
+
+    :param int status: status value as returned by os.wait4/os.waitpid
+    :return int: exit status, or negated signal number if the child was killed
+    """
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return status
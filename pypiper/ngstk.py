@@ -6,7 +6,12 @@ import subprocess
 import errno
 from .AttributeDict import AttributeDict as _AttributeDict
 from .exceptions import UnsupportedFiletypeException
+from .seqio import bam_to_fastq as _bam_to_fastq, \
+    count_flags as _count_flags, count_lines as _count_lines, \
+    count_unique_names as _count_unique_names, fastq_stats as _fastq_stats, \
+    split_fastq as _split_fastq
 from .utils import is_fastq, is_gzipped_fastq, is_sam_or_bam
+from .yamlconfig import load_yaml
 
 
 
@@ -48,10 +53,9 @@ class NGSTk(_AttributeDict):
         if config_file is None:
             super(NGSTk, self).__init__({}, default=True)
         else:
-            import yaml
-            with open(config_file, 'r') as config_file:
-                config = yaml.load(config_file)
-            super(NGSTk, self).__init__(config, default=True)
+            # A pipeline manager's config file is parsed only once.
+            config = load_yaml(config_file)
+            super(NGSTk, self).__init__(config or {}, default=True)
 
         # Keep a link to the pipeline manager, if one is provided.
         # if None is provided, instantiate "tools" and "parameters" with empty AttributeDicts
@@ -216,6 +220,7 @@ class NGSTk(_AttributeDict):
         than the standard way of doing this using Picard, and also much faster than the 
         bedtools implementation as well; however, it does no sanity checks and assumes the reads
         (for paired data) are all paired (no singletons), in the correct order.
+        See bam_to_fastq_native for a conversion without those assumptions.
 
         """
         self.make_sure_path_exists(os.path.dirname(out_fastq_pre))
@@ -249,6 +254,75 @@ class NGSTk(_AttributeDict):
         return cmd, fq1, fq2
 
 
+    def bam_to_fastq_native(self, bam_file, out_fastq_pre, paired_end,
+                            gzip=False, singletons=False):
+        """
+        Convert a BAM file to FASTQ file(s) (R1/R2) in process, in one pass.
+
+        Unlike bam_to_fastq_awk, this needn't have paired reads next to each
+        other, or every read paired: a read whose mate isn't found is a
+        singleton. The reads are counted as they're converted, and with a
+        pipeline manager, the counts are reported as check_fastq would have
+        reported them (Raw_reads, PF_reads, and Fastq_reads), so there's no
+        need to count the files' reads again.
+
+        :param str bam_file: path to BAM file with sequencing reads
+        :param str out_fastq_pre: path prefix for output FASTQ file(s)
+        :param bool paired_end: whether the given file contains paired-end
+            or single-end sequencing reads
+        :param bool gzip: whether to compress the FASTQ files (in parallel,
+            with as many threads as the pipeline manager has cores)
+        :param bool singletons: whether to keep paired-end reads whose mates
+            weren't found, in a file of their own (with suffix _singletons)
+        :return (str, str, dict[str, int]): Paths to the R1 and R2 FASTQ
+            files (the latter null if single-end), and the counts of reads
+            (see pypiper.seqio.bam_to_fastq)
+        """
+        self.make_sure_path_exists(os.path.dirname(out_fastq_pre))
+        ext = ".fastq.gz" if gzip else ".fastq"
+        fq1 = out_fastq_pre + "_R1" + ext
+        fq2 = out_fastq_pre + "_R2" + ext if paired_end else None
+        single = out_fastq_pre + "_singletons" + ext \
+            if paired_end and singletons else None
+        counts = _bam_to_fastq(bam_file, fq1, fq2, singletons=single,
+                               workers=self._cores())
+        if hasattr(self.pm, "report_result"):
+            self.pm.report_result("Raw_reads", counts["reads"])
+            self.pm.report_result(
+                "PF_reads", counts["reads"] - counts["qc_failed"])
+            self.pm.report_result("Fastq_reads", counts["written"])
+        return fq1, fq2, counts
+
+
+    def split_fastq(self, input_file, out_fastq_pre, gzip=False):
+        """
+        Split an interleaved FASTQ file into R1/R2 files, in process.
+
+        This is the in-process counterpart of the fastq_split.py script that
+        input_to_fastq runs. The input may be gzipped, and is decompressed
+        while it's split. With a pipeline manager, the read counts are
+        reported (Raw_reads and Fastq_reads), so there's no need to count
+        the files' reads again.
+
+        :param str input_file: path to FASTQ file, each read followed by its
+            mate
+        :param str out_fastq_pre: path prefix for output FASTQ files
+        :param bool gzip: whether to compress the FASTQ files (in parallel,
+            with as many threads as the pipeline manager has cores)
+        :return (str, str, dict[str, int]): Paths to the R1 and R2 FASTQ
+            files, and the counts of reads (see pypiper.seqio.split_fastq)
+        """
+        self.make_sure_path_exists(os.path.dirname(out_fastq_pre))
+        ext = ".fastq.gz" if gzip else ".fastq"
+        fq1 = out_fastq_pre + "_R1" + ext
+        fq2 = out_fastq_pre + "_R2" + ext
+        counts = _split_fastq(input_file, fq1, fq2, workers=self._cores())
+        if hasattr(self.pm, "report_result"):
+            self.pm.report_result("Raw_reads", counts["reads"])
+            self.pm.report_result("Fastq_reads", counts["reads"])
+        return fq1, fq2, counts
+
+
     def get_input_ext(self, input_file):
         """
         Get the extension of the input_file. Assumes you're using either
@@ -433,6 +507,7 @@ class NGSTk(_AttributeDict):
                 print("Found .fastq.gz file")
                 if paired_end and not multiclass:
                     # For paired-end reads in one fastq file, we must split the file into 2.
+                    # (split_fastq does this in process, if it's called directly.)
                     script_path = os.path.join(
                             self.tools.scripts_dir, "fastq_split.py")
                     cmd = self.tools.python + " -u " + script_path
@@ -484,19 +559,21 @@ class NGSTk(_AttributeDict):
             print(input_files)
             print(output_files)
 
-            n_input_files = len(filter(bool, input_files))
+            n_input_files = len([f for f in input_files if f])
 
             total_reads = sum([int(self.count_reads(input_file, paired_end))
                                for input_file in input_files])
-            raw_reads = total_reads / n_input_files
+            raw_reads = total_reads // n_input_files
             self.pm.report_result("Raw_reads", str(raw_reads))
 
-            total_fastq_reads = sum(
-                [int(self.count_reads(output_file, paired_end))
-                 for output_file in output_files])
-            fastq_reads = total_fastq_reads / n_input_files
+            # One pass over each output gives its count and its statistics.
+            fastq_stats = [self.fastq_stats(f) for f in output_files]
+            total_fastq_reads = sum(stats.reads for stats in fastq_stats) * \
+                (2 if paired_end else 1)
+            fastq_reads = total_fastq_reads // n_input_files
 
             self.pm.report_result("Fastq_reads", fastq_reads)
+            self._report_fastq_stats("Fastq", fastq_stats)
             input_ext = self.get_input_ext(input_files[0])
             # We can only assess pass filter reads in bam files with flags.
             if input_ext == ".bam":
@@ -541,8 +618,20 @@ class NGSTk(_AttributeDict):
             if paired_end and not trimmed_fastq_R2:
                 print("WARNING: specified paired-end but no R2 file")
 
-            n_trim = float(self.count_reads(trimmed_fastq, paired_end))
+            # One pass over each file gives its count and its statistics.
+            trimmed_stats = [self.fastq_stats(trimmed_fastq)]
+            if paired_end and trimmed_fastq_R2:
+                trimmed_stats.append(self.fastq_stats(trimmed_fastq_R2))
+                if trimmed_stats[0].reads != trimmed_stats[1].reads:
+                    print("WARNING: R1 and R2 have different read counts "
+                          "({} and {})".format(trimmed_stats[0].reads,
+                                               trimmed_stats[1].reads))
+                n_trim = float(sum(stats.reads for stats in trimmed_stats))
+            else:
+                n_trim = float(
+                    trimmed_stats[0].reads * (2 if paired_end else 1))
             self.pm.report_result("Trimmed_reads", int(n_trim))
+            self._report_fastq_stats("Trimmed", trimmed_stats)
             try:
                 rr = float(self.pm.get_stat("Raw_reads"))
             except:
@@ -648,22 +737,26 @@ class NGSTk(_AttributeDict):
 
     def count_lines(self, file_name):
         """
-        Uses the command-line utility wc to count the number of lines in a file.
+        Count the number of lines in a file, in process (the file is
+        memory-mapped, and a large one counted in parallel).
 
         :param file_name: name of file whose lines are to be counted
         :type file_name: str
+        :return int: Number of lines in the file
         """
-        x = subprocess.check_output("wc -l " + file_name + " | cut -f1 -d' '", shell=True)
-        return x
+        return _count_lines(file_name, workers=self._cores())
 
     def count_lines_zip(self, file_name):
         """
-        Uses the command-line utility wc to count the number of lines in a file.
-        For compressed files.
-        :param file: file_name
+        Count the number of lines in a gzipped file, decompressing it with as
+        many threads as the pipeline manager has cores (a BGZF file's blocks
+        are decompressed in parallel).
+
+        :param file_name: name of file whose lines are to be counted
+        :type file_name: str
+        :return int: Number of lines in the decompressed file
         """
-        x = subprocess.check_output("zcat " + file_name + " | wc -l | cut -f1 -d' '", shell=True)
-        return x
+        return _count_lines(file_name, workers=self._cores())
 
     def get_chrs_from_bam(self, file_name):
         """
@@ -679,7 +772,50 @@ class NGSTk(_AttributeDict):
     ###################################
     # In these functions, A paired-end read, with 2 sequences, counts as a two reads
 
-    def count_unique_reads(self, file_name, paired_end):
+    def count_flags(self, file_name):
+        """
+        Tally the reads in a SAM or BAM file by their flags, in one pass.
+
+        The flag-based counting functions use this, so calling several of
+        them on one file reads it only once.
+
+        :param str file_name: Path to the SAM or BAM file.
+        :return pypiper.seqio.FlagCounts: Tally of the reads, from which any
+            count by flag (e.g., mapped, secondary, QC-failed) can be had
+        """
+        return _count_flags(file_name, workers=self._cores())
+
+
+    def fastq_stats(self, file_name):
+        """
+        Gather statistics of the reads in a FASTQ file, in one pass.
+
+        :param str file_name: Path to the FASTQ file, which may be gzipped.
+        :return pypiper.seqio.FastqStats: Read and base counts, length
+            histogram, mean quality by position, and GC fraction
+        """
+        return _fastq_stats(file_name, workers=self._cores())
+
+
+    def _cores(self):
+        """ Number of cores the pipeline manager has, or 1 without one. """
+        return int(self.pm.cores) if hasattr(self.pm, "cores") else 1
+
+
+    def _report_fastq_stats(self, prefix, stats):
+        """ Report the base count, mean length, and GC of FASTQ files. """
+        reads = sum(s.reads for s in stats)
+        bases = sum(s.bases for s in stats)
+        gc = sum(s.gc for s in stats)
+        self.pm.report_result(prefix + "_bases", bases)
+        self.pm.report_result(prefix + "_mean_length",
+                              round(float(bases) / reads, 2) if reads else 0)
+        self.pm.report_result(prefix + "_GC_fraction",
+                              round(float(gc) / bases, 4) if bases else 0)
+
+
+    def count_unique_reads(self, file_name, paired_end, approximate=False,
+                           max_exact=None):
         """
         Sometimes alignment software puts multiple locations for a single read; if you just count
         those reads, you will get an inaccurate count. This is _not_ the same as multimapping reads,
@@ -688,21 +824,27 @@ class NGSTk(_AttributeDict):
         This function counts each read only once.
         This accounts for paired end or not for free because pairs have the same read name.
         In this function, a paired-end read would count as 2 reads.
+
+        Names are counted as the file is read, in one pass, rather than sorted. The count is
+        exact unless an estimate is asked for, which bounds memory use.
+
+        :param file_name: name of reads file
+        :type file_name: str
+        :param paired_end: True/False paired end data
+        :type paired_end: bool
+        :param approximate: Whether to estimate the count (to within about 1%) in fixed memory
+        :type approximate: bool
+        :param max_exact: Number of distinct names beyond which to estimate the count
+            (each takes about 70 bytes); None (the default) for no limit
+        :type max_exact: int
+        :return: Number of unique reads.
+        :rtype: int
         """
-        if file_name.endswith("sam"):
-            param = "-S"
-        if file_name.endswith("bam"):
-            param = ""
-        if paired_end:
-            r1 = self.samtools_view(file_name, param=param + " -f64", postpend=" | cut -f1 | sort -k1,1 -u | wc -l ")
-            r2 = self.samtools_view(file_name, param=param + " -f128", postpend=" | cut -f1 | sort -k1,1 -u | wc -l ")
-        else:
-            r1 = self.samtools_view(file_name, param=param + "", postpend=" | cut -f1 | sort -k1,1 -u | wc -l ")
-            r2 = 0
-        return int(r1) + int(r2)
+        return self._count_unique(file_name, paired_end, 0, approximate, max_exact)
 
 
-    def count_unique_mapped_reads(self, file_name, paired_end):
+    def count_unique_mapped_reads(self, file_name, paired_end,
+                                  approximate=False, max_exact=None):
         """
         For a bam or sam file with paired or or single-end reads, returns the
         number of mapped reads, counting each read only once, even if it appears
@@ -712,28 +854,28 @@ class NGSTk(_AttributeDict):
         :type file_name: str
         :param paired_end: True/False paired end data
         :type paired_end: bool
+        :param approximate: Whether to estimate the count (to within about 1%) in fixed memory
+        :type approximate: bool
+        :param max_exact: Number of distinct names beyond which to estimate the count
+            (each takes about 70 bytes); None (the default) for no limit
+        :type max_exact: int
         :return: Number of uniquely mapped reads.
         :rtype: int
         """
+        return self._count_unique(file_name, paired_end, 4, approximate, max_exact)
 
-        _, ext = os.path.splitext(file_name)
-        ext = ext.lower()
 
-        if ext == ".sam":
-            param = "-S -F4"
-        elif ext == "bam":
-            param = "-F4"
-        else:
+    def _count_unique(self, file_name, paired_end, exclude, approximate, max_exact):
+        """ Count distinct read names, of first and second reads in the same pass. """
+        if not is_sam_or_bam(file_name):
             raise ValueError("Not a SAM or BAM: '{}'".format(file_name))
-
-        if paired_end:
-            r1 = self.samtools_view(file_name, param=param + " -f64", postpend=" | cut -f1 | sort -k1,1 -u | wc -l ")
-            r2 = self.samtools_view(file_name, param=param + " -f128", postpend=" | cut -f1 | sort -k1,1 -u | wc -l ")
-        else:
-            r1 = self.samtools_view(file_name, param=param + "", postpend=" | cut -f1 | sort -k1,1 -u | wc -l ")
-            r2 = 0
-
-        return int(r1) + int(r2)
+        r1, r2, exact = _count_unique_names(
+            file_name, paired_end=paired_end, exclude=exclude,
+            workers=self._cores(), max_exact=max_exact,
+            approximate=approximate)
+        if not exact:
+            print("Unique read count of '{}' is an estimate".format(file_name))
+        return r1 + r2
 
 
     def count_flag_reads(self, file_name, flag, paired_end):
@@ -750,10 +892,7 @@ class NGSTk(_AttributeDict):
         pipeline development.
         :type paired_end: bool
         """
-        param = " -c -f" + str(flag)
-        if file_name.endswith("sam"):
-            param += " -S"
-        return self.samtools_view(file_name, param=param)
+        return self.count_flags(file_name).count(require=int(flag))
 
 
     def count_multimapping_reads(self, file_name, paired_end):
@@ -782,10 +921,7 @@ class NGSTk(_AttributeDict):
         :param paired_end: This parameter is ignored.
         :type paired_end: bool
         """
-        param = " -c -F256"
-        if file_name.endswith("sam"):
-            param += " -S"
-        return self.samtools_view(file_name, param=param)
+        return self.count_flags(file_name).count(exclude=256)
 
 
     def count_fail_reads(self, file_name, paired_end):
@@ -834,21 +970,19 @@ class NGSTk(_AttributeDict):
         :type paired_end: bool
         """
 
-        _, ext = os.path.splitext(file_name)
         if not (is_sam_or_bam(file_name) or is_fastq(file_name)):
             # TODO: make this an exception and force caller to handle that
             # rather than relying on knowledge of possibility of negative value.
             return -1
 
         if is_sam_or_bam(file_name):
-            param_text = "-c" if ext == ".bam" else "-c -S"
-            return self.samtools_view(file_name, param=param_text)
+            return self.count_flags(file_name).total
         else:
             num_lines = self.count_lines_zip(file_name) \
                     if is_gzipped_fastq(file_name) \
                     else self.count_lines(file_name)
             divisor = 2 if paired_end else 4
-            return int(num_lines) / divisor
+            return num_lines // divisor
 
 
     def count_mapped_reads(self, file_name, paired_end):
@@ -864,14 +998,11 @@ class NGSTk(_AttributeDict):
         counting functions require the parameter. This makes it easier to swap counting functions during
         pipeline development.
         :type paired_end: bool
-        :return: Either return code from samtools view command, or -1 to
-            indicate an error state.
+        :return: Number of mapped reads, or -1 to indicate an error state.
         :rtype: int
         """
-        if file_name.endswith("bam"):
-            return self.samtools_view(file_name, param="-c -F4")
-        if file_name.endswith("sam"):
-            return self.samtools_view(file_name, param="-c -F4 -S")
+        if file_name.endswith("bam") or file_name.endswith("sam"):
+            return self.count_flags(file_name).mapped
         return -1
 
 
@@ -1749,9 +1880,7 @@ class NGSTk(_AttributeDict):
         :param sample: A Sample object with the "peaks" attribute.
         :type sample: pipelines.Sample
         """
-        proc = subprocess.Popen(["wc", "-l", sample.peaks], stdout=subprocess.PIPE)
-        out, err = proc.communicate()
-        sample["peakNumber"] = re.sub("\D.*", "", out)
+        sample["peakNumber"] = self.count_lines(sample.peaks)
         return sample
 
 
@@ -2,6 +2,7 @@
 
 import abc
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import glob
 import os
 import sys
@@ -148,6 +149,9 @@ class Pipeline(object):
             _internal_to_external[internal_name] = name
             self._stages.append(stage)
 
+        # Determine the stages on which each stage directly depends.
+        self._upstream = _stage_dependencies(self._stages)
+
         self.skipped, self.executed = None, None
 
 
@@ -243,10 +247,17 @@ class Pipeline(object):
             return paths
 
 
-    def run(self, start_point=None, stop_before=None, stop_after=None):
+    def run(self, start_point=None, stop_before=None, stop_after=None,
+            max_workers=1):
         """
         Run the pipeline, optionally specifying start and/or stop points.
 
+        Stages are run once the stages on which they depend have finished;
+        with more than one worker, independent stages run at the same time.
+        Start and stop points are interpreted with respect to the stages'
+        dependencies: starting at a stage skips the stages upstream of it,
+        and stopping at a stage leaves out the stages downstream of it.
+
         :param start_point: Name of stage at which to begin execution.
         :type start_point: str
         :param stop_before: Name of stage at which to cease execution;
@@ -255,6 +266,8 @@ class Pipeline(object):
         :param stop_after: Name of stage at which to cease execution;
             inclusive, i.e. this stage is the last one run
         :type stop_after: str
+        :param max_workers: Maximum number of stages to run at once
+        :type max_workers: int
         :raise IllegalPipelineExecutionError: If both inclusive (stop_after)
             and exclusive (stop_before) halting points are provided, or if that
             start stage is the same as or after the stop stage, raise an
@@ -296,57 +309,75 @@ class Pipeline(object):
             print("WARNING: Starting and stopping points are nonsense for "
                   "pipeline with unordered stages.")
 
-        # TODO: consider context manager based on start/stop points.
-
-        # Determine where to start (but perhaps skip further based on
-        # checkpoint completions.)
-        start_index = self._start_index(start_point)
-        stop_index = self._stop_index(stop, inclusive=inclusive_stop)
-        assert stop_index <= len(self._stages)
-        if start_index >= stop_index:
+        # Stages upstream of the start point are skipped, and those
+        # downstream of the stopping point are left out.
+        before_start = set() if start_point is None else \
+            _ancestors(self._upstream, parse_stage_name(start_point))
+        beyond_stop = set()
+        if stop is not None:
+            stop_name = parse_stage_name(stop)
+            beyond_stop = _descendants(self._upstream, stop_name)
+            if not inclusive_stop:
+                beyond_stop.add(stop_name)
+        if start_point is not None and \
+                parse_stage_name(start_point) in beyond_stop:
             raise IllegalPipelineExecutionError(
                     "Cannot start pipeline at or after stopping point")
 
-        # TODO: consider storing just stage name rather than entire stage.
-        # TODO (cont.): the bad case for whole-Stage is if associated data
-        # TODO (cont.): (i.e., one or more args) are large.
-        self.skipped.extend(self._stages[:start_index])
-
-        # TODO: support both courses of action for non-continuous checkpoints.
-        # TODO (cont.): That is, what if there's a stage with a checkpoint
-        # TODO (cont.): file downstream of one without it? Naively, we'll
-        # TODO (cont.): skip it, but we may want to re-run.
-        skip_mode = True
-
-        for stage in self._stages[start_index:stop_index]:
-
-            # TODO: Note that there's no way to tell whether a non-checkpointed
-            # TODO (cont.) Stage has been completed, and thus this seek
-            # TODO (cont.) operation will find the first Stage, starting
-            # TODO (cont.) the specified start point, either uncheckpointed or
-            # TODO (cont.) for which the checkpoint file does not exist.
-            # Look for checkpoint file.
-            if skip_mode and self.completed_stage(stage):
-                print("Skipping completed checkpoint stage: {}".format(stage))
-                self.skipped.append(stage)
-                continue
-
-            # Once we've found where to being execution, ignore checkpoint
-            # flags downstream if they exist since there may be dependence
-            # between results from different stages.
-            skip_mode = False
+        # Names of stages skipped, and of those that are done (run or not).
+        skipped = set(before_start)
+        finished = set(before_start)
+        pending = [s for s in self._stages
+                   if s.name not in before_start and s.name not in beyond_stop]
+        running = {}
+        pool = ThreadPoolExecutor(max_workers=max_workers) \
+            if max_workers > 1 else None
 
-            print("Running stage: {}".format(stage))
-
-            stage.run()
-            self.executed.append(stage)
-            self.checkpoint(stage)
+        try:
+            while pending or running:
+                stage = None
+                if len(running) < max_workers:
+                    stage = next((s for s in pending
+                                  if self._upstream[s.name] <= finished), None)
+                if stage is not None:
+                    pending.remove(stage)
+                    # TODO: Note that there's no way to tell whether a
+                    # TODO (cont.) non-checkpointed Stage has been completed.
+                    # A completed stage is skipped unless something upstream
+                    # of it has been run, since it may depend on the results.
+                    if not (self._upstream[stage.name] & self._ran) and \
+                            self.completed_stage(stage):
+                        print("Skipping completed checkpoint stage: {}".
+                              format(stage))
+                        skipped.add(stage.name)
+                        finished.add(stage.name)
+                        continue
+                    print("Running stage: {}".format(stage))
+                    self._ran.add(stage.name)
+                    if pool is None:
+                        self._run_stage(stage)
+                        self._finish_stage(stage, finished)
+                    else:
+                        running[pool.submit(self._run_stage, stage)] = stage
+                    continue
+                # Nothing more can start until a running stage finishes.
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    future.result()
+                    self._finish_stage(stage, finished)
+        finally:
+            if pool is not None:
+                for future in running:
+                    future.cancel()
+                pool.shutdown(wait=True)
 
         # Add any unused stages to the collection of skips.
-        self.skipped.extend(self._stages[stop_index:])
+        skipped.update(beyond_stop)
+        self.skipped.extend(s for s in self._stages if s.name in skipped)
 
         # Where we stopped determines the shutdown mode.
-        if stop_index == len(self._stages):
+        if not beyond_stop:
             self.wrapup()
         else:
             self.halt(raise_error=False)
@@ -357,49 +388,101 @@ class Pipeline(object):
         self.manager.complete()
 
 
+    def _run_stage(self, stage):
+        """ Run a stage, letting the manager know which stage it is. """
+        self.manager.current_stage = stage.name
+        try:
+            stage.run()
+        finally:
+            self.manager.current_stage = None
+
+
+    def _finish_stage(self, stage, finished):
+        """ Record completion of a stage that's been run. """
+        self.executed.append(stage)
+        self.checkpoint(stage)
+        finished.add(stage.name)
+
+
     def _reset(self):
         """ Scrub decks with respect to Stage status/label tracking. """
         self.skipped, self.executed = [], []
+        self._ran = set()
 
 
-    def _start_index(self, start=None):
-        """ Seek to the first stage to run. """
-        if start is None:
-            return 0
-        start_stage = translate_stage_name(start)
-        internal_names = [translate_stage_name(s.name) for s in self._stages]
-        try:
-            return internal_names.index(start_stage)
-        except ValueError:
-            raise UnknownPipelineStageError(start, self)
 
+def _ancestors(upstream, name):
+    """
+    Determine the names of the stages upstream of the one named.
 
-    def _stop_index(self, stop_point, inclusive):
-        """
-        Determine index of stage of stopping point for run().
-
-        :param stop_point: Stopping point itself or name of it.
-        :type stop_point: str | pypiper.Stage | function
-        :param inclusive: Whether the stopping point is to be regarded as
-            inclusive (i.e., whether it's the final stage to run, or the one
-            just beyond)
-        :type inclusive: bool
-        :return: Index into sequence of Pipeline's stages that indicates
-            where to stop; critically, the value of the inclusive parameter
-            here is used to contextualize this index such that it's always
-            returned as an exclusive stopping index (i.e., execute up to the
-            stage indexed by the value returned from this function.)
-        :rtype: int
-        """
-        if not stop_point:
-            # Null case, no stopping point
-            return len(self._stages)
-        stop_name = parse_stage_name(stop_point)
-        try:
-            stop_index = self.stage_names.index(stop_name)
-        except ValueError:
-            raise UnknownPipelineStageError(stop_name, self)
-        return stop_index + 1 if inclusive else stop_index
+    :param Mapping[str, set[str]] upstream: names of the stages on which
+        each stage directly depends, keyed by stage name
+    :param str name: name of stage of interest
+    :return set[str]: names of stages on which the named one depends,
+        directly or indirectly
+    """
+    found = set()
+    frontier = [name]
+    while frontier:
+        frontier = [u for n in frontier for u in upstream[n] if u not in found]
+        found.update(frontier)
+    return found
+
+
+
+def _descendants(upstream, name):
+    """
+    Determine the names of the stages downstream of the one named.
+
+    :param Mapping[str, set[str]] upstream: names of the stages on which
+        each stage directly depends, keyed by stage name
+    :param str name: name of stage of interest
+    :return set[str]: names of stages that depend on the named one,
+        directly or indirectly
+    """
+    return {n for n in upstream if name in _ancestors(upstream, n)}
+
+
+
+def _stage_dependencies(stages):
+    """
+    Determine the stages on which each of a pipeline's stages depends.
+
+    A stage depends on those it names, and on those that produce its inputs;
+    a stage that declares neither depends on the stage preceding it.
+
+    :param Sequence[pypiper.Stage] stages: the pipeline's stages
+    :return dict[str, set[str]]: names of the stages on which each stage
+        directly depends, keyed by stage name
+    :raise IllegalPipelineDefinitionError: If a stage depends on an unknown
+        stage, or if the dependencies are circular.
+    """
+    names = {translate_stage_name(s.name): s.name for s in stages}
+    producers = {}
+    for stage in stages:
+        for path in stage.outputs:
+            producers.setdefault(os.path.abspath(path), set()).add(stage.name)
+    upstream = OrderedDict()
+    for i, stage in enumerate(stages):
+        deps = set()
+        for name in stage.depends_on or []:
+            try:
+                deps.add(names[translate_stage_name(name)])
+            except KeyError:
+                raise IllegalPipelineDefinitionError(
+                    "Stage '{}' depends on unknown stage '{}'".
+                    format(stage.name, name))
+        for path in stage.inputs:
+            deps.update(producers.get(os.path.abspath(path), set()))
+        if stage.depends_on is None and not stage.inputs and i > 0:
+            deps.add(stages[i - 1].name)
+        deps.discard(stage.name)
+        upstream[stage.name] = deps
+    for name in upstream:
+        if name in _ancestors(upstream, name):
+            raise IllegalPipelineDefinitionError(
+                "Circular dependency of stage '{}'".format(name))
+    return upstream
 
 
 
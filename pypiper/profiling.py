@@ -0,0 +1,251 @@
+""" Structured records of the commands run by pipelines """
+
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import json
+import os
+import re
+
+from .stats import RecordWriter
+
+
+__all__ = ["PROFILE_FIELDS", "ProfileWriter", "read_profiles",
+           "load_profiles", "summarize_profiles"]
+
+
+
+# Fields of each record: the pipeline, and when the run of it started (epoch
+# seconds); the command, its lock, and the stage it was part of; its process
+# ID, start and end times (epoch seconds), and wall time, user and system CPU
+# time (seconds); peak memory use (GB); its exit code (null if killed); and
+# the end of its output, if the pipeline keeps that (otherwise null).
+PROFILE_FIELDS = ["pipeline", "run_start", "command", "lock_name", "stage",
+                  "pid", "start", "end", "wall", "cpu_user", "cpu_sys",
+                  "peak_mem", "exit_code", "output"]
+
+PROFILE_SUFFIX = "_profile.jsonl"
+TSV_PROFILE_SUFFIX = "_profile.tsv"
+
+# Statistics for each group of records in a summary.
+SUMMARY_FIELDS = ["group", "runs", "failures", "failure_rate", "wall_total",
+                  "wall_p50", "wall_p95", "mem_p50", "mem_p95", "mem_max"]
+
+
+
+class ProfileWriter(object):
+    """
+    Writer of a pipeline's profile as JSON Lines, one record per command.
+
+    Unlike the human-oriented profile TSV, every record has the same fields
+    (PROFILE_FIELDS) with machine-readable values, so the profiles of many
+    pipeline runs can be combined into one table without parsing text. The
+    file is append-only; each record is appended whole, in a single write.
+
+    :param str path: Path to the profile file.
+    :param str pipeline: Name of the pipeline.
+    :param float run_start: When this run of the pipeline started.
+    """
+
+    def __init__(self, path, pipeline, run_start):
+        self.path = path
+        self.pipeline = pipeline
+        self.run_start = run_start
+        self._writer = RecordWriter(path)
+
+
+    def write(self, **fields):
+        """
+        Append a record to the profile.
+
+        :param fields: Values for the record, named as in PROFILE_FIELDS;
+            unspecified fields are null.
+        """
+        record = {f: fields.get(f) for f in PROFILE_FIELDS}
+        record["pipeline"] = self.pipeline
+        record["run_start"] = self.run_start
+        self._writer.write(json.dumps(record, sort_keys=True))
+
+
+
+def read_profiles(paths, workers=1):
+    """
+    Read the records of the profiles of one or more pipeline runs.
+
+    A folder with no JSON Lines profile (e.g., from a pipeline run before
+    those were written) is represented by its TSV profile, if any, from which
+    only the command name, lock, wall time, memory, and CPU time are known.
+
+    :param str | Iterable[str] paths: Path(s) to profile files, or to
+        folders containing them (e.g., sample output folders).
+    :param int workers: Number of processes among which to divide the
+        reading of the profiles.
+    :return dict[str, list]: For each field (PROFILE_FIELDS, plus 'folder',
+        the folder of the profile file), the values of all of the records.
+    """
+    files = list(_profile_files(paths))
+    if workers > 1 and len(files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_read_profile_file, files,
+                                  chunksize=max(1, len(files) // (4 * workers))))
+    else:
+        parts = [_read_profile_file(f) for f in files]
+    columns = {f: [] for f in PROFILE_FIELDS + ["folder"]}
+    for part in parts:
+        for field, values in part.items():
+            columns[field].extend(values)
+    return columns
+
+
+
+def load_profiles(paths):
+    """
+    Combine the profiles of one or more pipeline runs into a single table.
+
+    :param str | Iterable[str] paths: Path(s) to profile files, or to
+        folders containing them (e.g., sample output folders).
+    :return pandas.DataFrame: One row per command run, with a column for each
+        field (see read_profiles)
+    """
+    import pandas as pd
+    columns = read_profiles(paths)
+    return pd.DataFrame(columns, columns=PROFILE_FIELDS + ["folder"])
+
+
+
+def summarize_profiles(columns, by="tool"):
+    """
+    Summarize the commands of many pipeline runs, by tool or stage.
+
+    :param Mapping[str, list] columns: Profile records, as from read_profiles
+    :param str by: How to group the records: 'tool' (the program run, i.e.
+        the command's first word), 'stage', 'lock_name', or 'command'
+    :return list[dict]: For each group, its number of runs and of failures
+        (nonzero or killed), failure rate (among runs for which exit status
+        is known), total wall time, median and 95th percentile of wall time
+        (seconds) and peak memory (GB), and maximum peak memory; sorted
+        by total wall time, largest first
+    """
+    if by == "tool":
+        keys = [_tool(c) for c in columns["command"]]
+    else:
+        keys = columns[by]
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(key, []).append(i)
+    summary = []
+    for key, rows in groups.items():
+        walls = [columns["wall"][i] for i in rows
+                 if columns["wall"][i] is not None]
+        mems = [columns["peak_mem"][i] for i in rows
+                if columns["peak_mem"][i] is not None]
+        # Only records from the structured profile have exit status (and
+        # process ID); those from a TSV profile don't.
+        known = [i for i in rows if columns["pid"][i] is not None]
+        failures = sum(1 for i in known if columns["exit_code"][i] != 0)
+        summary.append({
+            "group": key, "runs": len(rows), "failures": failures,
+            "failure_rate": float(failures) / len(known) if known else None,
+            "wall_total": sum(walls),
+            "wall_p50": _percentile(walls, 50),
+            "wall_p95": _percentile(walls, 95),
+            "mem_p50": _percentile(mems, 50),
+            "mem_p95": _percentile(mems, 95),
+            "mem_max": max(mems) if mems else None})
+    return sorted(summary, key=lambda g: -g["wall_total"])
+
+
+
+def _percentile(values, q):
+    """ Compute a percentile by linear interpolation; null if no values. """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100.0
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+
+def _tool(command):
+    """ Determine the program that a command runs. """
+    words = (command or "").split()
+    return os.path.basename(words[0]) if words else None
+
+
+
+def _profile_files(paths):
+    """ Find the profile files among paths to files and folders. """
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        if os.path.isdir(path):
+            found = sorted(glob.glob(os.path.join(path, "*" + PROFILE_SUFFIX)))
+            if not found:
+                found = sorted(glob.glob(
+                    os.path.join(path, "*" + TSV_PROFILE_SUFFIX)))
+            for f in found:
+                yield f
+        else:
+            yield path
+
+
+
+def _read_profile_file(path):
+    """ Read one profile file into columns of field values. """
+    folder = os.path.dirname(os.path.abspath(path))
+    columns = {f: [] for f in PROFILE_FIELDS + ["folder"]}
+    if path.endswith(TSV_PROFILE_SUFFIX):
+        pipeline = os.path.basename(path)[:-len(TSV_PROFILE_SUFFIX)]
+        records = _read_tsv_profile(path, pipeline)
+    else:
+        records = _read_jsonl_profile(path)
+    for record in records:
+        for field in PROFILE_FIELDS:
+            columns[field].append(record.get(field))
+        columns["folder"].append(folder)
+    return columns
+
+
+
+def _read_jsonl_profile(path):
+    """ Parse the records of a JSON Lines profile. """
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # A record may be only partly written.
+                continue
+
+
+
+def _read_tsv_profile(path, pipeline):
+    """ Parse what can be had from the records of a TSV profile. """
+    with open(path) as f:
+        for line in f:
+            if line.startswith("#") or not line.strip():
+                continue
+            fields = [x.strip() for x in line.split("\t")]
+            try:
+                record = {"pipeline": pipeline, "command": fields[0],
+                          "lock_name": None if fields[1] == "None" else fields[1],
+                          "wall": _parse_duration(fields[2]),
+                          "peak_mem": float(fields[3])}
+            except (IndexError, ValueError):
+                continue
+            if len(fields) > 4:
+                # CPU time isn't split into user and system here.
+                record["cpu_user"] = float(fields[4])
+            yield record
+
+
+
+def _parse_duration(text):
+    """ Convert a printed timedelta (e.g. '1 day, 2:03:04.5') to seconds. """
+    match = re.match(r"(?:(-?\d+) days?, )?(\d+):(\d+):(\d+(?:\.\d*)?)$", text)
+    if not match:
+        raise ValueError("Not a duration: '{}'".format(text))
+    days, hours, minutes, seconds = match.groups()
+    return int(days or 0) * 86400 + int(hours) * 3600 + \
+        int(minutes) * 60 + float(seconds)
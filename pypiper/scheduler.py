@@ -0,0 +1,120 @@
+""" Admission of commands within a pipeline's core and memory budget """
+
+from collections import deque
+from contextlib import contextmanager
+import threading
+
+
+__all__ = ["ResourcePool", "parse_mem"]
+
+
+
+# Multipliers to megabytes for memory size suffixes.
+_MEM_UNITS = {"k": 1.0 / 1024, "m": 1, "g": 1024, "t": 1024 ** 2}
+
+
+
+class ResourcePool(object):
+    """
+    Budget of cores and memory shared by concurrently running commands.
+
+    Each command reserves the cores and memory it needs before it starts
+    and returns them when it's done. Requests are admitted in the order in
+    which they're made, so a large request isn't starved by a stream of
+    smaller ones that keep fitting into the remaining space. A request for
+    more than the whole budget is trimmed to the budget, meaning that it
+    runs by itself rather than never at all.
+
+    :param int cores: total number of cores available
+    :param float mem: total memory available, in megabytes
+    """
+
+    def __init__(self, cores, mem):
+        self.cores = int(cores)
+        self.mem = float(mem)
+        self.free_cores = self.cores
+        self.free_mem = self.mem
+        self._queue = deque()
+        self._changed = threading.Condition()
+
+
+    def __repr__(self):
+        return "{}: {}/{} cores, {}/{} MB free".format(
+            self.__class__.__name__, self.free_cores, self.cores,
+            self.free_mem, self.mem)
+
+
+    def acquire(self, cores=1, mem=0, blocking=True):
+        """
+        Reserve cores and memory, waiting until they're available.
+
+        :param int cores: number of cores needed
+        :param float mem: amount of memory needed, in megabytes
+        :param bool blocking: whether to wait for the resources to become
+            available, rather than giving up right away if they're not
+        :return (int, float) | NoneType: cores and memory reserved, to be
+            passed to release(); null if not blocking and resources are short
+        """
+        cores, mem = min(int(cores), self.cores), min(float(mem), self.mem)
+        ticket = object()
+        with self._changed:
+            self._queue.append(ticket)
+            try:
+                while self._queue[0] is not ticket or \
+                        cores > self.free_cores or mem > self.free_mem:
+                    if not blocking:
+                        return None
+                    self._changed.wait()
+            finally:
+                self._queue.remove(ticket)
+                # Whoever is next in line may be able to go now.
+                self._changed.notify_all()
+            self.free_cores -= cores
+            self.free_mem -= mem
+        return cores, mem
+
+
+    def release(self, reserved):
+        """
+        Return reserved cores and memory to the pool.
+
+        :param (int, float) reserved: cores and memory, as from acquire()
+        """
+        cores, mem = reserved
+        with self._changed:
+            self.free_cores += cores
+            self.free_mem += mem
+            self._changed.notify_all()
+
+
+    @contextmanager
+    def reserve(self, cores=1, mem=0):
+        """
+        Hold cores and memory for the duration of a context.
+
+        :param int cores: number of cores needed
+        :param float mem: amount of memory needed, in megabytes
+        """
+        reserved = self.acquire(cores, mem)
+        try:
+            yield reserved
+        finally:
+            self.release(reserved)
+
+
+
+def parse_mem(mem):
+    """
+    Determine a number of megabytes from a memory specification.
+
+    :param int | float | str mem: amount of memory, in megabytes if a plain
+        number, or as text with a unit suffix, e.g. '4000m' or '8G'
+    :return float: amount of memory, in megabytes
+    :raise ValueError: if the memory specification can't be interpreted
+    """
+    if isinstance(mem, (int, float)):
+        return float(mem)
+    text = str(mem).strip().lower().rstrip("b")
+    if text and text[-1] in _MEM_UNITS:
+        return float(text[:-1]) * _MEM_UNITS[text[-1]]
+    return float(text)
@@ -0,0 +1,1151 @@
+""" Reading of sequencing data files (SAM/BAM) without external tools """
+
+import binascii
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import gzip
+import hashlib
+import math
+import mmap
+import os
+import struct
+import subprocess
+import sys
+import threading
+import zlib
+if sys.version_info < (3, 3):
+    from backports.functools_lru_cache import lru_cache
+    from distutils.spawn import find_executable as which
+    import Queue as queue
+    from string import maketrans
+else:
+    from functools import lru_cache
+    import queue
+    from shutil import which
+    maketrans = bytes.maketrans
+
+
+__all__ = ["FastqStats", "FlagCounts", "UniqueCounter", "bam_to_fastq",
+           "count_flags", "count_lines", "count_unique_names", "fastq_stats",
+           "inflate_bgzf", "split_fastq"]
+
+
+
+# SAM flag bits
+PAIRED = 0x1
+PROPER_PAIR = 0x2
+UNMAPPED = 0x4
+MATE_UNMAPPED = 0x8
+REVERSE = 0x10
+MATE_REVERSE = 0x20
+READ1 = 0x40
+READ2 = 0x80
+SECONDARY = 0x100
+QC_FAIL = 0x200
+DUPLICATE = 0x400
+SUPPLEMENTARY = 0x800
+
+# Number of BGZF blocks to decompress at a time, per worker
+_BLOCKS_PER_WORKER = 16
+
+# Number of bytes to read from a file at a time
+_READ_SIZE = 1 << 22
+
+# Size above which an uncompressed file's lines are counted in parallel
+_PARALLEL_MIN_SIZE = 1 << 26
+
+# A BAM record's length, then (14 bytes on) its flag
+_RECORD_HEAD = struct.Struct("<i14xH")
+# A BAM record's length, its name's length (8 bytes on), and its flag
+_RECORD_NAME_HEAD = struct.Struct("<i8xB5xH")
+_INT = struct.Struct("<i")
+# The first 8 bytes of a digest, as a number
+_HASH = struct.Struct("<Q")
+# A BAM record's length, its name's length, its number of CIGAR operations,
+# its flag, and its sequence's length, up to its name
+_RECORD_FIELDS = struct.Struct("<i8xB3xHHi12x")
+
+# Bases by their BAM code, as hexadecimal digits
+_BASES = maketrans(b"0123456789abcdef", b"=ACMGRSVTWYHKDBN")
+_COMPLEMENT = maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+# Quality characters by their BAM value (Phred+33)
+_PHRED = bytes(bytearray((i + 33) % 256 for i in range(256)))
+# Quality for bases that have none (as samtools fastq)
+_DEFAULT_QUALITY = b'"'
+
+# Number of unmatched mates held while looking for their mates
+_MAX_PENDING_MATES = 1000000
+
+
+
+class FlagCounts(object):
+    """
+    Tally of the reads in an alignment file by their SAM flag.
+
+    Any count that samtools view -c could give with flag filters (-f/-F)
+    can be had from the tally, so many counts take a single pass over the
+    file.
+
+    :param Mapping[int, int] by_flag: Number of reads with each flag value
+    """
+
+    __slots__ = ("by_flag",)
+
+    def __init__(self, by_flag):
+        self.by_flag = {flag: n for flag, n in by_flag.items() if n}
+
+
+    def __repr__(self):
+        return "{}(total={}, mapped={})".format(
+            self.__class__.__name__, self.total, self.mapped)
+
+
+    def count(self, require=0, exclude=0):
+        """
+        Count the reads with some flag bits set and others not.
+
+        :param int require: Bits that must all be set (as samtools view -f)
+        :param int exclude: Bits that must all be unset (as samtools view -F)
+        :return int: Number of reads whose flag qualifies
+        """
+        return sum(n for flag, n in self.by_flag.items()
+                   if flag & require == require and not flag & exclude)
+
+
+    @property
+    def total(self):
+        """ Number of records, including secondary and supplementary ones """
+        return self.count()
+
+
+    @property
+    def mapped(self):
+        return self.count(exclude=UNMAPPED)
+
+
+    @property
+    def unmapped(self):
+        return self.count(require=UNMAPPED)
+
+
+    @property
+    def primary(self):
+        """ Number of records other than secondary and supplementary ones """
+        return self.count(exclude=SECONDARY | SUPPLEMENTARY)
+
+
+    @property
+    def primary_mapped(self):
+        return self.count(exclude=UNMAPPED | SECONDARY | SUPPLEMENTARY)
+
+
+    @property
+    def secondary(self):
+        return self.count(require=SECONDARY)
+
+
+    @property
+    def supplementary(self):
+        return self.count(require=SUPPLEMENTARY)
+
+
+    @property
+    def qc_fail(self):
+        return self.count(require=QC_FAIL)
+
+
+    @property
+    def duplicates(self):
+        return self.count(require=DUPLICATE)
+
+
+    @property
+    def paired(self):
+        return self.count(require=PAIRED)
+
+
+    @property
+    def properly_paired(self):
+        return self.count(require=PAIRED | PROPER_PAIR)
+
+
+    @property
+    def read1(self):
+        return self.count(require=PAIRED | READ1)
+
+
+    @property
+    def read2(self):
+        return self.count(require=PAIRED | READ2)
+
+
+    def as_dict(self):
+        """
+        Provide the named counts.
+
+        :return dict[str, int]: Each named count (e.g., 'mapped'), by name
+        """
+        names = ["total", "mapped", "unmapped", "primary", "primary_mapped",
+                 "secondary", "supplementary", "qc_fail", "duplicates",
+                 "paired", "properly_paired", "read1", "read2"]
+        return {name: getattr(self, name) for name in names}
+
+
+
+def count_flags(file_name, workers=1):
+    """
+    Tally the reads in a SAM or BAM file by flag, in a single pass.
+
+    BAM files are read natively: their compressed (BGZF) blocks are
+    decompressed by a pool of threads while the records are tallied. Tallies
+    are remembered for recently counted files, for as long as they're
+    unchanged, so that several counts of the same file need only one pass.
+
+    :param str file_name: Path to the SAM or BAM file.
+    :param int workers: Number of threads with which to decompress a BAM
+    :return FlagCounts: Tally of the file's reads
+    :raise ValueError: If the file isn't SAM or BAM.
+    """
+    info = os.stat(file_name)
+    return _count_flags(os.path.realpath(file_name), info.st_mtime,
+                        info.st_size, max(1, int(workers)))
+
+
+
+@lru_cache(maxsize=16)
+def _count_flags(path, mtime, size, workers):
+    """ Tally a file's reads; the file's state is part of the cache key. """
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic[:2] == b"\x1f\x8b":
+        return FlagCounts(_bam_flags(path, workers))
+    if path.lower().endswith(".sam"):
+        return FlagCounts(_sam_flags(path))
+    raise ValueError("Not a SAM or BAM: '{}'".format(path))
+
+
+
+def _sam_flags(path):
+    """ Tally a SAM file's reads by flag. """
+    counts = [0] * 65536
+    with open(path, "rb") as f:
+        for line in f:
+            if line.startswith(b"@"):
+                continue
+            fields = line.split(b"\t", 2)
+            if len(fields) > 2:
+                counts[int(fields[1])] += 1
+    return dict(enumerate(counts))
+
+
+
+def _bam_flags(path, workers):
+    """ Tally a BAM file's reads by flag. """
+    counts = [0] * 65536
+    unpack = _RECORD_HEAD.unpack_from
+    for data, offset, end in _bam_record_spans(path, workers):
+        while offset < end:
+            size, flag = unpack(data, offset)
+            counts[flag] += 1
+            offset += 4 + size
+    return dict(enumerate(counts))
+
+
+
+def _bam_record_spans(path, workers):
+    """
+    Decompress a BAM file's records, in spans of whole records.
+
+    :param str path: Path to the BAM file.
+    :param int workers: Number of threads with which to decompress
+    :return Iterable[(bytes, int, int)]: Data, and the start and end within
+        it of a series of whole records
+    :raise ValueError: If the file isn't BAM, or is truncated
+    """
+    data = b""
+    offset = 0
+    in_header = True
+    for chunk in inflate_bgzf(path, workers):
+        data = data[offset:] + chunk if offset < len(data) else chunk
+        offset = 0
+        if in_header:
+            offset = _skip_header(data)
+            if offset is None:
+                # The header continues in the next block.
+                offset = 0
+                continue
+            in_header = False
+        start = offset
+        end = len(data)
+        unpack = _INT.unpack_from
+        while offset + 4 <= end:
+            size = unpack(data, offset)[0]
+            if offset + 4 + size > end:
+                break
+            offset += 4 + size
+        if offset > start:
+            yield data, start, offset
+    if in_header or offset < len(data):
+        raise ValueError("Truncated BAM file: '{}'".format(path))
+
+
+
+class UniqueCounter(object):
+    """
+    Counter of distinct values (e.g., read names) in a stream.
+
+    Values are counted exactly, by keeping a set of their 64-bit hashes.
+    Only if asked, from the start or beyond a given number of distinct
+    values, they're counted approximately, with a HyperLogLog sketch of
+    fixed size (relative error about 1.04 / sqrt(2 ** precision), e.g.
+    under 1% by default), so that memory is bounded. Hashes are digests of
+    the values, rather than Python's hashes (which vary from process to
+    process), so counts and estimates are the same from run to run.
+
+    :param int max_exact: Number of distinct values beyond which counting
+        becomes approximate (the set of hashes takes about 70 bytes per
+        value); null (the default) for no limit
+    :param bool approximate: Whether to count approximately from the start
+    :param int precision: Number of bits of each hash that select a register
+        of the sketch (4 to 18); there are 2 ** precision registers
+    """
+
+    __slots__ = ("max_exact", "precision", "_hashes", "_registers")
+
+    def __init__(self, max_exact=None, approximate=False,
+                 precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError("Precision must be from 4 to 18: {}".format(
+                precision))
+        self.max_exact = max_exact
+        self.precision = precision
+        self._hashes = None if approximate else set()
+        self._registers = bytearray(1 << precision) if approximate else None
+
+
+    @property
+    def exact(self):
+        """ Whether the count is exact """
+        return self._hashes is not None
+
+
+    def add(self, value):
+        """
+        Count a value.
+
+        :param bytes value: Value to count
+        """
+        h = _HASH.unpack_from(hashlib.md5(value).digest())[0]
+        if self._hashes is not None:
+            self._hashes.add(h)
+            if self.max_exact is not None and \
+                    len(self._hashes) > self.max_exact:
+                self._to_sketch()
+        else:
+            self._sketch(h)
+
+
+    def count(self):
+        """
+        Count the distinct values seen.
+
+        :return int: Number of distinct values, exact or estimated
+        """
+        if self._hashes is not None:
+            return len(self._hashes)
+        m = len(self._registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self._registers)
+        zeros = self._registers.count(b"\0")
+        if estimate <= 2.5 * m and zeros:
+            # Few values: linear counting is more accurate.
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+    def _to_sketch(self):
+        """ Switch from exact to approximate counting. """
+        self._registers = bytearray(1 << self.precision)
+        for h in self._hashes:
+            self._sketch(h)
+        self._hashes = None
+
+
+    def _sketch(self, h):
+        """ Add a hash to the HyperLogLog registers. """
+        p = self.precision
+        index = h & ((1 << p) - 1)
+        rank = 64 - p - (h >> p).bit_length() + 1
+        if rank > self._registers[index]:
+            self._registers[index] = rank
+
+
+
+def count_unique_names(file_name, paired_end=False, exclude=0, workers=1,
+                       max_exact=None, approximate=False):
+    """
+    Count distinct read names in a SAM or BAM file, in a single pass.
+
+    A read that's present several times (e.g., aligned to several places)
+    counts once. For paired-end data, names are counted separately among
+    first and among second reads of pairs, as both are counted in the same
+    pass. Counts are exact unless asked to be estimated, to bound memory use
+    for very large files; see UniqueCounter.
+
+    :param str file_name: Path to the SAM or BAM file.
+    :param bool paired_end: Whether to count first and second reads of pairs
+        separately, rather than all reads together
+    :param int exclude: Flag bits of records to skip (as samtools view -F),
+        e.g. 4 to count only mapped reads
+    :param int workers: Number of threads with which to decompress a BAM
+    :param int max_exact: Number of distinct names per count beyond which
+        counting becomes approximate; null (the default) for no limit
+    :param bool approximate: Whether to count approximately from the start
+    :return (int, int, bool): Number of distinct names among first reads (or
+        all reads, if not paired-end) and among second reads (0 if not
+        paired-end), and whether the counts are exact
+    """
+    counters = [UniqueCounter(max_exact, approximate) for _ in range(2)]
+    if paired_end:
+        # Like -f64 and -f128; reads of neither kind aren't counted.
+        by_flag = [counters[0] if flag & READ1 else
+                   counters[1] if flag & READ2 else None
+                   for flag in range(65536)]
+    else:
+        by_flag = [counters[0]] * 65536
+    by_flag = [None if flag & exclude else counter
+               for flag, counter in enumerate(by_flag)]
+    with open(file_name, "rb") as f:
+        bam = f.read(2) == b"\x1f\x8b"
+    if bam:
+        unpack = _RECORD_NAME_HEAD.unpack_from
+        for data, offset, end in _bam_record_spans(file_name, workers):
+            while offset < end:
+                size, name_length, flag = unpack(data, offset)
+                counter = by_flag[flag]
+                if counter is not None:
+                    counter.add(data[offset + 36:offset + 35 + name_length])
+                offset += 4 + size
+    else:
+        with open(file_name, "rb") as f:
+            for line in f:
+                if line.startswith(b"@"):
+                    continue
+                fields = line.split(b"\t", 2)
+                if len(fields) < 3:
+                    continue
+                counter = by_flag[int(fields[1])]
+                if counter is not None:
+                    counter.add(fields[0])
+    r1, r2 = counters
+    return r1.count(), r2.count() if paired_end else 0, r1.exact and r2.exact
+
+
+
+def bam_to_fastq(file_name, fastq1, fastq2=None, singletons=None, workers=1,
+                 max_pending=_MAX_PENDING_MATES):
+    """
+    Convert a BAM file's reads to FASTQ, in a single pass.
+
+    Secondary and supplementary alignments are skipped, and reads aligned to
+    the reverse strand are reverse-complemented, as by samtools fastq. Given
+    a second output, the reads are paired: each read's mate needn't follow
+    it, as unmatched mates are held (up to a limit) until their mates are
+    found. A read whose mate isn't found is a singleton, and is written to
+    its own output, if there's one. Outputs whose names end in .gz are
+    compressed as they're written: with pigz if it's available and more
+    than one worker is allowed, otherwise in a thread of their own.
+
+    :param str file_name: Path to the BAM file.
+    :param str fastq1: Path to the FASTQ file for all reads, or for first
+        reads if paired.
+    :param str fastq2: Path to the FASTQ file for second reads, to pair them.
+    :param str singletons: Path to the FASTQ file for reads whose mates
+        weren't found; by default, they're not written.
+    :param int workers: Number of threads with which to decompress the BAM,
+        and compress each output
+    :param int max_pending: Maximum number of reads to hold while looking
+        for their mates; beyond that, the longest held is a singleton.
+    :return dict[str, int]: Number of 'reads' (primary, i.e. not secondary
+        or supplementary), of those that are 'qc_failed', of 'pairs' and
+        'singletons' (if paired), and of reads 'written' to the outputs
+    :raise ValueError: If the file isn't BAM, or is truncated
+    """
+    counts = {"reads": 0, "qc_failed": 0, "pairs": 0, "singletons": 0,
+              "written": 0}
+    paths = [fastq1, fastq2, singletons]
+    outputs = [None if path is None else _FastqOutput(path, workers)
+               for path in paths]
+    try:
+        _convert_bam(file_name, outputs, workers, max_pending, counts)
+    finally:
+        for output in outputs:
+            if output is not None:
+                output.close()
+    return counts
+
+
+
+def _convert_bam(path, outputs, workers, max_pending, counts):
+    """ Write a BAM file's reads as FASTQ, tallying them. """
+    out1, out2, out_single = outputs
+    paired = out2 is not None
+    # Reads held until their mates are found, by name, oldest first; unlike
+    # a dict's, an OrderedDict's oldest item is removed in constant time.
+    pending = OrderedDict()
+    unpack = _RECORD_FIELDS.unpack_from
+    for data, offset, end in _bam_record_spans(path, workers):
+        reads1, reads2, unpaired = [], [], []
+        while offset < end:
+            size, name_length, cigar_ops, flag, length = unpack(data, offset)
+            start = offset
+            offset += 4 + size
+            if flag & (SECONDARY | SUPPLEMENTARY):
+                continue
+            counts["reads"] += 1
+            if flag & QC_FAIL:
+                counts["qc_failed"] += 1
+            name = data[start + 36:start + 35 + name_length]
+            seq_start = start + 36 + name_length + 4 * cigar_ops
+            qual_start = seq_start + (length + 1) // 2
+            seq = binascii.hexlify(data[seq_start:qual_start]).translate(
+                _BASES)[:length]
+            qual = data[qual_start:qual_start + length]
+            if qual[:1] == b"\xff":
+                qual = _DEFAULT_QUALITY * length
+            else:
+                qual = qual.translate(_PHRED)
+            if flag & REVERSE:
+                seq = seq[::-1].translate(_COMPLEMENT)
+                qual = qual[::-1]
+            if not paired:
+                reads1.append(b"@" + name + b"\n" + seq + b"\n+\n" + qual +
+                              b"\n")
+                continue
+            second = bool(flag & READ2)
+            record = b"@" + name + (b"/2\n" if second else b"/1\n") + seq + \
+                b"\n+\n" + qual + b"\n"
+            if not flag & PAIRED:
+                unpaired.append(record)
+                continue
+            mate = pending.pop(name, None)
+            if mate is None or mate[0] == second:
+                if mate is not None:
+                    unpaired.append(mate[1])
+                pending[name] = (second, record)
+                if len(pending) > max_pending:
+                    unpaired.append(pending.popitem(last=False)[1][1])
+                continue
+            counts["pairs"] += 1
+            reads1.append(mate[1] if second else record)
+            reads2.append(record if second else mate[1])
+        out1.write(b"".join(reads1))
+        counts["written"] += len(reads1) + len(reads2)
+        if paired:
+            out2.write(b"".join(reads2))
+            counts["singletons"] += len(unpaired)
+            if out_single is not None:
+                out_single.write(b"".join(unpaired))
+                counts["written"] += len(unpaired)
+    if pending:
+        counts["singletons"] += len(pending)
+        if out_single is not None:
+            out_single.write(b"".join(read[1] for read in pending.values()))
+            counts["written"] += len(pending)
+
+
+
+class _FastqOutput(object):
+    """ A file being written, compressed if its name ends in .gz """
+
+    def __init__(self, path, workers):
+        self.path = path
+        self._proc = None
+        self._pool = None
+        self._pending = None
+        if not path.endswith(".gz"):
+            self._file = open(path, "wb", _READ_SIZE)
+            return
+        pigz = which("pigz") if workers > 1 else None
+        if pigz is not None:
+            with open(path, "wb") as f:
+                self._proc = subprocess.Popen(
+                    [pigz, "-c", "-p", str(workers)], stdin=subprocess.PIPE,
+                    stdout=f)
+            self._file = self._proc.stdin
+        else:
+            self._file = gzip.open(path, "wb", compresslevel=6)
+            # Compression releases the GIL, so it overlaps with conversion.
+            self._pool = ThreadPoolExecutor(max_workers=1)
+
+
+    def write(self, data):
+        if self._pool is None:
+            self._file.write(data)
+            return
+        if self._pending is not None:
+            self._pending.result()
+        self._pending = self._pool.submit(self._file.write, data)
+
+
+    def close(self):
+        try:
+            if self._pending is not None:
+                self._pending.result()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._file.close()
+        if self._proc is not None and self._proc.wait() != 0:
+            raise IOError("pigz failed to compress '{}'".format(self.path))
+
+
+
+def count_lines(file_name, workers=1):
+    """
+    Count the lines in a file, which may be gzipped (e.g., FASTQ.gz).
+
+    An uncompressed file is memory-mapped rather than read, so no process is
+    forked and its data isn't copied into buffers of its own; if NumPy is
+    available and the file's large, parts of it are counted by a pool of
+    threads. A BGZF file (as from bgzip) has its blocks decompressed and
+    counted by a pool of threads. Any other gzipped file is one compressed
+    stream, so it's decompressed as it's read, by pigz if it's available and
+    more than one worker is allowed (pigz does its reading, writing, and
+    checking in threads of their own), or natively. Newlines are counted
+    with a single scan of each chunk of bytes.
+
+    :param str file_name: Path to the file.
+    :param int workers: Number of threads with which to decompress
+    :return int: Number of lines (newline characters) in the file
+    """
+    with open(file_name, "rb") as f:
+        head = f.read(18)
+    if head[:2] != b"\x1f\x8b":
+        return _count_mapped_lines(file_name, workers)
+    if _is_bgzf(head):
+        blocks = _bgzf_blocks(file_name)
+        if workers <= 1:
+            return sum(_inflate_count(block) for block in blocks)
+        total = 0
+        batch_size = workers * _BLOCKS_PER_WORKER
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            batch = []
+            for block in blocks:
+                batch.append(block)
+                if len(batch) == batch_size:
+                    total += sum(pool.map(_inflate_count, batch))
+                    batch = []
+            total += sum(pool.map(_inflate_count, batch))
+        return total
+    return _count_newlines(_gzip_chunks(file_name, workers))
+
+
+
+def _count_newlines(chunks):
+    return sum(chunk.count(b"\n") for chunk in chunks)
+
+
+
+def _count_mapped_lines(path, workers):
+    """ Count the newlines in an uncompressed file, by mapping it. """
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return 0
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        try:
+            import numpy
+        except ImportError:
+            # Slices of the map are taken straight from the page cache; the
+            # counting holds the GIL, so there's nothing to gain from threads.
+            return sum(mapped[start:start + _READ_SIZE].count(b"\n")
+                       for start in range(0, size, _READ_SIZE))
+        # Each span is viewed as an array only while it's counted, since the
+        # map can't be closed while an array refers to it.
+        count = functools.partial(_count_array_newlines, mapped, size)
+        starts = range(0, size, _READ_SIZE)
+        if workers <= 1 or size < _PARALLEL_MIN_SIZE:
+            return sum(map(count, starts))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return sum(pool.map(count, starts))
+    finally:
+        mapped.close()
+
+
+
+def _count_array_newlines(mapped, size, start):
+    """ Count the newlines in a span of a mapped file, as an array. """
+    import numpy as np
+    return int(np.count_nonzero(np.frombuffer(
+        mapped, dtype=np.uint8, count=min(_READ_SIZE, size - start),
+        offset=start) == 10))
+
+
+
+class FastqStats(object):
+    """
+    Statistics of the reads in a FASTQ file.
+
+    Per-position and per-length values are NumPy arrays if NumPy is
+    available, and lists otherwise.
+
+    :param int reads: Number of reads
+    :param int gc: Number of G and C bases
+    :param Mapping[int, int] lengths: Number of reads of each length
+    :param Sequence[int] quality_sums: Sum of the quality characters' codes
+        at each position
+    :param int offset: Code of the character for quality 0 (Phred+33)
+    """
+
+    def __init__(self, reads, gc, lengths, quality_sums, offset=33):
+        self.reads = reads
+        self.gc = gc
+        self.lengths = dict(lengths)
+        self.quality_sums = list(quality_sums)
+        self.offset = offset
+
+
+    def __repr__(self):
+        return "{}(reads={}, bases={})".format(
+            self.__class__.__name__, self.reads, self.bases)
+
+
+    @property
+    def bases(self):
+        """ Total length of the reads """
+        return sum(length * n for length, n in self.lengths.items())
+
+
+    @property
+    def gc_fraction(self):
+        """ Fraction of bases that are G or C """
+        return float(self.gc) / self.bases if self.bases else 0.0
+
+
+    @property
+    def mean_length(self):
+        """ Mean length of the reads """
+        return float(self.bases) / self.reads if self.reads else 0.0
+
+
+    @property
+    def length_histogram(self):
+        """ Number of reads of each length, indexed by length """
+        counts = [0] * (max(self.lengths) + 1 if self.lengths else 0)
+        for length, n in self.lengths.items():
+            counts[length] = n
+        return _array(counts)
+
+
+    @property
+    def mean_quality(self):
+        """ Mean (Phred) quality at each position, of reads that long """
+        # Reads covering each position: those longer than the position
+        covering = []
+        remaining = self.reads
+        for n in self.length_histogram[:len(self.quality_sums)]:
+            remaining -= n
+            covering.append(remaining)
+        return _array([float(total) / n - self.offset
+                       for total, n in zip(self.quality_sums, covering)])
+
+
+    def as_dict(self):
+        """
+        Provide the summary statistics.
+
+        :return dict[str, int | float]: Each statistic (e.g., 'bases'), by
+            name
+        """
+        names = ["reads", "bases", "mean_length", "gc_fraction"]
+        return {name: getattr(self, name) for name in names}
+
+
+
+def fastq_stats(file_name, workers=1):
+    """
+    Gather statistics of the reads in a FASTQ file, in a single pass.
+
+    The file may be gzipped, and is decompressed as for count_lines. It's
+    read in large chunks, and each chunk's reads are tallied together, with
+    reads of the same length having their qualities summed as one array if
+    NumPy is available. Statistics are remembered for recently read files,
+    for as long as they're unchanged.
+
+    :param str file_name: Path to the FASTQ file.
+    :param int workers: Number of threads with which to decompress
+    :return FastqStats: Statistics of the file's reads
+    :raise ValueError: If the file's last record is incomplete.
+    """
+    info = os.stat(file_name)
+    return _fastq_stats(os.path.realpath(file_name), info.st_mtime,
+                        info.st_size, max(1, int(workers)))
+
+
+
+@lru_cache(maxsize=16)
+def _fastq_stats(path, mtime, size, workers):
+    """ Gather a file's statistics; its state is part of the cache key. """
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    reads = 0
+    gc = 0
+    lengths = {}
+    quality_sums = []
+    for seqs, quals in _fastq_records(_decompressed_chunks(path, workers),
+                                      path):
+        reads += len(seqs)
+        bases = b"".join(seqs)
+        gc += bases.count(b"G") + bases.count(b"C") + \
+            bases.count(b"g") + bases.count(b"c")
+        by_length = {}
+        for qual in quals:
+            by_length.setdefault(len(qual), []).append(qual)
+        for length, same in by_length.items():
+            lengths[length] = lengths.get(length, 0) + len(same)
+            if length > len(quality_sums):
+                quality_sums.extend([0] * (length - len(quality_sums)))
+            if np is None:
+                sums = [sum(column)
+                        for column in zip(*map(bytearray, same))]
+            else:
+                sums = np.frombuffer(b"".join(same), dtype=np.uint8).reshape(
+                    len(same), length).sum(axis=0, dtype=np.int64).tolist()
+            for i, total in enumerate(sums):
+                quality_sums[i] += total
+    return FastqStats(reads, gc, lengths, quality_sums)
+
+
+
+def _fastq_records(chunks, path):
+    """
+    Split FASTQ data into records, a chunk at a time.
+
+    :param Iterable[bytes] chunks: Consecutive parts of the file's data
+    :param str path: Path to the file, for error messages
+    :return Iterable[(list[bytes], list[bytes])]: Sequences and qualities of
+        the complete records in each chunk
+    """
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        # All but the last line are complete.
+        end = (len(lines) - 1) // 4 * 4
+        if end:
+            yield lines[1:end:4], lines[3:end:4]
+        rest = b"\n".join(lines[end:])
+    lines = rest.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    if len(lines) == 4:
+        yield lines[1:2], lines[3:4]
+    elif lines:
+        raise ValueError("Truncated FASTQ file: '{}'".format(path))
+
+
+
+def split_fastq(file_name, fastq1, fastq2, workers=1):
+    """
+    Split an interleaved FASTQ file into first and second reads.
+
+    The file may be gzipped; it's decompressed (as for count_lines) in a
+    thread of its own, while the records decompressed so far are split.
+    Each chunk's records are written to each output at once. Outputs whose
+    names end in .gz are compressed as they're written, as by bam_to_fastq.
+
+    :param str file_name: Path to the FASTQ file, in which each read is
+        followed by its mate.
+    :param str fastq1: Path to the FASTQ file for first reads.
+    :param str fastq2: Path to the FASTQ file for second reads.
+    :param int workers: Number of threads with which to decompress the
+        input, and compress each output
+    :return dict[str, int]: Number of 'pairs', and of 'reads' (two per pair)
+    :raise ValueError: If the file's last pair of records is incomplete.
+    """
+    outputs = [_FastqOutput(fastq1, workers), _FastqOutput(fastq2, workers)]
+    try:
+        pairs = _split_mates(
+            _prefetch(_decompressed_chunks(file_name, workers)), outputs,
+            file_name)
+    finally:
+        for output in outputs:
+            output.close()
+    return {"pairs": pairs, "reads": 2 * pairs}
+
+
+
+def _split_mates(chunks, outputs, path):
+    """ Write alternate FASTQ records to two outputs; count the pairs. """
+    pairs = 0
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        # All but the last line are complete.
+        end = (len(lines) - 1) // 8 * 8
+        if end:
+            _write_mates(lines, end, outputs)
+            pairs += end // 8
+        rest = b"\n".join(lines[end:])
+    lines = rest.split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    if len(lines) == 8:
+        _write_mates(lines, 8, outputs)
+        pairs += 1
+    elif lines:
+        raise ValueError("Incomplete pair of FASTQ records at the end of "
+                         "'{}'".format(path))
+    return pairs
+
+
+
+def _write_mates(lines, end, outputs):
+    """ Write the records in lines, alternately to each of two outputs. """
+    for mate, output in enumerate(outputs):
+        records = [None] * (end // 2)
+        for i in range(4):
+            records[i::4] = lines[4 * mate + i:end:8]
+        records.append(b"")
+        output.write(b"\n".join(records))
+
+
+
+# Marks the end of prefetched chunks
+_END = object()
+
+
+
+def _prefetch(chunks, depth=4):
+    """
+    Produce chunks in a thread of their own, a few ahead of their use.
+
+    :param Iterable[bytes] chunks: Chunks to produce
+    :param int depth: Maximum number of chunks produced but not yet used
+    :return Iterable[bytes]: The chunks, in order
+    """
+    ready = queue.Queue(depth)
+    stopped = threading.Event()
+
+    def put(item):
+        # Give up if the chunks are no longer wanted.
+        while not stopped.is_set():
+            try:
+                ready.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put((chunk, None)):
+                    return
+            put((_END, None))
+        except Exception as e:
+            put((_END, e))
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk, error = ready.get()
+            if error is not None:
+                raise error
+            if chunk is _END:
+                return
+            yield chunk
+    finally:
+        stopped.set()
+        thread.join()
+
+
+
+def _array(values):
+    """ Make a NumPy array of values, if NumPy is available. """
+    try:
+        import numpy as np
+    except ImportError:
+        return values
+    return np.array(values)
+
+
+
+def _decompressed_chunks(path, workers):
+    """ Read a file, which may be gzipped, in decompressed chunks. """
+    with open(path, "rb") as f:
+        head = f.read(18)
+    if head[:2] != b"\x1f\x8b":
+        return _read_chunks(path)
+    if _is_bgzf(head):
+        return inflate_bgzf(path, workers)
+    return _gzip_chunks(path, workers)
+
+
+
+def _gzip_chunks(path, workers):
+    """ Decompress a gzipped file in chunks, with pigz if allowed. """
+    pigz = which("pigz") if workers > 1 else None
+    if pigz is None:
+        for chunk in _gunzip_chunks(path):
+            yield chunk
+        return
+    proc = subprocess.Popen([pigz, "-dc", "-p", str(workers), path],
+                            stdout=subprocess.PIPE)
+    try:
+        for chunk in iter(functools.partial(
+                proc.stdout.read, _READ_SIZE), b""):
+            yield chunk
+    finally:
+        proc.stdout.close()
+    if proc.wait() != 0:
+        raise IOError("pigz failed to decompress '{}'".format(path))
+
+
+
+def _read_chunks(path):
+    """ Read a file in large chunks. """
+    with open(path, "rb") as f:
+        for chunk in iter(functools.partial(f.read, _READ_SIZE), b""):
+            yield chunk
+
+
+
+def _gunzip_chunks(path):
+    """ Decompress a gzipped file, of one or more members, in chunks. """
+    decompressor = zlib.decompressobj(31)
+    for chunk in _read_chunks(path):
+        while chunk:
+            yield decompressor.decompress(chunk)
+            if not decompressor.unused_data:
+                break
+            # Another member follows (as from concatenated gzip files).
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(31)
+    yield decompressor.flush()
+
+
+
+def _is_bgzf(head):
+    """ Determine whether a file's first bytes start a BGZF block. """
+    try:
+        _block_size(head, 0, None)
+    except (ValueError, struct.error):
+        return False
+    return True
+
+
+
+def _inflate_count(block):
+    """ Count the newlines in a BGZF block. """
+    return _inflate(block).count(b"\n")
+
+
+
+def _skip_header(data):
+    """
+    Find where a BAM file's records start.
+
+    :param bytes data: Decompressed start of the file
+    :return int | NoneType: Offset of the first record, or null if the data
+        doesn't include the whole header
+    """
+    if data[:4] != b"BAM\1":
+        if len(data) < 4:
+            return None
+        raise ValueError("Not a BAM file")
+    try:
+        l_text = _INT.unpack_from(data, 4)[0]
+        offset = 8 + l_text
+        n_ref = _INT.unpack_from(data, offset)[0]
+        offset += 4
+        for _ in range(n_ref):
+            l_name = _INT.unpack_from(data, offset)[0]
+            offset += 4 + l_name + 4
+    except struct.error:
+        return None
+    return offset if offset <= len(data) else None
+
+
+
+def inflate_bgzf(path, workers=1):
+    """
+    Decompress a BGZF file (e.g., BAM), block by block.
+
+    :param str path: Path to the file.
+    :param int workers: Number of threads with which to decompress blocks
+    :return Iterable[bytes]: Content of each block, in order
+    """
+    blocks = _bgzf_blocks(path)
+    if workers <= 1:
+        for block in blocks:
+            yield _inflate(block)
+        return
+    batch_size = workers * _BLOCKS_PER_WORKER
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = []
+        for block in blocks:
+            batch.append(block)
+            if len(batch) == batch_size:
+                # Decompression releases the GIL, so blocks are decompressed
+                # in parallel; map keeps them in order.
+                for data in pool.map(_inflate, batch):
+                    yield data
+                batch = []
+        for data in pool.map(_inflate, batch):
+            yield data
+
+
+
+def _bgzf_blocks(path, read_size=_READ_SIZE):
+    """ Split a BGZF file into its compressed blocks. """
+    with open(path, "rb") as f:
+        data = b""
+        offset = 0
+        while True:
+            if len(data) - offset < 65536 + 18:
+                more = f.read(read_size)
+                data = data[offset:] + more
+                offset = 0
+                if not data:
+                    return
+            size = _block_size(data, offset, path)
+            if offset + size > len(data):
+                raise ValueError("Truncated BGZF file: '{}'".format(path))
+            yield data[offset:offset + size]
+            offset += size
+
+
+
+def _block_size(data, offset, path):
+    """ Read the total size of the BGZF block at an offset. """
+    if len(data) - offset < 18:
+        raise ValueError("Truncated BGZF file: '{}'".format(path))
+    if data[offset:offset + 4] != b"\x1f\x8b\x08\x04":
+        raise ValueError("Not a BGZF file: '{}'".format(path))
+    xlen = struct.unpack_from("<H", data, offset + 10)[0]
+    extra = offset + 12
+    end = extra + xlen
+    while extra + 4 <= end:
+        si1, si2, slen = struct.unpack_from("<BBH", data, extra)
+        if (si1, si2) == (66, 67):
+            return struct.unpack_from("<H", data, extra + 4)[0] + 1
+        extra += 4 + slen
+    raise ValueError("Not a BGZF file: '{}'".format(path))
+
+
+
+def _inflate(block):
+    """ Decompress a BGZF block. """
+    xlen = struct.unpack_from("<H", block, 10)[0]
+    return zlib.decompress(block[12 + xlen:-8], -15)
@@ -2,7 +2,7 @@
 
 import copy
 
-from .utils import translate_stage_name
+from .utils import parse_stage_name, translate_stage_name
 
 __author__ = "Vince Reuter"
 __email__ = "vreuter@virginia.edu"
@@ -20,15 +20,26 @@ class Stage(object):
 
 
     def __init__(self, func, f_args=None, f_kwargs=None,
-                 name=None, checkpoint=True):
+                 name=None, checkpoint=True, depends_on=None,
+                 inputs=None, outputs=None):
         """
         A function, perhaps with arguments, defines the stage.
 
+        A stage that declares neither dependencies nor inputs depends on the
+        one that precedes it in the pipeline's definition of its stages.
+
         :param callable func: The processing logic that defines the stage
         :param tuple f_args: Positional arguments for func
         :param dict f_kwargs: Keyword arguments for func
         :param str name: name for the phase/stage
         :param callable func: Object that defines how the stage will execute.
+        :param Iterable[str | Stage | callable] depends_on: stage(s) that
+            must be finished before this one may begin; empty for a stage
+            that depends on no other
+        :param Iterable[str] inputs: path(s) to file(s) that this stage uses;
+            this stage depends on any stage that declares one as an output
+        :param Iterable[str] outputs: path(s) to file(s) that this stage
+            produces
         """
         if isinstance(func, Stage):
             raise TypeError("Cannot create Stage from Stage")
@@ -38,6 +49,10 @@ class Stage(object):
         self.f_kwargs = f_kwargs or dict()
         self.name = name or func.__name__
         self.checkpoint = checkpoint
+        self.depends_on = None if depends_on is None else \
+            [parse_stage_name(s) for s in _as_list(depends_on)]
+        self.inputs = _as_list(inputs)
+        self.outputs = _as_list(outputs)
 
 
     @property
@@ -85,3 +100,13 @@ class Stage(object):
 
     def __str__(self):
         return "{}: '{}'".format(self.__class__.__name__, self.name)
+
+
+
+def _as_list(items):
+    """ Ensure a singleton or null specification is a list. """
+    if items is None:
+        return []
+    if isinstance(items, str) or not hasattr(items, "__iter__"):
+        return [items]
+    return list(items)
@@ -0,0 +1,198 @@
+""" Recording of pipeline results (stats and figures) """
+
+import math
+import os
+import threading
+
+
+__all__ = ["RecordWriter", "StatsStore", "parse_value"]
+
+
+
+class RecordWriter(object):
+    """
+    Appender of lines to a file that may be shared by several pipelines.
+
+    Each write is a single write(2) call on a file opened with O_APPEND,
+    which the system carries out as one indivisible append, so records from
+    concurrent writers never interleave and no lock file is needed. (On
+    network file systems, appends from different hosts aren't guaranteed to
+    be atomic, so pipelines sharing a results file across hosts should keep
+    to one writer per file.) With buffering, records are held in memory and
+    appended together on flush(), in a single write.
+
+    :param str path: Path to the file to which to append.
+    :param bool buffered: Whether to hold records until flush() is called,
+        rather than appending each one as it's written.
+    """
+
+    def __init__(self, path, buffered=False):
+        self.path = path
+        self.buffered = buffered
+        self._pending = []
+        self._lock = threading.Lock()
+
+
+    def write(self, record):
+        """
+        Add a record (line) to the file.
+
+        :param str record: Text of the record, without a line break.
+        """
+        with self._lock:
+            self._pending.append(record + "\n")
+            if not self.buffered:
+                self._flush()
+
+
+    def flush(self):
+        """ Append any records being held to the file. """
+        with self._lock:
+            self._flush()
+
+
+    def _flush(self):
+        if not self._pending:
+            return
+        data = "".join(self._pending).encode("utf-8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+        self._pending = []
+
+
+
+class StatsStore(object):
+    """
+    Index of a pipeline's reported stats, kept current with the stats file.
+
+    Stats are held in memory, keyed by name. The stats file is read
+    incrementally: the store remembers how far into the file it's read, and
+    a reload parses only what's been appended since, starting over only if
+    the file's been replaced or truncated. A lookup of a stat that's not
+    known costs a reload only if the file has changed since the stat was
+    last found to be absent.
+
+    :param str path: Path to the stats file.
+    :param Iterable[str] annotations: Annotations of the stats in the file
+        that are visible to this store, e.g. the pipeline's name and 'shared'
+    """
+
+    def __init__(self, path, annotations):
+        self.path = path
+        self.annotations = set(annotations)
+        self.values = {}
+        self._absent = set()
+        self._inode = None
+        self._offset = 0
+        self._lock = threading.Lock()
+
+
+    def __contains__(self, key):
+        return key in self.values
+
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self.values[key] = parse_value(value)
+            self._absent.discard(key)
+
+
+    def get(self, key, default=None):
+        """
+        Look up a stat, reloading the stats file if it's not yet known.
+
+        :param str key: Name of the stat.
+        :param object default: Value to return if the stat's not been reported
+        :return int | float | str: Value of the stat; a number if it's the
+            text of one (see parse_value), otherwise text.
+        """
+        try:
+            return self.values[key]
+        except KeyError:
+            pass
+        with self._lock:
+            if key not in self._absent or self._changed():
+                self._reload()
+            try:
+                return self.values[key]
+            except KeyError:
+                self._absent.add(key)
+                return default
+
+
+    def refresh(self):
+        """ Read any stats appended to the stats file since the last read. """
+        with self._lock:
+            self._reload()
+
+
+    def _changed(self):
+        """ Determine whether the file's been modified since it was read. """
+        try:
+            info = os.stat(self.path)
+        except OSError:
+            return self._inode is not None
+        return info.st_ino != self._inode or info.st_size != self._offset
+
+
+    def _reload(self):
+        try:
+            f = open(self.path, 'rb')
+        except (IOError, OSError):
+            return
+        with f:
+            info = os.fstat(f.fileno())
+            if info.st_ino != self._inode or info.st_size < self._offset:
+                # New or truncated file; start over.
+                self._inode, self._offset = info.st_ino, 0
+            f.seek(self._offset)
+            data = f.read()
+        # A record still being written is left for next time.
+        data = data[:data.rfind(b"\n") + 1]
+        self._offset += len(data)
+        for line in data.decode("utf-8").splitlines():
+            try:
+                # Someone may have put something that's not 3 columns in
+                # the stats file; if so, we can just ignore it.
+                key, value, annotation = line.split('\t')
+            except ValueError:
+                print("WARNING: Each row in a stats file is expected to "
+                      "have 3 columns")
+                continue
+            if annotation.rstrip() in self.annotations:
+                self.values[key] = parse_value(value)
+                self._absent.discard(key)
+
+
+
+def parse_value(value):
+    """
+    Interpret a reported value, as a number if that loses nothing.
+
+    The stats file doesn't record what type a value had, so text is read as
+    a number only if the number is written exactly that way, as it is when
+    a number is reported; e.g., '12' and '0.5' are numbers, but '007',
+    '1.10', '1e3', 'nan', and 'inf' stay text, since IDs, barcodes, and
+    version numbers may look like that.
+
+    :param object value: Reported value, or its text
+    :return int | float | str: Integer or floating-point number if the value
+        is one, or is the text of one, otherwise the value as stripped text.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    text = str(value).strip()
+    for convert in (int, float):
+        try:
+            number = convert(text)
+        except ValueError:
+            continue
+        if str(number) == text and not math.isinf(number) \
+                and not math.isnan(number):
+            return number
+        break
+    return text
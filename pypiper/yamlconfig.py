@@ -0,0 +1,145 @@
+""" Loading of pipeline configuration files, parsed once and cached """
+
+import copy
+import errno
+import hashlib
+import marshal
+import os
+import tempfile
+import threading
+
+
+__all__ = ["load_yaml", "default_cache_folder"]
+
+
+
+# Parsed configurations by path, with the state of the file when parsed.
+_parsed = {}
+_parsed_lock = threading.Lock()
+
+# Version of the format of cached configurations; part of each cache key
+_CACHE_VERSION = 2
+
+# Types of which a configuration cached on disk may consist
+_PLAIN_TYPES = (dict, list, tuple, set, frozenset, str, bytes, bool, int,
+                float, type(None))
+
+
+
+def load_yaml(path, cache_folder=None):
+    """
+    Parse a YAML configuration file, reusing an earlier parse if possible.
+
+    Within a process, the file is parsed again only if it's changed, and
+    each call gets its own copy of the parse, which the caller is free to
+    modify. Across processes (e.g., one per sample of a project), parses
+    may also be cached on disk, keyed by the file's path, modification
+    time, and size, if a cache folder's given or configured. Only
+    configurations of plain data (e.g., no dates) are cached on disk, in
+    marshal format rather than as pickles, so that a cached file can't make
+    the loading process run code. Parsing itself uses libyaml where it's
+    available.
+
+    :param str path: Path to the configuration file.
+    :param str cache_folder: Folder in which to cache parsed configurations;
+        by default, that of default_cache_folder(). An empty string disables
+        caching on disk.
+    :return object: The parsed configuration, usually a dict
+    """
+    path = os.path.realpath(path)
+    info = os.stat(path)
+    state = (info.st_mtime, info.st_size)
+    with _parsed_lock:
+        cached = _parsed.get(path)
+    if cached is not None and cached[0] == state:
+        return copy.deepcopy(cached[1])
+    if cache_folder is None:
+        cache_folder = default_cache_folder()
+    cache_file = None
+    if cache_folder:
+        key = "{}\0{!r}\0{}".format(path, state, _CACHE_VERSION)
+        cache_file = os.path.join(
+            cache_folder, hashlib.sha1(key.encode("utf-8")).hexdigest())
+    config = _read_cached(cache_file)
+    if config is None:
+        config = _parse(path)
+        _write_cached(cache_file, config)
+    with _parsed_lock:
+        _parsed[path] = (state, config)
+    return copy.deepcopy(config)
+
+
+
+def default_cache_folder():
+    """
+    Determine where parsed configurations are cached by default.
+
+    Caching on disk is opt-in, since the cache is never pruned: it's only
+    done if $PYPIPER_CACHE is set.
+
+    :return str: Path to the folder: $PYPIPER_CACHE/config if that variable
+        is set and not empty, otherwise an empty string (no caching on disk)
+    """
+    base = os.environ.get("PYPIPER_CACHE")
+    if not base:
+        return ""
+    return os.path.join(base, "config")
+
+
+
+def _parse(path):
+    """ Parse a YAML file, with libyaml if it's available. """
+    import yaml
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=loader)
+
+
+
+def _read_cached(cache_file):
+    """ Read a cached parse; null if there's none, or it can't be read. """
+    if cache_file is None:
+        return None
+    try:
+        with open(cache_file, "rb") as f:
+            config = marshal.load(f)
+    except Exception:
+        return None
+    return config if _is_plain(config) else None
+
+
+
+def _write_cached(cache_file, config):
+    """ Cache a parse, if possible; caching is only an optimization. """
+    if cache_file is None or not _is_plain(config):
+        return
+    temp = None
+    try:
+        try:
+            os.makedirs(os.path.dirname(cache_file))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, temp = tempfile.mkstemp(
+            suffix=".tmp", dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, "wb") as f:
+            marshal.dump(config, f)
+        os.rename(temp, cache_file)
+    except (IOError, OSError, ValueError):
+        if temp is not None:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+
+
+def _is_plain(value):
+    """ Determine whether a value consists only of plain data. """
+    if not isinstance(value, _PLAIN_TYPES):
+        return False
+    if isinstance(value, dict):
+        return all(_is_plain(k) and _is_plain(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return all(_is_plain(v) for v in value)
+    return True
@@ -11,6 +11,10 @@ try:
         extra['install_requires'] = ['argparse']
     if sys.version_info >= (3,):
         extra['use_2to3'] = True
+    else:
+        # Backports of the standard library's concurrency and caching tools
+        extra['install_requires'] = [
+            'futures', 'selectors34', 'backports.functools_lru_cache']
 except ImportError:
     from distutils.core import setup
     if sys.version_info < (2, 7):
@@ -57,6 +61,7 @@ setup(
     # Extra package if doing `python setup.py test`
     setup_requires=(["pytest-runner"] if {"test", "pytest", "ptr"} & set(sys.argv) else []),
     extras_require=addl_reqs,
+    entry_points={"console_scripts": ["pypiper = pypiper.cli:main"]},
     # Version-specific items
     **extra
 )
@@ -3,6 +3,8 @@
 from functools import partial
 import glob
 import os
+import struct
+import zlib
 import pytest
 from pypiper import Pipeline
 from pypiper.utils import checkpoint_filepath
@@ -65,3 +67,79 @@ class SafeTestPipeline(Pipeline):
         kwd_args = {"multi": True}    # Like interactive mode.
         kwd_args.update(kwargs)
         super(SafeTestPipeline, self).__init__(*args, **kwd_args)
+
+
+
+def write_bam(path, reads, references=(("chr1", 1000),), block_payload=200):
+    """
+    Write a BAM file, without any external tools.
+
+    :param str path: Path to the file to write.
+    :param Iterable[dict] reads: Reads, each with a 'name' and a 'flag', and
+        optionally a 'seq' and 'qual' (text; Phred+33), 'ref' (index of
+        reference), 'pos' (0-based), and 'mapq'.
+    :param Iterable[(str, int)] references: Name and length of each reference
+    :param int block_payload: Number of bytes of data per compressed block;
+        small, so that records span blocks.
+    """
+    text = b"@HD\tVN:1.6\n"
+    header = b"BAM\1" + struct.pack("<i", len(text)) + text + \
+        struct.pack("<i", len(references))
+    for name, length in references:
+        name = name.encode() + b"\0"
+        header += struct.pack("<i", len(name)) + name + struct.pack("<i", length)
+    data = header + b"".join(_bam_record(r) for r in reads)
+    with open(path, "wb") as f:
+        for start in range(0, len(data), block_payload):
+            f.write(_bgzf_block(data[start:start + block_payload]))
+        f.write(_bgzf_block(b""))
+
+
+
+def write_sam(path, reads):
+    """
+    Write a SAM file.
+
+    :param str path: Path to the file to write.
+    :param Iterable[dict] reads: Reads, as for write_bam
+    """
+    with open(path, "w") as f:
+        f.write("@HD\tVN:1.6\n@SQ\tSN:chr1\tLN:1000\n")
+        for r in reads:
+            ref = "*" if r.get("ref", -1) < 0 else "chr1"
+            f.write("\t".join(str(x) for x in [
+                r["name"], r["flag"], ref, r.get("pos", -1) + 1,
+                r.get("mapq", 0), "*", "*", 0, 0, r.get("seq", "*"),
+                r.get("qual", "*")]) + "\n")
+
+
+
+def _bam_record(read):
+    name = read["name"].encode() + b"\0"
+    seq = read.get("seq", "")
+    codes = ["=ACMGRSVTWYHKDBN".index(c) for c in seq] + [0]
+    packed = bytes(bytearray(
+        (codes[i] << 4) | codes[i + 1] for i in range(0, len(seq), 2)))
+    qual = bytes(bytearray(ord(c) - 33 for c in read.get("qual", ""))) \
+        if "qual" in read else b"\xff" * len(seq)
+    body = struct.pack(
+        "<iiBBHHHiiii", read.get("ref", -1), read.get("pos", -1), len(name),
+        read.get("mapq", 0), 4680, 0, read["flag"], len(seq), -1, -1, 0)
+    body += name + packed + qual
+    return struct.pack("<i", len(body)) + body
+
+
+
+def _bgzf_block(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = b"\x1f\x8b\x08\x04\0\0\0\0\0\xff\x06\0BC\x02\0" + \
+        struct.pack("<H", 18 + len(cdata) + 8 - 1)
+    return header + cdata + struct.pack(
+        "<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+
+
+def _gzip_member(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
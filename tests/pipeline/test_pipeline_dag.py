@@ -0,0 +1,143 @@
+""" Tests for running a pipeline's stages according to their dependencies """
+
+import os
+import threading
+import time
+
+import pytest
+
+from pypiper import Pipeline, Stage
+from pypiper.exceptions import IllegalPipelineDefinitionError
+from pypiper.utils import checkpoint_filepath
+
+
+
+class BranchingPipeline(Pipeline):
+    """ Alignment followed by two independent branches, then a report. """
+
+    def __init__(self, manager, delay=0):
+        self.delay = delay
+        self.calls = []
+        self._calls_lock = threading.Lock()
+        super(BranchingPipeline, self).__init__("branching", manager=manager)
+
+    def _record(self, name):
+        time.sleep(self.delay)
+        with self._calls_lock:
+            self.calls.append(name)
+
+    def stages(self):
+        return [Stage(self._record, ("align", ), name="align"),
+                Stage(self._record, ("peaks", ), name="peaks"),
+                Stage(self._record, ("bigwig", ), name="bigwig",
+                      depends_on=["align"]),
+                Stage(self._record, ("report", ), name="report",
+                      depends_on=["peaks", "bigwig"])]
+
+
+
+def _names(stages):
+    return [s.name for s in stages]
+
+
+
+def test_independent_stages_overlap(pl_mgr):
+    """ Independent branches run at the same time given the workers. """
+    pipe = BranchingPipeline(pl_mgr, delay=1)
+    start = time.time()
+    pipe.run(max_workers=2)
+    assert time.time() - start < 3.9
+    assert "align" == pipe.calls[0]
+    assert "report" == pipe.calls[-1]
+    assert {"peaks", "bigwig"} == set(pipe.calls[1:3])
+
+
+
+def test_default_run_is_sequential(pl_mgr):
+    """ Stages run one at a time in definition order by default. """
+    pipe = BranchingPipeline(pl_mgr)
+    pipe.run()
+    assert ["align", "peaks", "bigwig", "report"] == pipe.calls
+    assert pipe.calls == _names(pipe.executed)
+
+
+
+def test_stop_before_excludes_downstream(pl_mgr):
+    """ Stopping before a stage leaves out only what depends on it. """
+    pipe = BranchingPipeline(pl_mgr)
+    pipe.run(stop_before="peaks")
+    assert ["align", "bigwig"] == pipe.calls
+    assert ["peaks", "report"] == _names(pipe.skipped)
+
+
+
+def test_start_point_skips_upstream(pl_mgr):
+    """ Starting at a stage skips only what it depends on. """
+    pipe = BranchingPipeline(pl_mgr)
+    pipe.run(start_point="bigwig")
+    assert ["peaks", "bigwig", "report"] == pipe.calls
+    assert ["align"] == _names(pipe.skipped)
+
+
+
+def test_rerun_after_checkpointed_branch(pl_mgr):
+    """ A completed stage is skipped unless something upstream reruns. """
+    pipe = BranchingPipeline(pl_mgr)
+    pipe.run()
+    os.remove(checkpoint_filepath("bigwig", pl_mgr))
+    pipe.calls = []
+    pipe.run()
+    assert ["bigwig", "report"] == pipe.calls
+    assert ["align", "peaks"] == _names(pipe.skipped)
+
+
+
+def test_dependencies_from_inputs_and_outputs(pl_mgr):
+    """ A stage depends on those that produce its inputs. """
+    def noop():
+        pass
+    class FilePipeline(Pipeline):
+        def stages(self):
+            return [Stage(noop, name="a", outputs=["a.txt"]),
+                    Stage(noop, name="b", depends_on=[]),
+                    Stage(noop, name="c", inputs=["a.txt"])]
+    pipe = FilePipeline("files", manager=pl_mgr)
+    assert {"a": set(), "b": set(), "c": {"a"}} == dict(pipe._upstream)
+
+
+
+@pytest.mark.parametrize("deps", [{"a": ["b"], "b": ["a"]}, {"a": ["z"]}])
+def test_invalid_dependencies(pl_mgr, deps):
+    """ Circular or unknown dependencies make a pipeline invalid. """
+    def noop():
+        pass
+    class BadPipeline(Pipeline):
+        def stages(self):
+            return [Stage(noop, name=n, depends_on=d) for n, d in deps.items()]
+    with pytest.raises(IllegalPipelineDefinitionError):
+        BadPipeline("bad", manager=pl_mgr)
+
+
+
+def test_overlapping_stages_keep_own_checkpoints(pl_mgr):
+    """ A stage's checkpoints aren't mixed up with those of another. """
+    started, passed = threading.Event(), threading.Event()
+    seen = {}
+    def sort():
+        pl_mgr.timestamp(checkpoint="sort")
+        started.set()
+        passed.wait(10)
+        seen["sort"] = (pl_mgr.curr_checkpoint, os.path.exists(
+            checkpoint_filepath("sort", pl_mgr)))
+    def call():
+        started.wait(10)
+        pl_mgr.timestamp(checkpoint="call")
+        seen["call"] = (pl_mgr.prev_checkpoint, pl_mgr.curr_checkpoint)
+        passed.set()
+    class OverlappingPipeline(Pipeline):
+        def stages(self):
+            return [Stage(sort, name="align"),
+                    Stage(call, name="peaks", depends_on=[])]
+    OverlappingPipeline("overlapping", manager=pl_mgr).run(max_workers=2)
+    assert ("sort", False) == seen["sort"]
+    assert (None, "call") == seen["call"]
@@ -0,0 +1,122 @@
+""" Tests for remaking targets when their inputs or command change """
+
+import os
+import time
+
+import pytest
+
+from pypiper.manifest import BuildManifest
+
+
+
+@pytest.fixture
+def paths(tmpdir):
+    """ Provide an input file and a target path. """
+    infile = tmpdir.join("in.txt")
+    infile.write("first")
+    return infile.strpath, tmpdir.join("out.txt").strpath
+
+
+
+def _copy(src, dst, suffix=""):
+    return "cat {} > {}{}".format(src, dst, suffix)
+
+
+
+def _content(path):
+    with open(path) as f:
+        return f.read()
+
+
+
+def test_current_target_is_kept(get_pipe_manager, paths):
+    """ A target made from unchanged inputs isn't remade. """
+    infile, target = paths
+    pm = get_pipe_manager(name="incremental")
+    pm.run(_copy(infile, target), target, inputs=[infile])
+    with open(target, 'w') as f:
+        f.write("kept")
+    pm.run(_copy(infile, target), target, inputs=[infile])
+    assert "kept" == _content(target)
+
+
+
+def test_touched_input_hashed_once(get_pipe_manager, paths):
+    """ An input touched but unchanged counts once its content's known. """
+    infile, target = paths
+    pm = get_pipe_manager(name="incremental")
+    pm.run(_copy(infile, target), target, inputs=[infile])
+    # Only the time and size were recorded, so the content can't be compared.
+    os.utime(infile, (time.time() + 5, time.time() + 5))
+    with open(target, 'w') as f:
+        f.write("remade")
+    pm.run(_copy(infile, target), target, inputs=[infile])
+    assert "first" == _content(target)
+    # The hash taken then was recorded, so now touching doesn't count.
+    os.utime(infile, (time.time() + 10, time.time() + 10))
+    with open(target, 'w') as f:
+        f.write("kept")
+    pm.run(_copy(infile, target), target, inputs=[infile])
+    assert "kept" == _content(target)
+
+
+
+def test_recording_reads_no_inputs(tmpdir, paths, monkeypatch):
+    """ Recording a target notes its inputs' times and sizes only. """
+    infile, target = paths
+    with open(target, 'w') as f:
+        f.write("first")
+
+    def fail(path):
+        raise AssertionError("hashed " + path)
+    monkeypatch.setattr("pypiper.manifest.file_digest", fail)
+    manifest = BuildManifest(tmpdir.join("manifest.json").strpath)
+    manifest.record(target, "cmd", [infile])
+    assert not manifest.is_stale(target, "cmd", [infile])
+    assert "md5" not in manifest.entries[target]["inputs"][infile]
+
+
+
+def test_changed_input_remakes_target(get_pipe_manager, paths):
+    """ A target is remade when one of its inputs changes. """
+    infile, target = paths
+    pm = get_pipe_manager(name="incremental")
+    pm.run(_copy(infile, target), target, inputs=[infile])
+    with open(infile, 'w') as f:
+        f.write("second")
+    pm.run(_copy(infile, target), target, inputs=[infile])
+    assert "second" == _content(target)
+
+
+
+def test_changed_command_remakes_target(get_pipe_manager, paths):
+    """ A target is remade when the command that makes it changes. """
+    infile, target = paths
+    pm = get_pipe_manager(name="incremental")
+    pm.run(_copy(infile, target), target, inputs=[infile])
+    pm.run(_copy(infile, target, " && echo more >> " + target),
+           target, inputs=[infile])
+    assert "firstmore\n" == _content(target)
+
+
+
+def test_manifest_persists(get_pipe_manager, paths):
+    """ Records of targets are available to a later run of the pipeline. """
+    infile, target = paths
+    pm = get_pipe_manager(name="incremental")
+    pm.run(_copy(infile, target), target, inputs=[infile])
+    manifest = BuildManifest(pm.manifest.path)
+    assert not manifest.is_stale(target, _copy(infile, target), [infile])
+    assert manifest.is_stale(target, _copy(infile, target), [infile, target])
+
+
+
+def test_unrecorded_target_uses_times(tmpdir, paths):
+    """ Without a record, a target older than an input is out of date. """
+    infile, target = paths
+    with open(target, 'w') as f:
+        f.write("old")
+    manifest = BuildManifest(tmpdir.join("manifest.json").strpath)
+    assert not manifest.is_stale(target, "cmd", [infile])
+    os.utime(infile, (time.time() + 5, time.time() + 5))
+    assert manifest.is_stale(target, "cmd", [infile])
@@ -0,0 +1,120 @@
+""" Tests for the ways in which target lock files are held """
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from pypiper.locks import ExclusiveFileLocks, FlockLocks, get_lock_backend
+
+
+
+def _hold(backend, path):
+    """ Take a lock in another process. """
+    code = "from pypiper.locks import {}; import sys, time; " \
+           "{}().acquire({!r}); sys.stdout.write('locked\\n'); " \
+           "sys.stdout.flush(); time.sleep(60)".format(backend, backend, path)
+    proc = subprocess.Popen([sys.executable, "-c", code],
+                            stdout=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.dirname(
+                                os.path.dirname(os.path.abspath(__file__)))))
+    assert b"locked" in proc.stdout.readline()
+    return proc
+
+
+
+def _kill(proc):
+    proc.send_signal(signal.SIGKILL)
+    proc.wait()
+    proc.stdout.close()
+
+
+
+def _hold_and_die(backend, path):
+    """ Take a lock in another process, which is then killed. """
+    _kill(_hold(backend, path))
+
+
+
+@pytest.mark.parametrize(["backend", "stale"], [
+    (FlockLocks, True), (ExclusiveFileLocks, False)])
+def test_lock_of_killed_process(tmpdir, backend, stale):
+    """ Only a lock held with flock is released when its holder dies. """
+    path = tmpdir.join("lock.target").strpath
+    _hold_and_die(backend.__name__, path)
+    assert os.path.isfile(path)
+    assert stale != backend().is_locked(path)
+
+
+
+def test_flock_excludes_others(tmpdir):
+    """ A held lock can't be taken by anyone else. """
+    path = tmpdir.join("lock.target").strpath
+    holder, other = FlockLocks(), FlockLocks()
+    holder.acquire(path)
+    assert other.is_locked(path)
+    with pytest.raises(OSError):
+        other.acquire(path)
+    holder.release(path)
+    assert not os.path.exists(path)
+    assert not other.is_locked(path)
+
+
+
+@pytest.mark.parametrize("backend", [ExclusiveFileLocks, FlockLocks])
+def test_owner_is_recorded(tmpdir, backend):
+    """ The process holding a lock is identified in the lock file. """
+    path = tmpdir.join("lock.target").strpath
+    locks = backend()
+    locks.acquire(path)
+    assert {"pid": os.getpid(), "host": socket.gethostname()} == \
+           locks.owner(path)
+    locks.release(path)
+
+
+
+def test_stale_lock_is_taken_over(get_pipe_manager, tmpdir):
+    """ A pipeline doesn't wait on the lock of a killed pipeline. """
+    pm = get_pipe_manager(name="locking", lock_backend="flock")
+    target = tmpdir.join("out.txt").strpath
+    lock_file = pm._make_lock_path("out.txt")
+    _hold_and_die("FlockLocks", lock_file)
+    start = time.time()
+    pm.run("touch {}".format(target), target)
+    assert time.time() - start < 5
+    assert os.path.isfile(target)
+    assert not os.path.exists(lock_file)
+
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_lock_backend("nonesuch")
+
+
+
+def test_waiter_wakes_when_holder_dies(tmpdir):
+    """ A holder's death ends a wait for its flock right away. """
+    path = tmpdir.join("lock.target").strpath
+    proc = _hold("FlockLocks", path)
+    killed = []
+
+    def kill():
+        killed.append(time.time())
+        _kill(proc)
+
+    # Let the wait's interval grow, so waking on a timeout would be late.
+    killer = threading.Timer(3, kill)
+    killer.start()
+    try:
+        FlockLocks().wait(path)
+        woke = time.time()
+    finally:
+        killer.join()
+    assert os.path.isfile(path)
+    assert woke - killed[0] < 0.5
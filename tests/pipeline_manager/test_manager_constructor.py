@@ -29,6 +29,17 @@ def test_manager_starts_in_null_checkpoint_state(
 
 
 
+@pytest.mark.parametrize(
+    ["mem", "expected"], [("4000", 4000), ("4000M", 4000), ("8g", 8192)])
+def test_memory_with_or_without_unit(get_pipe_manager, mem, expected):
+    """ The memory given is in megabytes, unless it has a unit suffix. """
+    pm = get_pipe_manager(name="ctor-mem", mem=mem)
+    assert expected == pm.resources.mem
+    assert "{}m".format(expected) == pm.mem
+    assert "{}m".format(int(expected * 0.95)) == pm.javamem
+
+
+
 class ManagerConstructorCheckpointSpecificationTests:
     """ Tests for manager's constructor's ability to parse and set
     checkpoint specifications, which can determine aspects of control flow. """
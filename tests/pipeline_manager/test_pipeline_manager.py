@@ -121,7 +121,8 @@ class PipelineManagerTests(unittest.TestCase):
         stamp = time.time()
         self.pp.run(cmd, lock_name="sleep")
         print("Elapsed: " + str(self.pp.time_elapsed(stamp)))
-        self.assertTrue(self.pp.time_elapsed(stamp) > 1)
+        # The lock's removal is noticed right away.
+        self.assertTrue(0.3 < time.time() - stamp < 3)
 
         print("Wait for subprocess...")
         for p in self.pp.procs.copy():
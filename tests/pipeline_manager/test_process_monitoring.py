@@ -0,0 +1,109 @@
+""" Tests for how the pipeline manager waits on and profiles subprocesses. """
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from pypiper.monitor import ResourceSampler, process_tree
+
+
+
+@pytest.mark.parametrize("shell", [False, True])
+def test_exit_noticed_promptly(get_pipe_manager, shell):
+    """ A short command's exit isn't held up by the memory sampling timer. """
+    pm = get_pipe_manager(name="reaping")
+    start = time.time()
+    ret, _ = pm.callprint("sleep 1", shell=shell)
+    elapsed = time.time() - start
+    assert 0 == ret
+    # The old polling loop wouldn't notice this exit until 5.25 seconds.
+    assert elapsed < 3
+    assert not pm.procs
+
+
+
+def test_nonzero_return_is_reported(get_pipe_manager):
+    """ The return code captured by the reaper is the process's own. """
+    pm = get_pipe_manager(name="reaping")
+    ret, _ = pm.callprint("false", shell=False, nofail=True)
+    assert 1 == ret
+
+
+
+def test_peak_memory_of_short_spike(get_pipe_manager):
+    """ A spike shorter than the sampling interval is still measured. """
+    pm = get_pipe_manager(name="sampling", sampling_interval=30)
+    cmd = "{} -c 'x = bytearray(400 * 10 ** 6)'".format(sys.executable)
+    _, maxmem = pm.callprint(cmd, shell=False)
+    assert maxmem > 0.35
+
+
+
+@pytest.mark.parametrize("shell", [False, True])
+def test_parent_memory_not_counted(get_pipe_manager, shell):
+    """ Memory the pipeline itself holds isn't charged to its commands. """
+    pm = get_pipe_manager(name="sampling")
+    ballast = bytearray(100 * 10 ** 6)
+    _, maxmem = pm.callprint("true | cat" if shell else "true", shell=shell)
+    assert len(ballast) and maxmem < 0.05
+
+
+
+def test_sampler_records_usage_of_each_process():
+    """ Each sampled process entry gains memory and CPU measurements. """
+    procs = {os.getpid(): {}}
+    sampler = ResourceSampler(procs, interval=60)
+    sampler.sample()
+    usage = procs[os.getpid()]
+    assert usage["peak_mem"] > 0
+    assert usage["cpu_user"] + usage["cpu_sys"] > 0
+
+
+
+def test_sampler_runs_in_background():
+    """ The sampler measures on its own, at its configured rate. """
+    procs = {os.getpid(): {}}
+    sampler = ResourceSampler(procs, interval=0.05)
+    sampler.start()
+    try:
+        time.sleep(0.5)
+    finally:
+        sampler.stop()
+        sampler.join()
+    assert "peak_mem" in procs[os.getpid()]
+
+
+
+def test_shell_pipeline_memory_is_profiled(get_pipe_manager):
+    """ Memory of processes within a shell pipeline is measured. """
+    pm = get_pipe_manager(name="tree")
+    cmd = "{} -c 'x = bytearray(400 * 10 ** 6)' | cat".format(sys.executable)
+    _, maxmem = pm.callprint(cmd, shell=True)
+    assert maxmem > 0.35
+    with open(pm.pipeline_profile_file) as profile:
+        last_record = profile.readlines()[-1].split("\t")
+    assert float(last_record[3]) > 0.35
+
+
+
+def test_sampler_sums_process_tree():
+    """ A tree entry's memory is that of all of its member processes. """
+    child = subprocess.Popen(
+        "{0} -c '{1}' | {0} -c '{1}'".format(
+            sys.executable, "import time; x = bytearray(10 ** 8); time.sleep(5)"),
+        shell=True)
+    try:
+        time.sleep(1)
+        procs = {child.pid: {"tree": True}}
+        ResourceSampler(procs, interval=60).sample()
+        usage = procs[child.pid]
+        assert usage["tree_size"] >= 3
+        assert usage["peak_mem"] > 2 * 10 ** 5
+    finally:
+        for pid in reversed(process_tree(child.pid)):
+            os.kill(pid, signal.SIGKILL)
+        child.wait()
@@ -0,0 +1,127 @@
+""" Tests for the writing of reported results """
+
+import os
+import threading
+
+import pytest
+
+from pypiper.stats import RecordWriter, StatsStore, parse_value
+
+
+
+def _lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+
+def test_concurrent_writers_dont_interleave(tmpdir):
+    """ Records from writers sharing a file each arrive whole. """
+    path = tmpdir.join("stats.tsv").strpath
+    def write_many(name):
+        writer = RecordWriter(path)
+        for i in range(200):
+            writer.write("{}\t{}\t{}".format(name * 50, i, name))
+    threads = [threading.Thread(target=write_many, args=(n, ))
+               for n in "abcd"]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    lines = _lines(path)
+    assert 800 == len(lines)
+    for line in lines:
+        key, _, annotation = line.split("\t")
+        assert key == annotation * 50
+
+
+
+def test_buffered_records_wait_for_flush(tmpdir):
+    """ Buffered records are appended together when flushed. """
+    path = tmpdir.join("stats.tsv").strpath
+    writer = RecordWriter(path, buffered=True)
+    writer.write("a\t1\tpipe")
+    writer.write("b\t2\tpipe")
+    assert not os.path.exists(path)
+    writer.flush()
+    assert ["a\t1\tpipe", "b\t2\tpipe"] == _lines(path)
+
+
+
+def test_batched_results_written_at_timestamp(get_pipe_manager):
+    """ A manager batching results writes them out at its next timestamp. """
+    pm = get_pipe_manager(name="batching", batch_results=True)
+    pm.report_result("reads", 100)
+    assert 100 == pm.get_stat("reads")
+    assert not os.path.exists(pm.pipeline_stats_file)
+    pm.timestamp("### Next")
+    assert "reads\t100\tbatching" in _lines(pm.pipeline_stats_file)
+    pm.stop_pipeline()
+
+
+
+def test_store_reads_only_appended_stats(tmpdir):
+    """ A reload parses only the lines added since the last one. """
+    stats = tmpdir.join("stats.tsv")
+    stats.write("a\t1\tpipe\n")
+    store = StatsStore(stats.strpath, ["pipe", "shared"])
+    assert 1 == store.get("a")
+    # Rewriting an already-read line in place isn't noticed...
+    stats.write("a\t2\tpipe\nb\t3.5\tshared\nc\tx\tother\n")
+    assert 3.5 == store.get("b")
+    assert 1 == store.get("a")
+    # ...but a replaced file is read from the start.
+    stats.remove()
+    stats.write("a\t4\tpipe\nz\tzz\tpipe\n")
+    assert "zz" == store.get("z")
+    assert 4 == store.get("a")
+    assert store.get("c") is None
+
+
+
+def test_absent_stat_rereads_only_changed_file(tmpdir, monkeypatch):
+    """ Repeated lookups of a missing stat don't rescan the file. """
+    stats = tmpdir.join("stats.tsv")
+    stats.write("a\t1\tpipe\n")
+    store = StatsStore(stats.strpath, ["pipe"])
+    reloads = []
+    reload = store._reload
+    def counting_reload():
+        reloads.append(1)
+        reload()
+    monkeypatch.setattr(store, "_reload", counting_reload)
+    for _ in range(10):
+        assert store.get("b") is None
+    assert 1 == len(reloads)
+    with open(stats.strpath, "a") as f:
+        f.write("b\t2\tpipe\n")
+    assert 2 == store.get("b")
+    assert 2 == len(reloads)
+
+
+
+def test_text_stats_kept_as_written(get_pipe_manager):
+    """ Stats that only look like numbers come back just as reported. """
+    pm = get_pipe_manager(name="text_stats")
+    pm.report_result("barcode", "007")
+    pm.report_result("version", "1.10")
+    pm.report_result("reads", 12)
+    pm.stop_pipeline()
+    assert "007" == pm.get_stat("barcode")
+    # Read back from the stats file:
+    store = StatsStore(pm.pipeline_stats_file, ["text_stats"])
+    assert "007" == store.get("barcode")
+    assert "1.10" == store.get("version")
+    assert 12 == store.get("reads")
+
+
+
+@pytest.mark.parametrize(["text", "value"], [
+    ("12", 12), (" 0.5 ", 0.5), ("-3", -3), ("1e-05", 1e-05), (7, 7),
+    (2.5, 2.5), ("abc", "abc"), ("0:00:01", "0:00:01"), ("007", "007"),
+    ("1.10", "1.10"), ("1e3", "1e3"), ("1_000", "1_000"), ("+5", "+5"),
+    ("nan", "nan"), ("inf", "inf"), ("-0", "-0")])
+def test_parse_value(text, value):
+    """ Stats that are the text of numbers are numbers, others text. """
+    assert value == parse_value(text)
+    assert type(value) is type(parse_value(text))
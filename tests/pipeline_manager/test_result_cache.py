@@ -0,0 +1,140 @@
+""" Tests for reusing results of commands previously run on the same inputs """
+
+import os
+import time
+
+import pytest
+
+from pypiper.cache import ResultCache
+
+
+
+@pytest.fixture
+def cache_folder(tmpdir):
+    return tmpdir.join("cache").strpath
+
+
+
+def _make_pipe(get_pipe_manager, tmpdir, name, cache_folder, **kwargs):
+    """ Create a manager with its own output folder but a shared cache. """
+    return get_pipe_manager(name=name, cache_folder=cache_folder,
+                            outfolder=tmpdir.join(name).strpath, **kwargs)
+
+
+
+def test_identical_command_and_inputs_hit(get_pipe_manager, tmpdir, cache_folder):
+    """ A second pipeline reuses the result instead of rerunning. """
+    infile = tmpdir.join("in.txt")
+    infile.write("data")
+    target = tmpdir.join("out.txt").strpath
+    cmd = "cat {} > {}; echo ran >> {}".format(
+        infile.strpath, target, tmpdir.join("runs.txt").strpath)
+    for name in ["sample1", "sample2"]:
+        pm = _make_pipe(get_pipe_manager, tmpdir, name, cache_folder)
+        if os.path.exists(target):
+            os.remove(target)
+        pm.run(cmd, target, shell=True, inputs=[infile.strpath])
+        with open(target) as f:
+            assert "data" == f.read()
+    with open(tmpdir.join("runs.txt").strpath) as f:
+        assert 1 == len(f.readlines())
+    with open(pm.pipeline_profile_file) as f:
+        assert any(l.startswith("# Cache hit") for l in f)
+
+
+
+def test_changed_input_misses(get_pipe_manager, tmpdir, cache_folder):
+    """ Different input content means a different result. """
+    infile = tmpdir.join("in.txt")
+    target = tmpdir.join("out.txt").strpath
+    cmd = "cat {} > {}".format(infile.strpath, target)
+    for content in ["one", "two"]:
+        infile.write(content)
+        pm = _make_pipe(get_pipe_manager, tmpdir, content, cache_folder)
+        if os.path.exists(target):
+            os.remove(target)
+        pm.run(cmd, target, shell=True, inputs=[infile.strpath])
+        with open(target) as f:
+            assert content == f.read()
+    with open(pm.pipeline_profile_file) as f:
+        assert any(l.startswith("# Cache miss") for l in f)
+
+
+
+def test_least_recently_used_evicted(tmpdir):
+    """ The oldest results go when the cache outgrows its limit. """
+    cache = ResultCache(tmpdir.join("cache").strpath, max_size=150)
+    keys = []
+    for i in range(3):
+        result = tmpdir.join("result{}".format(i))
+        result.write("x" * 60)
+        keys.append(cache.key("cmd{}".format(i), []))
+        cache.store(keys[-1], result.strpath)
+        # Ensure distinct usage times.
+        os.utime(cache._path(keys[-1]), (time.time() - 10 + i, time.time() - 10 + i))
+        cache.evict(cache.max_size)
+    restored = tmpdir.join("restored").strpath
+    assert not cache.fetch(keys[0], restored)
+    assert cache.fetch(keys[2], restored)
+
+
+
+def test_stored_target_left_writable(tmpdir):
+    """ Caching a result neither shares nor locks the pipeline's target. """
+    cache = ResultCache(tmpdir.join("cache").strpath)
+    result = tmpdir.join("result")
+    result.write("data")
+    key = cache.key("cmd", [])
+    assert cache.store(key, result.strpath)
+    result.write("edited")
+    assert 1 == os.stat(result.strpath).st_nlink
+    restored = tmpdir.join("restored").strpath
+    assert cache.fetch(key, restored)
+    with open(restored) as f:
+        assert "data" == f.read()
+
+
+
+def test_fetch_keeps_modification_time(tmpdir):
+    """ Using a result doesn't touch copies that share its file. """
+    cache = ResultCache(tmpdir.join("cache").strpath)
+    result = tmpdir.join("result")
+    result.write("data")
+    key = cache.key("cmd", [])
+    cache.store(key, result.strpath)
+    first = tmpdir.join("first").strpath
+    cache.fetch(key, first)
+    os.utime(cache._path(key), (1000, 1000))
+    cache.fetch(key, tmpdir.join("second").strpath)
+    assert 1000 == os.path.getmtime(first)
+    assert os.stat(first).st_atime > 1000
+
+
+
+def test_writes_in_progress_not_evicted(tmpdir):
+    """ Another writer's partial result is neither evicted nor counted. """
+    cache = ResultCache(tmpdir.join("cache").strpath, max_size=100)
+    partial = tmpdir.join("cache", "ab", "abc123.tmp")
+    partial.write("x" * 500, ensure=True)
+    result = tmpdir.join("result")
+    result.write("x" * 60)
+    key = cache.key("cmd", [])
+    cache.store(key, result.strpath)
+    assert partial.check()
+    assert os.path.isfile(cache._path(key))
+    assert 60 == cache._size
+
+
+
+def test_concurrent_stores_of_same_key(tmpdir):
+    """ Threads storing the same result don't collide. """
+    from concurrent.futures import ThreadPoolExecutor
+    cache = ResultCache(tmpdir.join("cache").strpath, max_size=1000)
+    result = tmpdir.join("result")
+    result.write("x" * 60)
+    key = cache.key("cmd", [])
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        stored = list(pool.map(
+            lambda _: cache.store(key, result.strpath), range(16)))
+    assert all(stored)
+    assert [key] == os.listdir(os.path.dirname(cache._path(key)))
@@ -0,0 +1,116 @@
+""" Tests for running commands concurrently with the pipeline manager. """
+
+import os
+import time
+
+import pytest
+
+from pypiper.exceptions import PipelineError
+from pypiper.flags import COMPLETE_FLAG
+from pypiper.profiling import read_profiles
+
+
+def test_jobs_run_concurrently(get_pipe_manager, tmpdir):
+    """ Independent commands share the manager's cores. """
+    pm = get_pipe_manager(name="parallel", cores=2)
+    targets = [os.path.join(tmpdir.strpath, "out{}.txt".format(i))
+               for i in range(2)]
+    jobs = [("sleep 1; touch {}".format(t), t) for t in targets]
+    start = time.time()
+    codes = pm.run_parallel(jobs, shell=True)
+    elapsed = time.time() - start
+    assert [0, 0] == codes
+    assert all(os.path.isfile(t) for t in targets)
+    assert elapsed < 2
+    pm.stop_pipeline()
+
+
+
+def test_job_forms(get_pipe_manager, tmpdir):
+    """ Jobs may be mappings of run() arguments. """
+    pm = get_pipe_manager(name="parallel", cores=2)
+    target = os.path.join(tmpdir.strpath, "mapped.txt")
+    codes = pm.run_parallel(
+        [{"cmd": "true", "lock_name": "nothing"},
+         {"cmd": "touch {}".format(target), "target": target}])
+    assert [0, 0] == codes
+    assert os.path.isfile(target)
+    # An existing target means there's nothing to do.
+    assert [0] == pm.run_parallel([{"cmd": "false", "target": target}])
+    pm.stop_pipeline()
+
+
+
+def test_submit_returns_future(get_pipe_manager):
+    """ A submitted command's return code is the future's result. """
+    pm = get_pipe_manager(name="parallel")
+    future = pm.submit("true", lock_name="nothing")
+    assert 0 == future.result()
+    pm.stop_pipeline()
+
+
+
+def test_failed_job_fails_pipeline(get_pipe_manager):
+    """ One failed job stops the others and the pipeline. """
+    pm = get_pipe_manager(name="parallel", cores=2)
+    start = time.time()
+    with pytest.raises(Exception):
+        pm.run_parallel([{"cmd": "false", "lock_name": "fails"},
+                         {"cmd": "sleep 30", "lock_name": "sleeps"}])
+    assert time.time() - start < 10
+    assert pm.failed
+    assert not pm.procs
+
+
+
+def test_waiting_job_not_started_after_failure(get_pipe_manager, tmpdir):
+    """ A job waiting for resources isn't started once the pipeline fails. """
+    pm = get_pipe_manager(name="parallel", cores=2)
+    target = os.path.join(tmpdir.strpath, "late.txt")
+    failing = pm.submit("sleep 1; false", lock_name="fails", shell=True, cores=2)
+    # Hold off on the second job until the first has taken all the cores.
+    deadline = time.time() + 10
+    while pm.resources.free_cores:
+        assert time.time() < deadline, "First job never started"
+        time.sleep(0.01)
+    waiting = pm.submit("touch {}".format(target), target=target, cores=2)
+    with pytest.raises(Exception):
+        failing.result()
+    with pytest.raises(Exception):
+        waiting.result()
+    time.sleep(0.5)
+    assert pm.failed
+    assert not os.path.exists(target)
+    with pytest.raises(PipelineError):
+        pm.submit("true", lock_name="after")
+
+
+
+def test_failed_job_keeps_pipeline_failed(get_pipe_manager, tmpdir):
+    """ A pipeline with a failed submitted job can't then be completed. """
+    pm = get_pipe_manager(name="parallel")
+    with pytest.raises(Exception):
+        pm.submit("false", lock_name="fails").result()
+    target = os.path.join(tmpdir.strpath, "after.txt")
+    with pytest.raises(PipelineError):
+        pm.submit("touch {}".format(target), target=target)
+    with pytest.raises(Exception):
+        pm.stop_pipeline()
+    assert pm.failed
+    assert not os.path.exists(target)
+    assert not os.path.exists(pm.flag_file_path(COMPLETE_FLAG))
+
+
+
+def test_killed_job_profiled_once(get_pipe_manager):
+    """ A job stopped by another's failure has a single profile record. """
+    pm = get_pipe_manager(name="parallel", cores=2)
+    with pytest.raises(Exception):
+        pm.run_parallel([{"cmd": "sleep 1; false", "lock_name": "fails",
+                          "shell": True},
+                         {"cmd": "sleep 30", "lock_name": "sleeps"}])
+    # Give the killed job's worker time to notice.
+    time.sleep(1)
+    profile = read_profiles(pm.pipeline_profile_records_file)
+    assert ["sleep 1; false", "sleep 30"] == sorted(profile["command"])
+    assert 2 == len(set(profile["pid"]))
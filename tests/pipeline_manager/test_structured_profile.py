@@ -0,0 +1,61 @@
+""" Tests for the machine-readable profile of a pipeline's commands """
+
+import pytest
+
+from pypiper.profiling import PROFILE_FIELDS, load_profiles, read_profiles
+
+
+
+def _run_pipe(get_pipe_manager, tmpdir, name):
+    pm = get_pipe_manager(name=name, outfolder=tmpdir.join(name).strpath)
+    pm.run("true", lock_name="first")
+    pm.timestamp("### Align", checkpoint="align")
+    pm.run("false", lock_name="second", nofail=True)
+    pm.stop_pipeline()
+    return pm
+
+
+
+def test_record_per_command(get_pipe_manager, tmpdir):
+    """ Each command's profile has all of the fields, as values. """
+    pm = _run_pipe(get_pipe_manager, tmpdir, "sample1")
+    profile = read_profiles(pm.pipeline_profile_records_file)
+    assert ["true", "false"] == profile["command"]
+    assert ["first", "second"] == profile["lock_name"]
+    assert [None, "align"] == profile["stage"]
+    assert [0, 1] == profile["exit_code"]
+    assert all(isinstance(w, float) for w in profile["wall"])
+    for start, end, run_start in zip(
+            profile["start"], profile["end"], profile["run_start"]):
+        assert run_start <= start <= end
+    assert set(PROFILE_FIELDS) < set(profile)
+
+
+
+def test_profiles_of_many_folders_combined(get_pipe_manager, tmpdir):
+    """ Profiles found in output folders are read together. """
+    folders = [_run_pipe(get_pipe_manager, tmpdir, n).outfolder
+               for n in ["sample1", "sample2"]]
+    profile = read_profiles(folders)
+    assert ["sample1"] * 2 + ["sample2"] * 2 == profile["pipeline"]
+    assert 4 == len(set(profile["pid"]))
+
+
+
+def test_load_profiles_as_table(get_pipe_manager, tmpdir):
+    """ The combined profiles form a data frame. """
+    pytest.importorskip("pandas")
+    pm = _run_pipe(get_pipe_manager, tmpdir, "sample1")
+    table = load_profiles([pm.outfolder])
+    assert (2, len(PROFILE_FIELDS) + 1) == table.shape
+
+
+
+def test_output_tail_recorded(get_pipe_manager, tmpdir):
+    """ The end of each command's output can be kept in its record. """
+    pm = get_pipe_manager(name="tail", outfolder=tmpdir.strpath,
+                          output_tail=6)
+    pm.run("echo first; echo second", lock_name="echo")
+    pm.stop_pipeline()
+    profile = read_profiles(pm.pipeline_profile_records_file)
+    assert ["econd\n"] == profile["output"]
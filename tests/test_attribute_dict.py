@@ -0,0 +1,80 @@
+""" Tests for attribute-style access to nested configuration data """
+
+import copy
+import pickle
+
+import pytest
+
+from pypiper import AttributeDict
+from pypiper.ngstk import NGSTk
+
+
+
+@pytest.fixture
+def config(monkeypatch):
+    monkeypatch.setenv("TOOLS", "/opt/tools")
+    return AttributeDict({"tools": {"java": "$TOOLS/java"}, "threads": 4,
+                          "paths": ["$TOOLS"]}, default=True)
+
+
+
+def test_attribute_and_item_access(config):
+    """ Values are available as attributes and items, nested or not. """
+    assert 4 == config.threads == config["threads"]
+    assert "/opt/tools/java" == config.tools.java == config["tools"]["java"]
+    assert "threads" in config and "java" not in config
+
+
+
+def test_nested_object_shared(config):
+    """ A nested mapping is wrapped once and then shared. """
+    assert config.tools is config.tools
+    tk = NGSTk()
+    tk.tools = config.tools
+    assert config.tools is tk.tools
+
+
+
+def test_variables_expanded_once(config, monkeypatch):
+    """ Shell variables in text are expanded as of the first lookup. """
+    assert "/opt/tools/java" == config.tools.java
+    monkeypatch.setenv("TOOLS", "/elsewhere")
+    assert "/opt/tools/java" == config.tools.java
+    # Only text is expanded, not text in collections.
+    assert ["$TOOLS"] == config.paths
+
+
+
+def test_missing_attribute(config):
+    """ A missing attribute is its own name by default, else an error. """
+    assert "samtools" == config.tools.samtools
+    strict = AttributeDict({"a": 1})
+    with pytest.raises(AttributeError):
+        strict.b
+
+
+
+def test_value_set_directly_used_as_is(config):
+    """ Only configuration data is expanded and wrapped. """
+    config.command = "echo $TOOLS"
+    config.settings = {"a": 1}
+    assert "echo $TOOLS" == config.command
+    assert {"a": 1} == config.settings
+
+
+
+def test_copy_and_pickle(config):
+    """ Copies have the same values. """
+    for other in [copy.deepcopy(config), pickle.loads(pickle.dumps(config))]:
+        assert "/opt/tools/java" == other.tools.java
+        assert "missing" == other.missing
+
+
+
+def test_all_values_listed(config):
+    """ The values, prepared, are shown whether or not they've been used. """
+    config.command = "echo"
+    shown = repr(config)
+    for text in ["'threads': 4", "'/opt/tools/java'", "'command': 'echo'"]:
+        assert text in shown
+    assert "_entries" not in shown and "return_defaults" not in shown
@@ -0,0 +1,54 @@
+""" Tests for waiting on files """
+
+import os
+import threading
+import time
+
+import pytest
+
+from pypiper.filewatch import DirectoryWatcher, wait_for
+
+
+
+def _later(delay, func, *args):
+    timer = threading.Timer(delay, func, args)
+    timer.start()
+    return timer
+
+
+
+def test_deletion_wakes_waiter(tmpdir):
+    """ A waiter on a lock wakes when it's removed, not at the next poll. """
+    lock = tmpdir.join("lock.file")
+    lock.write("")
+    with DirectoryWatcher(tmpdir.strpath) as watcher:
+        if not watcher.active:
+            pytest.skip("inotify is unavailable")
+        _later(0.2, os.remove, lock.strpath)
+        start = time.time()
+        assert watcher.wait(10)
+        assert time.time() - start < 2
+    assert not lock.check()
+
+
+
+def test_creation_wakes_waiter(tmpdir):
+    """ A waiter on a file wakes when it's created. """
+    target = tmpdir.join("target.txt")
+    _later(0.2, target.write, "done")
+    wait_for(target.check, target.strpath)
+    assert target.check()
+
+
+
+def test_unwatchable_folder_falls_back_to_polling(tmpdir):
+    """ Without a watch, the condition is still rechecked periodically. """
+    watcher = DirectoryWatcher(tmpdir.join("missing").strpath)
+    assert not watcher.active
+    assert not watcher.wait(0.01)
+    timeouts = []
+    flag = []
+    _later(0.5, flag.append, True)
+    wait_for(lambda: bool(flag), tmpdir.join("missing", "file").strpath,
+             max_interval=0.5, on_timeout=lambda: timeouts.append(1))
+    assert timeouts
@@ -0,0 +1,108 @@
+""" Tests for reading version provenance from git repositories """
+
+import os
+import subprocess
+
+import pytest
+
+from pypiper.gitinfo import commit_date, diff_stat, diff_stat_async, repo_info
+
+
+
+def _git(repo, *args):
+    return subprocess.check_output(
+        ["git"] + list(args), cwd=repo,
+        env=dict(os.environ, GIT_AUTHOR_NAME="a", GIT_AUTHOR_EMAIL="a@b",
+                 GIT_COMMITTER_NAME="a", GIT_COMMITTER_EMAIL="a@b",
+                 GIT_AUTHOR_DATE="1500000000 -0400")
+    ).decode().strip()
+
+
+
+@pytest.fixture
+def repo(tmpdir):
+    """ Repository with a couple of commits. """
+    path = tmpdir.strpath
+    try:
+        _git(path, "init", "-q")
+    except OSError:
+        pytest.skip("git isn't available")
+    _git(path, "checkout", "-q", "-b", "main")
+    for i in range(2):
+        tmpdir.join("code.py").write("x = {}\n".format(i))
+        _git(path, "add", "code.py")
+        _git(path, "commit", "-q", "-m", "commit {}".format(i))
+    return path
+
+
+
+def _expected(repo):
+    return {"hash": _git(repo, "rev-parse", "HEAD"), "branch": "main",
+            "date": _git(repo, "show", "-s", "--format=%ai", "HEAD")}
+
+
+
+def test_loose_objects(repo):
+    """ Commit, branch, and date are read as git reports them. """
+    expected = _expected(repo)
+    assert "2017-07-13 22:40:00 -0400" == expected["date"]
+    assert expected == repo_info(os.path.join(repo))
+
+
+
+def test_packed_refs_and_objects(repo):
+    """ A packed repository is read from its pack files. """
+    expected = _expected(repo)
+    _git(repo, "gc", "-q")
+    assert not os.path.exists(os.path.join(repo, ".git", "refs", "heads", "main"))
+    assert expected == repo_info(repo)
+
+
+
+def test_every_packed_commit_found(repo, tmpdir):
+    """ Each commit in a pack is found by searching its index. """
+    for i in range(2, 20):
+        tmpdir.join("code.py").write("x = {}\n".format(i))
+        _git(repo, "commit", "-q", "-am", "commit {}".format(i))
+    _git(repo, "gc", "-q")
+    git_dir = os.path.join(repo, ".git")
+    for sha in _git(repo, "rev-list", "--all").split():
+        assert _git(repo, "show", "-s", "--format=%ai", sha) == \
+            commit_date(git_dir, sha)
+    assert commit_date(git_dir, "0" * 40) is None
+
+
+
+def test_detached_head(repo):
+    """ A commit checked out directly isn't on a branch. """
+    sha = _git(repo, "rev-parse", "HEAD~1")
+    _git(repo, "checkout", "-q", sha)
+    info = repo_info(repo)
+    assert sha == info["hash"]
+    assert "(HEAD detached at {})".format(sha[:7]) == info["branch"]
+
+
+
+def test_new_commit_seen(repo, tmpdir):
+    """ Provenance follows the branch when it moves. """
+    before = repo_info(repo)["hash"]
+    tmpdir.join("code.py").write("x = 2\n")
+    _git(repo, "commit", "-q", "-am", "commit 2")
+    assert before != repo_info(repo)["hash"]
+
+
+
+def test_not_a_repository(tmpdir):
+    """ There's no provenance outside of a repository. """
+    if repo_info(tmpdir.strpath) is not None:
+        pytest.skip("temporary folder is inside a repository")
+    assert repo_info(tmpdir.strpath) is None
+
+
+
+def test_diff(repo, tmpdir):
+    """ Uncommitted changes are summarized, now or in the background. """
+    assert "" == diff_stat(repo)
+    tmpdir.join("code.py").write("y = 3\n")
+    assert "1 file changed" in diff_stat(repo)
+    assert diff_stat(repo) == diff_stat_async(repo).result(timeout=10)
@@ -0,0 +1,128 @@
+""" Tests for the copying of output to the console and a log file """
+
+import gzip
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from pypiper.logmux import LogMultiplexer
+
+
+
+@pytest.fixture
+def console(tmpdir):
+    """ File standing in for the console. """
+    with open(tmpdir.join("console").strpath, "wb") as f:
+        yield f
+
+
+
+def _run(mux, cmd, tail=0):
+    stream = mux.open_stream(tail=tail)
+    p = subprocess.Popen(cmd, shell=True, stdout=stream.fileno(),
+                         stderr=stream.fileno())
+    stream.close_writer()
+    p.wait()
+    return mux.finish(stream)
+
+
+
+def test_output_copied_to_console_and_log(tmpdir, console):
+    """ Output of commands, out and err, goes to both places, in order. """
+    log = tmpdir.join("log.md").strpath
+    mux = LogMultiplexer(log, console_fd=console.fileno())
+    _run(mux, "echo one; echo two >&2")
+    _run(mux, "echo three")
+    mux.close()
+    with open(log) as f:
+        assert "one\ntwo\nthree\n" == f.read()
+    with open(console.name) as f:
+        assert "one\ntwo\nthree\n" == f.read()
+
+
+
+def test_output_tail_kept(console):
+    """ The end of a command's output can be kept. """
+    mux = LogMultiplexer(console_fd=console.fileno())
+    assert "last\n" == _run(mux, "seq 1000; echo last", tail=5)
+    assert "" == _run(mux, "echo nothing kept")
+    mux.close()
+
+
+
+def test_log_rotated_and_compressed(tmpdir, console):
+    """ A log that reaches its size limit is moved aside and compressed. """
+    log = tmpdir.join("log.md").strpath
+    mux = LogMultiplexer(log, console_fd=console.fileno(), max_size=1000,
+                         backups=2)
+    for _ in range(4):
+        _run(mux, "seq 1000 1249")
+    mux.close()
+    assert not os.path.exists(log + ".1")
+    assert os.path.exists(log + ".2.gz")
+    assert not os.path.exists(log + ".3.gz")
+    with gzip.open(log + ".1.gz") as f:
+        assert f.read().startswith(b"1000\n")
+
+
+
+def test_pipeline_output_logged(tmpdir):
+    """ A pipeline's own output and its commands' output are logged. """
+    script = tmpdir.join("pipe.py")
+    script.write(textwrap.dedent("""
+        import pypiper
+        pm = pypiper.PipelineManager("pipe", outfolder={!r})
+        print("before")
+        pm.run("echo from command", lock_name="cmd")
+        print("after")
+        pm.stop_pipeline()
+        """.format(tmpdir.join("out").strpath)))
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))))
+    out = subprocess.check_output([sys.executable, script.strpath], env=env)
+    with open(tmpdir.join("out", "pipe_log.md").strpath) as f:
+        log = f.read()
+    assert log.index("before") < log.index("from command") < \
+        log.index("after") < log.index("Pipeline completed")
+    assert b"from command" in out
+
+
+
+def test_log_failure_falls_back_to_console(tmpdir, console, capfd):
+    """ If the log can't be written, output still reaches the console. """
+    log = tmpdir.join("log.md").strpath
+    mux = LogMultiplexer(log, console_fd=console.fileno(), max_size=1000)
+
+    def fail():
+        raise OSError(28, "No space left on device")
+    mux._rotate = fail
+    _run(mux, "seq 1000 1249")
+    _run(mux, "echo after")
+    mux.close()
+    with open(console.name) as f:
+        assert f.read().endswith("1249\nafter\n")
+    assert "No space left on device" in capfd.readouterr().err
+
+
+
+def test_copying_survives_thread_error(console, capfd, monkeypatch):
+    """ An error in the copying thread is reported, and copying goes on. """
+    copy = LogMultiplexer._copy
+    calls = []
+
+    def fail_once(mux):
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("copy failed")
+        copy(mux)
+    monkeypatch.setattr(LogMultiplexer, "_copy", fail_once)
+    mux = LogMultiplexer(console_fd=console.fileno())
+    # Much more than a pipe holds, so the writer hangs if nothing copies.
+    _run(mux, "seq 1 100000; echo last")
+    mux.close()
+    with open(console.name) as f:
+        assert f.read().endswith("100000\nlast\n")
+    assert "copy failed" in capfd.readouterr().err
@@ -0,0 +1,105 @@
+""" Tests for the summary of the profiles of many pipeline runs """
+
+import json
+import os
+
+import pytest
+
+from pypiper.cli import main
+from pypiper.profiling import read_profiles, summarize_profiles
+
+
+
+def _write_jsonl(folder, records):
+    os.makedirs(folder)
+    with open(os.path.join(folder, "pipe_profile.jsonl"), "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+
+def _record(command, wall, mem, exit_code=0, stage=None):
+    return {"pipeline": "pipe", "command": command, "stage": stage,
+            "pid": 1, "wall": wall, "peak_mem": mem, "exit_code": exit_code}
+
+
+
+@pytest.fixture
+def folders(tmpdir):
+    """ Output folders of several runs of a pipeline. """
+    paths = []
+    for i in range(4):
+        path = tmpdir.join("sample{}".format(i)).strpath
+        _write_jsonl(path, [
+            _record("bowtie2 -x idx", 10.0 * (i + 1), 2.0, stage="align"),
+            _record("/usr/bin/samtools sort", 1.0, 0.5, exit_code=i % 2,
+                    stage="sort")])
+        paths.append(path)
+    return paths
+
+
+
+def test_summary_by_tool(folders):
+    """ Commands are grouped by program, with percentiles and failures. """
+    summary = summarize_profiles(read_profiles(folders))
+    assert ["bowtie2", "samtools"] == [g["group"] for g in summary]
+    bowtie, samtools = summary
+    assert 4 == bowtie["runs"]
+    assert 100.0 == bowtie["wall_total"]
+    assert 25.0 == bowtie["wall_p50"]
+    assert pytest.approx(38.5) == bowtie["wall_p95"]
+    assert 2.0 == bowtie["mem_max"]
+    assert 0 == bowtie["failures"]
+    assert 2 == samtools["failures"]
+    assert 0.5 == samtools["failure_rate"]
+
+
+
+def test_summary_by_stage(folders):
+    """ Commands can be grouped by the stage they're part of. """
+    summary = summarize_profiles(read_profiles(folders), by="stage")
+    assert ["align", "sort"] == [g["group"] for g in summary]
+
+
+
+def test_tsv_profile_read_if_no_jsonl(tmpdir):
+    """ An older output folder is summarized from its TSV profile. """
+    tmpdir.join("pipe_profile.tsv").write(
+        "# Pipeline started at 01-01 00:00:00\n\n"
+        "# \tcommand\tlock\ttime\tmem\n"
+        "bowtie2\tlock.aln\t0:01:02.5\t 1.5\n"
+        "samtools\tNone\t1 day, 0:00:01\t 0.25\t 3.0\n")
+    profile = read_profiles(tmpdir.strpath)
+    assert [62.5, 86401.0] == profile["wall"]
+    assert [1.5, 0.25] == profile["peak_mem"]
+    assert ["lock.aln", None] == profile["lock_name"]
+    summary = summarize_profiles(profile)
+    assert all(g["failure_rate"] is None for g in summary)
+
+
+
+def test_reading_in_parallel(folders):
+    """ Reading in several processes gives the same records, in order. """
+    assert read_profiles(folders) == read_profiles(folders, workers=2)
+
+
+
+def test_report_command(folders, tmpdir, capsys):
+    """ The report lists top offenders and can write the full summary. """
+    output = tmpdir.join("summary.tsv").strpath
+    pattern = os.path.join(os.path.dirname(folders[0]), "sample*")
+    assert 0 == main(["profile-report", pattern, "--sort", "failures",
+                      "--top", "1", "-p", "1", "-o", output])
+    out = capsys.readouterr().out
+    assert "folders: 4" in out
+    assert "samtools" in out and "bowtie2" not in out
+    with open(output) as f:
+        lines = f.read().splitlines()
+    assert 3 == len(lines)
+    assert lines[0].startswith("group\truns")
+
+
+
+def test_report_without_profiles(tmpdir):
+    """ Nothing to summarize is an error. """
+    assert 1 == main(["profile-report", tmpdir.strpath])
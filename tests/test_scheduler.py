@@ -0,0 +1,74 @@
+""" Tests for the sharing of a pipeline's cores and memory among commands """
+
+import threading
+import time
+
+import pytest
+
+from pypiper.scheduler import ResourcePool, parse_mem
+
+
+
+@pytest.mark.parametrize(["spec", "expected"], [
+    (4000, 4000), ("4000", 4000), ("4000m", 4000), ("8G", 8192),
+    ("8gb", 8192), ("512k", 0.5)])
+def test_parse_mem(spec, expected):
+    """ Memory may be given in megabytes or with a unit suffix. """
+    assert expected == parse_mem(spec)
+
+
+
+def test_parse_mem_invalid():
+    """ Unintelligible memory specification is an error. """
+    with pytest.raises(ValueError):
+        parse_mem("lots")
+
+
+
+def test_request_beyond_free_resources_waits():
+    """ A request that doesn't fit waits for a release. """
+    pool = ResourcePool(cores=4, mem=1000)
+    pool.acquire(cores=2, mem=800)
+    assert pool.acquire(cores=1, mem=400, blocking=False) is None
+    assert (2, 200) == pool.acquire(cores=2, mem=200, blocking=False)
+    assert 0 == pool.free_cores
+
+
+
+def test_oversized_request_is_trimmed():
+    """ A request larger than the whole budget runs alone. """
+    pool = ResourcePool(cores=2, mem=1000)
+    assert (2, 1000) == pool.acquire(cores=8, mem=5000, blocking=False)
+
+
+
+def test_requests_admitted_in_order():
+    """ Small requests don't jump ahead of a waiting large one. """
+    pool = ResourcePool(cores=4, mem=0)
+    first = pool.acquire(cores=2)
+    started = []
+    def take(cores):
+        with pool.reserve(cores=cores):
+            started.append(cores)
+    big = threading.Thread(target=take, args=(4, ))
+    big.start()
+    time.sleep(0.2)
+    # Two cores are free, but the 4-core request is ahead in line.
+    assert pool.acquire(cores=1, blocking=False) is None
+    pool.release(first)
+    big.join(5)
+    assert [4] == started
+    assert 4 == pool.free_cores
+
+
+
+def test_pipeline_commands_share_cores(get_pipe_manager, tmpdir):
+    """ Commands that together need more cores than there are take turns. """
+    pm = get_pipe_manager(name="scheduled", cores=2)
+    jobs = [{"cmd": "sleep 1", "lock_name": "job{}".format(i), "cores": 2}
+            for i in range(2)]
+    start = time.time()
+    assert [0, 0] == pm.run_parallel(jobs)
+    assert time.time() - start >= 2
+    assert 2 == pm.resources.free_cores
+    pm.stop_pipeline()
@@ -0,0 +1,414 @@
+""" Tests for reading alignment files natively """
+
+import gzip
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from pypiper import seqio
+from pypiper.ngstk import NGSTk
+from pypiper.seqio import UniqueCounter, bam_to_fastq, count_flags, \
+    count_lines, count_unique_names, fastq_stats, split_fastq
+from tests.helpers import _bgzf_block, _gzip_member, write_bam, write_sam
+
+
+_REPO_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Flags of a few of each kind of read
+FLAGS = [0, 4, 16, 256, 256 + 16, 512, 1024, 2048,
+         1 + 2 + 64, 1 + 2 + 128, 1 + 8 + 64, 1 + 4 + 128]
+
+
+
+@pytest.fixture(params=["bam", "sam"])
+def reads_file(request, tmpdir):
+    """ Alignment file with several reads of each flag. """
+    reads = [{"name": "r{}".format(i), "flag": flag, "seq": "ACGT",
+              "qual": "IIII"} for i, flag in enumerate(FLAGS * 50)]
+    path = tmpdir.join("reads." + request.param).strpath
+    (write_bam if request.param == "bam" else write_sam)(path, reads)
+    return path
+
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_flag_tallies(reads_file, workers):
+    """ Each kind of read is counted, in one pass. """
+    counts = count_flags(reads_file, workers=workers)
+    assert {
+        "total": 600, "mapped": 500, "unmapped": 100, "primary": 450,
+        "primary_mapped": 350, "secondary": 100, "supplementary": 50,
+        "qc_fail": 50, "duplicates": 50, "paired": 200,
+        "properly_paired": 100, "read1": 100, "read2": 100
+    } == counts.as_dict()
+    assert 50 == counts.count(require=16, exclude=256)
+
+
+
+def test_counts_reused(reads_file):
+    """ An unchanged file is read only once. """
+    assert count_flags(reads_file) is count_flags(reads_file)
+
+
+
+def test_truncated_bam(tmpdir):
+    """ A BAM file that ends partway through isn't silently miscounted. """
+    path = tmpdir.join("reads.bam").strpath
+    write_bam(path, [{"name": "r", "flag": 0}] * 10)
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) // 2])
+    with pytest.raises(ValueError):
+        count_flags(path)
+
+
+
+def test_toolkit_counts(reads_file):
+    """ The toolkit's counting functions use the tally. """
+    tk = NGSTk()
+    assert 600 == tk.count_reads(reads_file, False)
+    assert 500 == tk.count_mapped_reads(reads_file, False)
+    assert 100 == tk.count_multimapping_reads(reads_file, False)
+    assert 500 == tk.count_uniquelymapping_reads(reads_file, False)
+    assert 50 == tk.count_fail_reads(reads_file, False)
+    assert 100 == tk.count_flag_reads(reads_file, 64, False)
+
+
+
+@pytest.fixture(params=["bam", "sam"])
+def pairs_file(request, tmpdir):
+    """ Paired-end alignments, some reads aligned more than once. """
+    reads = []
+    for i in range(100):
+        for flag in [1 + 64, 1 + 128, 1 + 64 + 256]:
+            # Every tenth pair's second read is unmapped.
+            if flag & 128 and i % 10 == 0:
+                flag |= 4
+            reads.append({"name": "pair{}".format(i), "flag": flag})
+    path = tmpdir.join("pairs." + request.param).strpath
+    (write_bam if request.param == "bam" else write_sam)(path, reads)
+    return path
+
+
+
+def test_unique_names(pairs_file):
+    """ First and second reads' names are counted in one pass. """
+    assert (100, 100, True) == count_unique_names(pairs_file, paired_end=True)
+    assert (100, 90, True) == \
+        count_unique_names(pairs_file, paired_end=True, exclude=4)
+    assert (100, 0, True) == count_unique_names(pairs_file)
+
+
+
+def test_unique_names_bounded(pairs_file):
+    """ Beyond the limit on names held, counts are estimated. """
+    r1, r2, exact = count_unique_names(
+        pairs_file, paired_end=True, max_exact=50)
+    assert not exact
+    assert 95 <= r1 <= 105 and 95 <= r2 <= 105
+
+
+
+def test_approximate_count():
+    """ The estimate of many distinct values is close. """
+    counter = UniqueCounter(approximate=True)
+    for i in range(200000):
+        counter.add("read{}".format(i % 100000).encode())
+    assert not counter.exact
+    assert abs(counter.count() - 100000) < 3000
+
+
+
+def test_approximate_count_reproducible():
+    """ The same values give the same estimate in any process. """
+    script = ("from pypiper.seqio import UniqueCounter\n"
+              "c = UniqueCounter(approximate=True)\n"
+              "for i in range(20000): c.add(('read%d' % i).encode())\n"
+              "print(c.count())")
+    estimates = set()
+    for seed in ["1", "2"]:
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        estimates.add(subprocess.check_output(
+            [sys.executable, "-c", script], env=env, cwd=_REPO_FOLDER))
+    assert 1 == len(estimates)
+
+
+
+def test_exact_count_unbounded_by_default():
+    """ Counting is exact unless a limit is set. """
+    assert UniqueCounter().max_exact is None
+    counter = UniqueCounter(max_exact=10)
+    for i in range(11):
+        counter.add("read{}".format(i).encode())
+    assert not counter.exact
+
+
+
+def test_toolkit_unique_counts(pairs_file):
+    """ The toolkit counts unique reads without sorting. """
+    tk = NGSTk()
+    assert 200 == tk.count_unique_reads(pairs_file, True)
+    assert 190 == tk.count_unique_mapped_reads(pairs_file, True)
+    assert 100 == tk.count_unique_reads(pairs_file, False)
+
+
+
+def test_toolkit_estimates_only_if_asked(pairs_file, capsys):
+    """ An estimated count of unique reads is reported as such. """
+    tk = NGSTk()
+    tk.count_unique_reads(pairs_file, True)
+    assert "estimate" not in capsys.readouterr()[0]
+    assert 190 <= tk.count_unique_reads(pairs_file, True, max_exact=50) <= 210
+    assert "estimate" in capsys.readouterr()[0]
+
+
+
+@pytest.fixture(params=["plain", "gzip", "bgzf"])
+def fastq_file(request, tmpdir):
+    """ FASTQ file of 300 reads, compressed or not. """
+    records = ["@r{}\nACGT\n+\nIIII\n".format(i).encode() for i in range(300)]
+    path = tmpdir.join("reads.fastq").strpath
+    if request.param == "plain":
+        with open(path, "wb") as f:
+            f.write(b"".join(records))
+        return path
+    path += ".gz"
+    with open(path, "wb") as f:
+        # Several members or blocks, as from concatenated files
+        for start in range(0, 300, 70):
+            data = b"".join(records[start:start + 70])
+            f.write(_gzip_member(data) if request.param == "gzip"
+                    else _bgzf_block(data))
+        if request.param == "bgzf":
+            f.write(_bgzf_block(b""))
+    return path
+
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_line_count(fastq_file, workers):
+    """ Lines are counted whether or how the file's compressed. """
+    assert 1200 == count_lines(fastq_file, workers=workers)
+
+
+
+def test_toolkit_fastq_read_count(fastq_file):
+    """ The toolkit counts FASTQ reads as a whole number. """
+    tk = NGSTk()
+    count = tk.count_reads(fastq_file, False)
+    assert 300 == count and isinstance(count, int)
+    assert 600 == tk.count_reads(fastq_file, True)
+
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_mapped_line_count(tmpdir, monkeypatch, workers):
+    """ An uncompressed file's lines are counted across its parts. """
+    monkeypatch.setattr(seqio, "_READ_SIZE", 7)
+    monkeypatch.setattr(seqio, "_PARALLEL_MIN_SIZE", 20)
+    path = tmpdir.join("peaks.bed")
+    path.write("chr1\t1\t2\n" * 50 + "chr2\t5\t9")
+    assert 50 == count_lines(path.strpath, workers=workers)
+    path.write("")
+    assert 0 == count_lines(path.strpath, workers=workers)
+
+
+
+def test_peak_number(tmpdir):
+    """ A sample's peaks are counted without running wc. """
+    class Sample(dict):
+        peaks = tmpdir.join("peaks.bed").strpath
+    tmpdir.join("peaks.bed").write("chr1\t1\t2\n" * 12)
+    assert 12 == NGSTk().get_peak_number(Sample())["peakNumber"]
+
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_fastq_stats(fastq_file, workers):
+    """ A FASTQ file's statistics are gathered in one pass. """
+    stats = fastq_stats(fastq_file, workers=workers)
+    assert 300 == stats.reads and 1200 == stats.bases
+    assert 0.5 == stats.gc_fraction and 4.0 == stats.mean_length
+    assert [0, 0, 0, 0, 300] == list(stats.length_histogram)
+    assert [40.0] * 4 == list(stats.mean_quality)
+
+
+
+def test_fastq_stats_varied_lengths(tmpdir, monkeypatch):
+    """ Mean quality at a position is over the reads reaching it. """
+    monkeypatch.setattr(seqio, "_READ_SIZE", 5)
+    path = tmpdir.join("trimmed.fastq")
+    path.write("@a\nGGG\n+\n+++\n@b\nA\n+\n5\n@c\nAT\n+\n55")
+    stats = fastq_stats(path.strpath)
+    assert 3 == stats.reads and 6 == stats.bases
+    assert [0, 1, 1, 1] == list(stats.length_histogram)
+    assert pytest.approx([50 / 3.0, 15, 10]) == list(stats.mean_quality)
+    path.write("@a\nGGG\n+\n")
+    with pytest.raises(ValueError):
+        fastq_stats(path.strpath)
+
+
+
+def test_trim_stats_reported(tmpdir, get_pipe_manager):
+    """ Checking trimming reports the reads' statistics. """
+    path = tmpdir.join("trimmed.fastq")
+    path.write("@a\nGGCA\n+\nIIII\n@b\nAT\n+\nII\n")
+    pm = get_pipe_manager(name="trim_stats")
+    NGSTk(pm=pm).check_trim(path.strpath, paired_end=False)()
+    assert 2 == pm.get_stat("Trimmed_reads")
+    assert 6 == pm.get_stat("Trimmed_bases")
+    assert 3.0 == pm.get_stat("Trimmed_mean_length")
+    assert 0.5 == pm.get_stat("Trimmed_GC_fraction")
+    pm.stop_pipeline()
+
+
+
+def test_paired_trim_reads_each_file_once(
+        tmpdir, monkeypatch, get_pipe_manager):
+    """ Each mate's file is read once, for its count and statistics. """
+    reads_of = []
+    decompressed_chunks = seqio._decompressed_chunks
+    def record(path, *args):
+        reads_of.append(os.path.basename(path))
+        return decompressed_chunks(path, *args)
+    monkeypatch.setattr(seqio, "_decompressed_chunks", record)
+    for mate in ("R1", "R2"):
+        tmpdir.join(mate + ".fastq").write(
+            "@a\nGGCA\n+\nIIII\n@b\nAT\n+\nII\n")
+    pm = get_pipe_manager(name="trim_pairs")
+    NGSTk(pm=pm).check_trim(tmpdir.join("R1.fastq").strpath, paired_end=True,
+                            trimmed_fastq_R2=tmpdir.join("R2.fastq").strpath)()
+    assert ["R1.fastq", "R2.fastq"] == sorted(reads_of)
+    assert 4 == pm.get_stat("Trimmed_reads")
+    assert 12 == pm.get_stat("Trimmed_bases")
+    pm.stop_pipeline()
+
+
+
+@pytest.fixture
+def unsorted_pairs_bam(tmpdir):
+    """ BAM of pairs whose mates are apart, plus other kinds of reads. """
+    reads = []
+    for i in range(100):
+        reads.append({"name": "p{}".format(i), "flag": 1 + 64,
+                      "seq": "AACG", "qual": "ABCD"})
+    for i in reversed(range(100)):
+        reads.append({"name": "p{}".format(i), "flag": 1 + 128 + 16,
+                      "seq": "AACG", "qual": "ABCD"})
+    reads.append({"name": "lone", "flag": 1 + 64 + 512, "seq": "ACGTN"})
+    reads.append({"name": "p0", "flag": 1 + 64 + 256, "seq": "A"})
+    path = tmpdir.join("pairs.bam").strpath
+    write_bam(path, reads)
+    return path
+
+
+
+def _read_fastq(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        lines = f.read().decode().splitlines()
+    return [lines[i:i + 4] for i in range(0, len(lines), 4)]
+
+
+
+@pytest.mark.parametrize(["workers", "ext"], [(1, ".fastq"), (3, ".fastq.gz")])
+def test_bam_to_fastq_pairs(unsorted_pairs_bam, tmpdir, workers, ext):
+    """ Mates are paired wherever they are, and singletons set aside. """
+    fq1, fq2, single = [tmpdir.join(name + ext).strpath
+                        for name in ["R1", "R2", "single"]]
+    counts = bam_to_fastq(unsorted_pairs_bam, fq1, fq2, singletons=single,
+                          workers=workers)
+    assert {"reads": 201, "qc_failed": 1, "pairs": 100, "singletons": 1,
+            "written": 201} == counts
+    r1, r2 = _read_fastq(fq1), _read_fastq(fq2)
+    assert [name[1:-2] for name, _, _, _ in r1] == \
+        [name[1:-2] for name, _, _, _ in r2]
+    assert ["@p99/1", "AACG", "+", "ABCD"] == r1[0]
+    # Reverse-strand reads are restored to their original orientation.
+    assert ["@p99/2", "CGTT", "+", "DCBA"] == r2[0]
+    assert [["@lone/1", "ACGTN", "+", '"""""']] == _read_fastq(single)
+
+
+
+def test_bam_to_fastq_limited_pending(unsorted_pairs_bam, tmpdir):
+    """ Reads held longest become singletons when too many are held. """
+    fq1, fq2 = tmpdir.join("R1.fastq").strpath, tmpdir.join("R2.fastq").strpath
+    counts = bam_to_fastq(unsorted_pairs_bam, fq1, fq2, max_pending=50)
+    assert 50 == counts["pairs"] and 101 == counts["singletons"]
+    assert 100 == counts["written"]
+    assert ["@p99/1", "@p50/1"] == [r1[0] for r1 in _read_fastq(fq1)][::49]
+
+
+
+def test_bam_to_fastq_full_buffer(tmpdir):
+    """ Evicting from a large, full buffer of unmatched reads stays fast. """
+    reads = [{"name": "d{}".format(i), "flag": 1 + 64, "seq": "AC",
+              "qual": "II"} for i in range(300000)]
+    path = tmpdir.join("discordant.bam").strpath
+    write_bam(path, reads)
+    fq1, fq2 = tmpdir.join("R1.fastq").strpath, tmpdir.join("R2.fastq").strpath
+    start = time.time()
+    counts = bam_to_fastq(path, fq1, fq2, max_pending=100000)
+    # Each eviction used to take time in proportion to those before it.
+    assert time.time() - start < 8
+    assert 0 == counts["pairs"] and 300000 == counts["singletons"]
+
+
+
+def test_toolkit_bam_conversion_reports_counts(
+        unsorted_pairs_bam, tmpdir, get_pipe_manager):
+    """ Converting reports the read counts without counting again. """
+    pm = get_pipe_manager(name="bam_conversion")
+    prefix = tmpdir.join("fastq", "sample").strpath
+    fq1, fq2, counts = NGSTk(pm=pm).bam_to_fastq_native(
+        unsorted_pairs_bam, prefix, paired_end=True)
+    assert prefix + "_R2.fastq" == fq2 and 100 == len(_read_fastq(fq2))
+    assert 201 == pm.get_stat("Raw_reads")
+    assert 200 == pm.get_stat("PF_reads")
+    assert 200 == pm.get_stat("Fastq_reads")
+    pm.stop_pipeline()
+
+
+
+@pytest.mark.parametrize("ext", [".fastq", ".fastq.gz"])
+@pytest.mark.parametrize("workers", [1, 3])
+def test_split_fastq(fastq_file, tmpdir, ext, workers):
+    """ Alternate records go to each output, wherever chunks end. """
+    fq1, fq2 = tmpdir.join("R1" + ext).strpath, tmpdir.join("R2" + ext).strpath
+    counts = split_fastq(fastq_file, fq1, fq2, workers=workers)
+    assert {"pairs": 150, "reads": 300} == counts
+    r1, r2 = _read_fastq(fq1), _read_fastq(fq2)
+    assert ["@r0", "ACGT", "+", "IIII"] == r1[0]
+    assert ["@r299", "ACGT", "+", "IIII"] == r2[-1]
+    assert ["@r{}".format(i) for i in range(1, 300, 2)] == \
+        [record[0] for record in r2]
+
+
+
+def test_split_fastq_small_chunks(tmpdir, monkeypatch):
+    """ Records split across chunks are kept whole; an odd one's an error. """
+    monkeypatch.setattr(seqio, "_READ_SIZE", 3)
+    path = tmpdir.join("pairs.fastq")
+    path.write("@a/1\nAC\n+\nII\n@a/2\nGT\n+\nII\n" * 5)
+    fq1, fq2 = tmpdir.join("R1.fastq").strpath, tmpdir.join("R2.fastq").strpath
+    assert 5 == split_fastq(path.strpath, fq1, fq2)["pairs"]
+    assert "@a/1\nAC\n+\nII\n" * 5 == tmpdir.join("R1.fastq").read()
+    path.write("@a/1\nAC\n+\nII\n")
+    with pytest.raises(ValueError):
+        split_fastq(path.strpath, fq1, fq2)
+
+
+
+def test_toolkit_split_reports_counts(fastq_file, tmpdir, get_pipe_manager):
+    """ Splitting reports the read counts without counting again. """
+    pm = get_pipe_manager(name="fastq_split")
+    fq1, fq2, counts = NGSTk(pm=pm).split_fastq(
+        fastq_file, tmpdir.join("split", "sample").strpath, gzip=True)
+    assert fq2.endswith("sample_R2.fastq.gz") and 150 == len(_read_fastq(fq2))
+    assert 300 == pm.get_stat("Raw_reads") == pm.get_stat("Fastq_reads")
+    pm.stop_pipeline()
@@ -0,0 +1,133 @@
+""" Tests for the loading of pipeline configuration files """
+
+import marshal
+import os
+
+import pytest
+
+from pypiper import yamlconfig
+from pypiper.ngstk import NGSTk
+from pypiper.yamlconfig import load_yaml
+
+
+CONFIG = "tools:\n  java: /opt/java\nparameters:\n  threads: 4\n"
+
+
+
+@pytest.fixture
+def config_file(tmpdir, monkeypatch):
+    """ Config file, with its parses cached in a temporary folder. """
+    monkeypatch.setenv("PYPIPER_CACHE", tmpdir.join("cache").strpath)
+    monkeypatch.setattr(yamlconfig, "_parsed", {})
+    path = tmpdir.join("pipe.yaml")
+    path.write(CONFIG)
+    return path.strpath
+
+
+
+def _forget_parses(monkeypatch):
+    """ Start over as if in a new process. """
+    monkeypatch.setattr(yamlconfig, "_parsed", {})
+
+
+
+def test_parse_reused_within_process(config_file, monkeypatch):
+    """ The file isn't parsed again while it's unchanged. """
+    config = load_yaml(config_file)
+    assert {"java": "/opt/java"} == config["tools"]
+
+    def fail(path):
+        raise AssertionError("Parsed again")
+
+    monkeypatch.setattr(yamlconfig, "_parse", fail)
+    monkeypatch.setenv("PYPIPER_CACHE", "")
+    assert config == load_yaml(config_file)
+
+
+
+def test_changes_to_parse_not_shared(config_file):
+    """ Each caller gets a configuration of its own to modify. """
+    config = load_yaml(config_file)
+    config["tools"]["java"] = "/elsewhere/java"
+    config["extra"] = 1
+    again = load_yaml(config_file)
+    assert {"java": "/opt/java"} == again["tools"]
+    assert "extra" not in again
+
+
+
+def test_parse_cached_on_disk(config_file, monkeypatch):
+    """ Another process reuses the parse rather than parse the file. """
+    config = load_yaml(config_file)
+    _forget_parses(monkeypatch)
+
+    def fail(path):
+        raise AssertionError("Parsed again")
+
+    monkeypatch.setattr(yamlconfig, "_parse", fail)
+    assert config == load_yaml(config_file)
+
+
+
+def test_changed_file_parsed_again(config_file):
+    """ A cached parse is only used for the file as it was. """
+    load_yaml(config_file)
+    with open(config_file, "a") as f:
+        f.write("extra: 1\n")
+    assert 1 == load_yaml(config_file)["extra"]
+
+
+
+def test_disk_cache_disabled(config_file, monkeypatch, tmpdir):
+    """ An empty cache setting keeps parses off the disk. """
+    monkeypatch.setenv("PYPIPER_CACHE", "")
+    load_yaml(config_file)
+    assert not tmpdir.join("cache").check()
+
+
+
+def test_manager_and_toolkit_share_config(config_file, get_pipe_manager):
+    """ A toolkit given its manager's config file sees the same settings. """
+    pm = get_pipe_manager(name="shared", config_file=config_file)
+    tk = NGSTk(pm.config_file, pm)
+    assert "/opt/java" == pm.config.tools.java == tk.tools.java
+    assert 4 == tk.parameters.threads
+    pm.stop_pipeline()
+
+
+
+def test_disk_cache_opt_in(config_file, monkeypatch, tmpdir):
+    """ Without a cache folder configured, nothing's written to disk. """
+    monkeypatch.delenv("PYPIPER_CACHE")
+    monkeypatch.setenv("HOME", tmpdir.join("home").strpath)
+    monkeypatch.setenv("XDG_CACHE_HOME", tmpdir.join("xdg").strpath)
+    assert "" == yamlconfig.default_cache_folder()
+    load_yaml(config_file)
+    assert not tmpdir.join("home").check()
+    assert not tmpdir.join("xdg").check()
+
+
+
+def test_cached_parse_holds_only_plain_data(config_file, monkeypatch, tmpdir):
+    """ Parses are cached in marshal format, and only of plain data. """
+    load_yaml(config_file)
+    cache_files = tmpdir.join("cache", "config").listdir()
+    assert 1 == len(cache_files)
+    with open(cache_files[0].strpath, "rb") as f:
+        assert {"java": "/opt/java"} == marshal.load(f)["tools"]
+    # A date isn't plain data, so its configuration isn't cached on disk.
+    dated = tmpdir.join("dated.yaml")
+    dated.write("released: 2018-01-01\n")
+    assert "released" in load_yaml(dated.strpath)
+    assert 1 == len(tmpdir.join("cache", "config").listdir())
+
+
+
+def test_cached_code_ignored(config_file, monkeypatch, tmpdir):
+    """ A cache file that holds anything but plain data isn't used. """
+    load_yaml(config_file)
+    cache_file = tmpdir.join("cache", "config").listdir()[0]
+    with open(cache_file.strpath, "wb") as f:
+        marshal.dump(compile("1", "<cached>", "eval"), f)
+    _forget_parses(monkeypatch)
+    assert {"java": "/opt/java"} == load_yaml(config_file)["tools"]